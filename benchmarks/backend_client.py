@@ -0,0 +1,232 @@
+"""Reactions per second through the bot's backend client, before and after pooling.
+
+Serves ``bot.server`` with uvicorn in a child process on a seeded temporary
+SQLite database, then plays reactions against it the way ``bot.bot`` handles
+a vote reaction without its caches: ``get_vote`` for the message, then
+``add_vouch_event``. Each run uses one of two clients:
+
+- ``per-call``: a new ``aiohttp.ClientSession``, and so a new connection,
+  for every request, as ``bot.bot`` did before ``HTTPBackend``;
+- ``pooled``: ``HTTPBackend``'s one keep-alive session.
+
+::
+
+    python -m benchmarks.backend_client --reactions 2000 --concurrency 1 8 32 \\
+        --out backend_client.json
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Optional
+
+import aiohttp
+
+from bot.schemas import BotSettings, VouchEventBase
+from bot.tracing import percentiles
+
+MODES = ("per-call", "pooled")
+
+
+def create_client(mode: str, settings: BotSettings):
+    # bot.backend imports bot.db, which reads DATABASE_URL at import time.
+    from bot.backend import HTTPBackend
+
+    if mode == "pooled":
+        return HTTPBackend(settings)
+
+    class PerCallBackend(HTTPBackend):
+        """``HTTPBackend`` with a fresh session per request and no ETag cache."""
+
+        @contextlib.asynccontextmanager
+        async def _request(
+            self, method: str, path: str, timeout: Optional[float] = None, **kwargs
+        ):
+            async with aiohttp.ClientSession(
+                timeout=self.timeout, headers={"Content-Type": "application/json"}
+            ) as session:
+                async with session.request(
+                    method, "{}{}".format(self.base_url, path), **kwargs
+                ) as resp:
+                    yield resp
+
+    return PerCallBackend(settings.copy(update={"backend_etag_cache_size": 0}))
+
+
+async def run_level(
+    backend,
+    rng: random.Random,
+    vote_ids: List[str],
+    n_reactions: int,
+    concurrency: int,
+) -> dict:
+    # A new voucher per reaction, so every vouch is written.
+    plan = iter(
+        [
+            (rng.choice(vote_ids), "bench-{}-{}".format(concurrency, i))
+            for i in range(n_reactions)
+        ]
+    )
+    latencies: List[float] = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        for vote_id, voucher_id in plan:
+            start = time.perf_counter()
+            try:
+                await backend.get_vote(vote_id)
+                await backend.add_vouch_event(
+                    VouchEventBase(vote_id=vote_id, voucher_id=voucher_id)
+                )
+            except aiohttp.ClientError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "errors": errors,
+        "wall_s": wall,
+        "reactions_per_s": len(latencies) / wall if wall else 0.0,
+        **percentiles(latencies),
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_server(settings: BotSettings, server: subprocess.Popen):
+    backend = create_client("pooled", settings)
+    try:
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError("The backend server exited on startup")
+            try:
+                await backend.status(timeout=1.0)
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                await asyncio.sleep(0.1)
+    finally:
+        await backend.close()
+
+
+async def main_async(args, settings: BotSettings, server: subprocess.Popen):
+    await wait_for_server(settings, server)
+    rng = random.Random(args.seed)
+    runs = []
+    for mode in args.modes:
+        for concurrency in args.concurrency:
+            backend = create_client(mode, settings)
+            try:
+                run = await run_level(
+                    backend, rng, args.vote_ids, args.reactions, concurrency
+                )
+            finally:
+                await backend.close()
+            run["mode"] = mode
+            runs.append(run)
+            print(
+                "{:<9} concurrency={:<4} {:>8.1f} reactions/s  p50 {:.2f} ms"
+                "  p99 {:.2f} ms  errors {}".format(
+                    mode,
+                    concurrency,
+                    run["reactions_per_s"],
+                    run.get("p50_ms", 0.0),
+                    run.get("p99_ms", 0.0),
+                    run["errors"],
+                )
+            )
+    return runs
+
+
+async def seed_database(args) -> List[str]:
+    from bot import db
+
+    from .server_load import seed
+
+    try:
+        vote_ids, _ = await seed(
+            random.Random(args.seed), args.members, args.votes, args.vouches_per_vote
+        )
+    finally:
+        await db.engine.dispose()
+    return vote_ids
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--members", type=int, default=2000)
+    parser.add_argument("--votes", type=int, default=1000)
+    parser.add_argument("--vouches-per-vote", type=int, default=10)
+    parser.add_argument("--reactions", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    tmpdir = tempfile.TemporaryDirectory()
+    env = dict(
+        os.environ,
+        DATABASE_URL="sqlite+aiosqlite:///{}".format(
+            os.path.join(tmpdir.name, "bench.db")
+        ),
+        TRACE_SAMPLE_RATE="0",
+    )
+    # bot.db reads the URL at import time.
+    os.environ.update(env)
+    port = free_port()
+    settings = BotSettings(backend_url="http://127.0.0.1:{}".format(port))
+    server = None
+    try:
+        args.vote_ids = asyncio.run(seed_database(args))
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "bot.server:app",
+                "--port",
+                str(port),
+                "--log-level",
+                "warning",
+            ],
+            env=env,
+        )
+        runs = asyncio.run(main_async(args, settings, server))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        tmpdir.cleanup()
+
+    if args.out:
+        config = {
+            k: v for k, v in vars(args).items() if k not in ("out", "vote_ids")
+        }
+        results = {
+            "config": config,
+            "timestamp": datetime.datetime.utcnow().isoformat(),
+            "runs": runs,
+        }
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
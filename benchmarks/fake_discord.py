@@ -0,0 +1,596 @@
+"""A local stand-in for the Discord gateway and REST API.
+
+``FakeGateway`` feeds recorded gateway dispatches (``READY``,
+``GUILD_CREATE``, ``MESSAGE_CREATE``, ``MESSAGE_REACTION_ADD`` ...) into a
+real discord.py client through its ``ConnectionState`` parsers, so every
+listener, command and cache runs as it would live. ``FakeHTTPClient``
+replaces the client's REST client, answers the calls the bots make, and
+records each one against the event that caused it.
+
+Traces are JSON lines of ``{"t": seconds, "op": <dispatch name>, "d":
+<payload>}``. A ``message_id`` of ``"reply:<id>"`` stands for the bot's
+reply to message ``<id>``, e.g. the vote card posted for a ``!verify``,
+since its id is only known once the reply has been sent.
+
+Like Discord, ``FakeGateway`` only delivers the events the client's intents
+subscribe to, and blanks message text without the message content intent.
+"""
+import asyncio
+import contextvars
+import datetime
+import itertools
+import json
+import random
+import time
+from types import SimpleNamespace
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional
+
+import discord
+from discord.http import HTTPClient
+
+from bot.tracing import percentiles
+
+# The index of the trace event being handled; tasks and outbox actions
+# inherit it, so REST calls are charged to the event that caused them.
+current_event: contextvars.ContextVar = contextvars.ContextVar(
+    "current_event", default=None
+)
+
+DISCORD_EPOCH = 1420070400000
+
+# The intent each dispatch needs; others are always sent.
+EVENT_INTENTS = {
+    "MESSAGE_CREATE": "guild_messages",
+    "MESSAGE_REACTION_ADD": "guild_reactions",
+    "MESSAGE_REACTION_REMOVE": "guild_reactions",
+    "PRESENCE_UPDATE": "presences",
+    "TYPING_START": "guild_typing",
+    "VOICE_STATE_UPDATE": "voice_states",
+}
+
+
+def snowflake(when: datetime.datetime, counter: int) -> int:
+    ms = int(when.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+    return ((ms - DISCORD_EPOCH) << 22) | (counter & 0x3FFFFF)
+
+
+def user_payload(user_id: int, name: str, bot: bool = False) -> dict:
+    return {
+        "id": str(user_id),
+        "username": name,
+        "discriminator": "{:04d}".format(user_id % 10000),
+        "avatar": None,
+        "bot": bot,
+    }
+
+
+def member_payload(user: dict, role_ids: List[int]) -> dict:
+    return {
+        "user": user,
+        "roles": [str(role_id) for role_id in role_ids],
+        "nick": None,
+        "joined_at": "2022-01-01T00:00:00+00:00",
+        "deaf": False,
+        "mute": False,
+        "flags": 0,
+    }
+
+
+def role_payload(role_id: int, name: str, position: int) -> dict:
+    return {
+        "id": str(role_id),
+        "name": name,
+        "permissions": "0",
+        "position": position,
+        "color": 0,
+        "hoist": False,
+        "managed": False,
+        "mentionable": False,
+    }
+
+
+def message_payload(
+    message_id: int,
+    channel_id: int,
+    guild_id: int,
+    author: dict,
+    content: str = "",
+    member: Optional[dict] = None,
+    embeds: Optional[List[dict]] = None,
+    reference: Optional[dict] = None,
+) -> dict:
+    data = {
+        "id": str(message_id),
+        "channel_id": str(channel_id),
+        "guild_id": str(guild_id),
+        "author": author,
+        "content": content,
+        "timestamp": datetime.datetime.utcnow().isoformat() + "+00:00",
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": embeds or [],
+        "pinned": False,
+        "type": 0,
+    }
+    if member is not None:
+        data["member"] = {k: v for k, v in member.items() if k != "user"}
+    if reference is not None:
+        data["message_reference"] = reference
+        data["type"] = 19
+    return data
+
+
+class FakeHTTPClient(HTTPClient):
+    """Answers REST calls from in-memory state and records every call."""
+
+    def __init__(self, gateway: "FakeGateway", latency: float = 0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.gateway = gateway
+        self.latency = latency
+        self.calls: List[dict] = []
+
+    async def request(self, route, *, files=None, form=None, **kwargs):
+        self.calls.append(
+            {
+                "event": current_event.get(),
+                "method": route.method,
+                "route": route.path,
+                "at": time.perf_counter(),
+            }
+        )
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.gateway.answer(route, kwargs.get("json"))
+
+    async def static_login(self, token, *, bot):
+        return user_payload(self.gateway.bot_user["id"], "bot", bot=True)
+
+
+class FakeGateway:
+    """Replays a trace into ``client`` and answers its REST calls."""
+
+    def __init__(self, client: discord.Client, latency: float = 0.0):
+        """Create inside ``async with client``, on the loop that runs it."""
+        self.client = client
+        self.state = client._connection
+        self.http = FakeHTTPClient(
+            self, latency=latency, loop=asyncio.get_running_loop()
+        )
+        client.http = self.state.http = self.http
+        # No gateway round trips: ready as soon as the guilds are in.
+        self.state.guild_ready_timeout = 0.1
+        self.bot_user: dict = {}
+        self.members: Dict[int, dict] = {}
+        self.messages: Dict[int, dict] = {}
+        self.replies: Dict[int, int] = {}
+        self.injected: List[dict] = []
+        self.filtered: Dict[str, int] = {}
+        self.started_at: Optional[float] = None
+        self.ready_at: Optional[float] = None
+        self._ids = itertools.count(1)
+
+    def _not_found(self, text: str):
+        response = SimpleNamespace(status=404, reason="Not Found")
+        return discord.NotFound(response, {"message": text, "code": 10008})
+
+    def answer(self, route, payload: Optional[dict]):
+        method, path, url = route.method, route.path, route.url
+        if (method, path) == ("POST", "/channels/{channel_id}/messages"):
+            return self._send_message(route.channel_id, payload or {})
+        if (method, path) == ("GET", "/channels/{channel_id}/messages/{message_id}"):
+            message_id = int(url.rsplit("/", 1)[1])
+            if message_id not in self.messages:
+                raise self._not_found("Unknown Message")
+            return self.messages[message_id]
+        if (method, path) == ("GET", "/guilds/{guild_id}/members/{user_id}"):
+            user_id = int(url.rsplit("/", 1)[1])
+            if user_id not in self.members:
+                raise self._not_found("Unknown Member")
+            return self.members[user_id]
+        if path == "/guilds/{guild_id}/members/{user_id}/roles/{role_id}":
+            if method == "PUT":
+                _, user_id, _, role_id = url.rsplit("/", 3)
+                self._grant_role(route.guild_id, int(user_id), role_id)
+        return None
+
+    def _send_message(self, channel_id: int, payload: dict) -> dict:
+        message_id = snowflake(datetime.datetime.utcnow(), next(self._ids))
+        embeds = payload.get("embeds") or (
+            [payload["embed"]] if payload.get("embed") else []
+        )
+        reference = payload.get("message_reference")
+        channel = self.client.get_channel(channel_id)
+        data = message_payload(
+            message_id,
+            channel_id,
+            channel.guild.id,
+            self.bot_user,
+            content=payload.get("content") or "",
+            embeds=embeds,
+            reference=reference,
+        )
+        self.messages[message_id] = data
+        if reference is not None:
+            self.replies[int(reference["message_id"])] = message_id
+        return data
+
+    def _grant_role(self, guild_id: int, user_id: int, role_id: str):
+        # Discord follows a role grant with GUILD_MEMBER_UPDATE.
+        member = self.members.get(user_id)
+        if member is None or role_id in member["roles"]:
+            return
+        member["roles"].append(role_id)
+        update = dict(member, guild_id=str(guild_id))
+        asyncio.get_running_loop().call_soon(
+            self.state.parse_guild_member_update, update
+        )
+
+    def _remember(self, op: str, data: dict):
+        if op == "READY":
+            self.bot_user = data["user"]
+        elif op == "GUILD_CREATE":
+            for member in data.get("members", []):
+                self.members[int(member["user"]["id"])] = member
+        elif op == "MESSAGE_CREATE":
+            self.messages[int(data["id"])] = data
+
+    async def _resolve(self, data: dict, timeout: float) -> dict:
+        message_id = data.get("message_id")
+        if not isinstance(message_id, str) or not message_id.startswith("reply:"):
+            return data
+        source = int(message_id.split(":", 1)[1])
+        deadline = time.perf_counter() + timeout
+        while source not in self.replies:
+            if time.perf_counter() > deadline:
+                raise TimeoutError("No reply to message {}".format(source))
+            await asyncio.sleep(0.001)
+        return dict(data, message_id=str(self.replies[source]))
+
+    def _filter(self, op: str, data: dict) -> Optional[dict]:
+        """``data`` as Discord would deliver it to this client, or None."""
+        intents = self.state._intents
+        intent = EVENT_INTENTS.get(op)
+        if intent is not None and not getattr(intents, intent):
+            return None
+        if (
+            op == "MESSAGE_CREATE"
+            and not intents.message_content
+            and data["author"]["id"] != self.bot_user.get("id")
+        ):
+            return dict(data, content="", embeds=[], attachments=[])
+        return data
+
+    def _inject(self, index: int, op: str, data: dict):
+        current_event.set(index)
+        self._remember(op, data)
+        getattr(self.state, "parse_" + op.lower())(data)
+
+    async def replay(
+        self,
+        events: Iterator[dict],
+        speed: float = 0.0,
+        reply_timeout: float = 10.0,
+        warm_up: Optional[Callable[[], Awaitable[None]]] = None,
+    ):
+        """Inject each event; ``speed`` 1.0 keeps trace time, 0 goes flat out.
+
+        Events after the guild setup wait for the client to be ready and then
+        for ``warm_up``, which lets a bot finish its own ``on_ready`` work.
+        """
+        start = time.perf_counter()
+        for index, event in enumerate(events):
+            op, data = event["op"], event["d"]
+            if op not in ("READY", "GUILD_CREATE") and self.ready_at is None:
+                await self.client.wait_until_ready()
+                if warm_up is not None:
+                    await warm_up()
+                self.ready_at = time.perf_counter()
+                # Trace time starts once the bot is up.
+                start = self.ready_at - (event.get("t", 0) / speed if speed else 0)
+            if speed and "t" in event:
+                delay = start + event["t"] / speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            data = self._filter(op, data)
+            if data is None:
+                self.filtered[op] = self.filtered.get(op, 0) + 1
+                continue
+            data = await self._resolve(data, reply_timeout)
+            self.injected.append({"op": op, "at": time.perf_counter()})
+            contextvars.copy_context().run(self._inject, index, op, data)
+            if self.started_at is None:
+                self.started_at = self.injected[-1]["at"]
+            # Let the handlers this event scheduled start running.
+            await asyncio.sleep(0)
+
+    async def settle(self, quiet: float = 1.0, timeout: float = 60.0):
+        """Wait until no REST call has been made for ``quiet`` seconds."""
+        deadline = time.perf_counter() + timeout
+        seen = -1
+        while time.perf_counter() < deadline:
+            if len(self.http.calls) == seen:
+                return
+            seen = len(self.http.calls)
+            await asyncio.sleep(quiet)
+
+    def report(self) -> dict:
+        """REST calls per event and event-to-REST/reply latency per event type."""
+        by_event: Dict[Optional[int], List[dict]] = {}
+        for call in self.http.calls:
+            by_event.setdefault(call["event"], []).append(call)
+        ops: Dict[str, dict] = {}
+        for index, event in enumerate(self.injected):
+            stats = ops.setdefault(
+                event["op"],
+                {"count": 0, "rest_calls": 0, "first_rest": [], "reply": []},
+            )
+            calls = by_event.get(index, [])
+            stats["count"] += 1
+            stats["rest_calls"] += len(calls)
+            if calls:
+                stats["first_rest"].append(calls[0]["at"] - event["at"])
+            replies = [
+                call
+                for call in calls
+                if (call["method"], call["route"])
+                == ("POST", "/channels/{channel_id}/messages")
+            ]
+            if replies:
+                stats["reply"].append(replies[0]["at"] - event["at"])
+        for stats in ops.values():
+            stats["rest_calls_per_event"] = stats["rest_calls"] / stats["count"]
+            for key in ("first_rest", "reply"):
+                summary = percentiles(stats.pop(key))
+                stats[key + "_n"] = summary.pop("count")
+                for name, value in summary.items():
+                    stats["{}_{}".format(key, name)] = value
+        routes: Dict[str, int] = {}
+        for call in self.http.calls:
+            key = "{} {}".format(call["method"], call["route"])
+            routes[key] = routes.get(key, 0) + 1
+        startup = None
+        if self.started_at is not None and self.ready_at is not None:
+            startup = self.ready_at - self.started_at
+        return {
+            "startup_s": startup,
+            "events": len(self.injected),
+            "filtered_events": self.filtered,
+            "rest_calls": len(self.http.calls),
+            "background_rest_calls": len(by_event.get(None, [])),
+            "by_event_type": ops,
+            "by_route": routes,
+        }
+
+
+def read_trace(path: str) -> Iterator[dict]:
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def generate_trace(
+    channel_id: int,
+    members: int = 10000,
+    voter_share: float = 0.3,
+    verifies: int = 20,
+    reactions_per_minute: int = 1000,
+    minutes: float = 5.0,
+    unauthorized_share: float = 0.1,
+    remove_share: float = 0.1,
+    presences_per_minute: int = 2000,
+    typing_per_minute: int = 200,
+    voice_per_minute: int = 50,
+    seed: int = 0,
+) -> Iterator[dict]:
+    """A synthetic trace of one vouching guild under reaction load.
+
+    Presence, typing and voice events, which the vouch flow ignores, are
+    mixed in at their own rates.
+    """
+    rng = random.Random(seed)
+    now = datetime.datetime.utcnow()
+    ids = itertools.count(1)
+    guild_id = snowflake(now, next(ids))
+    voice_channel_id = snowflake(now, next(ids))
+    bot_user = user_payload(snowflake(now, next(ids)), "Voting-Bot", bot=True)
+    voter_role, verified_role, trophied_role = (
+        snowflake(now, next(ids)) for _ in range(3)
+    )
+    roles = [
+        role_payload(guild_id, "@everyone", 0),
+        role_payload(voter_role, "Voter", 1),
+        role_payload(verified_role, "Verified", 2),
+        role_payload(trophied_role, "Trophied", 3),
+    ]
+    users = [
+        user_payload(snowflake(now, next(ids)), "member-{}".format(i))
+        for i in range(members)
+    ]
+    member_roles = {}
+    for user in users:
+        role_ids = []
+        if rng.random() < voter_share:
+            role_ids += [voter_role, verified_role]
+        member_roles[user["id"]] = role_ids
+    member_data = {
+        user["id"]: member_payload(user, member_roles[user["id"]]) for user in users
+    }
+    bot_member = member_payload(bot_user, [])
+    voters = [user for user in users if voter_role in member_roles[user["id"]]]
+    others = [user for user in users if voter_role not in member_roles[user["id"]]]
+
+    yield {
+        "t": 0.0,
+        "op": "READY",
+        "d": {
+            "v": 9,
+            "user": bot_user,
+            "guilds": [{"id": str(guild_id), "unavailable": True}],
+            "session_id": "fake",
+        },
+    }
+    yield {
+        "t": 0.0,
+        "op": "GUILD_CREATE",
+        "d": {
+            "id": str(guild_id),
+            "name": "Fake Guild",
+            "owner_id": bot_user["id"],
+            "region": "us-east",
+            "verification_level": 0,
+            "default_message_notifications": 0,
+            "explicit_content_filter": 0,
+            "mfa_level": 0,
+            "features": [],
+            "emojis": [],
+            "roles": roles,
+            "channels": [
+                {
+                    "id": str(channel_id),
+                    "name": "vouching",
+                    "type": 0,
+                    "position": 0,
+                    "permission_overwrites": [],
+                    "nsfw": False,
+                    "topic": None,
+                    "parent_id": None,
+                },
+                {
+                    "id": str(voice_channel_id),
+                    "name": "lounge",
+                    "type": 2,
+                    "position": 1,
+                    "permission_overwrites": [],
+                    "bitrate": 64000,
+                    "user_limit": 0,
+                    "parent_id": None,
+                },
+            ],
+            "members": [bot_member] + list(member_data.values()),
+            "member_count": members + 1,
+            "large": members > 250,
+            "unavailable": False,
+        },
+    }
+
+    duration = minutes * 60
+    # Spread the !verify posts over the first half so votes get reactions.
+    candidates = rng.sample(others, min(verifies, len(others)))
+    verify_times = sorted(rng.uniform(0, duration / 2) for _ in candidates)
+    schedule = [(t, "verify", user) for t, user in zip(verify_times, candidates)]
+    first = verify_times[0] if verify_times else 0.0
+    for _ in range(int(reactions_per_minute * minutes)):
+        schedule.append((rng.uniform(first, duration), "react", None))
+    for kind, per_minute in (
+        ("presence", presences_per_minute),
+        ("typing", typing_per_minute),
+        ("voice", voice_per_minute),
+    ):
+        for _ in range(int(per_minute * minutes)):
+            schedule.append((rng.uniform(0, duration), kind, rng.choice(users)))
+    schedule.sort(key=lambda item: item[0])
+
+    posted: List[str] = []
+    cast: Dict[str, List[dict]] = {}
+    in_voice = set()
+    for t, kind, user in schedule:
+        if kind == "presence":
+            status = rng.choice(["online", "idle", "dnd", "offline"])
+            yield {
+                "t": t,
+                "op": "PRESENCE_UPDATE",
+                "d": {
+                    "user": {"id": user["id"]},
+                    "guild_id": str(guild_id),
+                    "status": status,
+                    "activities": [],
+                    "client_status": {} if status == "offline" else {"desktop": status},
+                },
+            }
+            continue
+        if kind == "typing":
+            yield {
+                "t": t,
+                "op": "TYPING_START",
+                "d": {
+                    "channel_id": str(channel_id),
+                    "guild_id": str(guild_id),
+                    "user_id": user["id"],
+                    "timestamp": int(now.timestamp() + t),
+                    "member": member_data[user["id"]],
+                },
+            }
+            continue
+        if kind == "voice":
+            joined = user["id"] not in in_voice
+            (in_voice.add if joined else in_voice.discard)(user["id"])
+            yield {
+                "t": t,
+                "op": "VOICE_STATE_UPDATE",
+                "d": {
+                    "guild_id": str(guild_id),
+                    "channel_id": str(voice_channel_id) if joined else None,
+                    "user_id": user["id"],
+                    "member": member_data[user["id"]],
+                    "session_id": "fake-{}".format(user["id"]),
+                    "deaf": False,
+                    "mute": False,
+                    "self_deaf": False,
+                    "self_mute": False,
+                    "self_video": False,
+                    "suppress": False,
+                    "request_to_speak_timestamp": None,
+                },
+            }
+            continue
+        if kind == "verify":
+            message_id = snowflake(now + datetime.timedelta(seconds=t), next(ids))
+            posted.append(str(message_id))
+            yield {
+                "t": t,
+                "op": "MESSAGE_CREATE",
+                "d": message_payload(
+                    message_id,
+                    channel_id,
+                    guild_id,
+                    user,
+                    content="!verify",
+                    member=member_data[user["id"]],
+                ),
+            }
+            continue
+        if not posted:
+            continue
+        source = rng.choice(posted)
+        reactions = cast.setdefault(source, [])
+        base = {
+            "channel_id": str(channel_id),
+            "message_id": "reply:{}".format(source),
+            "guild_id": str(guild_id),
+            "emoji": {"id": None, "name": "✅"},
+            "type": 0,
+            "burst": False,
+        }
+        if reactions and rng.random() < remove_share:
+            reactor = reactions.pop(rng.randrange(len(reactions)))
+            yield {
+                "t": t,
+                "op": "MESSAGE_REACTION_REMOVE",
+                "d": dict(base, user_id=reactor["id"]),
+            }
+            continue
+        pool = others if rng.random() < unauthorized_share else voters
+        reactor = rng.choice(pool)
+        reactions.append(reactor)
+        yield {
+            "t": t,
+            "op": "MESSAGE_REACTION_ADD",
+            "d": dict(
+                base, user_id=reactor["id"], member=member_data[reactor["id"]]
+            ),
+        }
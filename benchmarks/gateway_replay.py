@@ -0,0 +1,152 @@
+"""Replay gateway traces through ``bot.bot`` with no network.
+
+``generate`` writes a synthetic trace of a vouching guild under reaction
+load; ``replay`` runs the real bot against it with the embedded backend on a
+temporary SQLite database, then reports REST calls per event and
+event-to-reply latency::
+
+    python -m benchmarks.gateway_replay generate --members 10000 \\
+        --reactions-per-minute 1000 --minutes 5 --out trace.jsonl
+    python -m benchmarks.gateway_replay replay trace.jsonl --speed 0 \\
+        --out replay.json
+
+Compare gateway profiles by replaying the same trace with
+``GATEWAY_PROFILE=full`` and ``GATEWAY_PROFILE=lean``; the report includes
+the startup time and peak RSS.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import resource
+import sys
+import tempfile
+
+# bot.bot's hard-coded vouching channel.
+DEFAULT_CHANNEL_ID = 984295827868631060
+
+
+def generate(args):
+    from .fake_discord import generate_trace
+
+    events = generate_trace(
+        channel_id=args.channel_id,
+        members=args.members,
+        voter_share=args.voter_share,
+        verifies=args.verifies,
+        reactions_per_minute=args.reactions_per_minute,
+        minutes=args.minutes,
+        unauthorized_share=args.unauthorized_share,
+        remove_share=args.remove_share,
+        presences_per_minute=args.presences_per_minute,
+        typing_per_minute=args.typing_per_minute,
+        voice_per_minute=args.voice_per_minute,
+        seed=args.seed,
+    )
+    out = open(args.out, "w") if args.out else sys.stdout
+    try:
+        for event in events:
+            out.write(json.dumps(event, ensure_ascii=False))
+            out.write("\n")
+    finally:
+        if args.out:
+            out.close()
+
+
+def replay(args):
+    tmpdir = tempfile.TemporaryDirectory()
+    # Both are read when bot.bot and bot.db are imported.
+    os.environ["BACKEND_MODE"] = "embedded"
+    os.environ.setdefault(
+        "DATABASE_URL",
+        "sqlite+aiosqlite:///{}".format(os.path.join(tmpdir.name, "replay.db")),
+    )
+    from bot import bot, tracing
+
+    from .fake_discord import FakeGateway, read_trace
+
+    client = bot.client
+
+    async def warm_up():
+        # on_ready starts the sweep loop last.
+        while not bot.sweep_outstanding_votes.is_running():
+            await asyncio.sleep(0.01)
+
+    async def run():
+        # Sets up the client's loop-bound state without logging in.
+        async with client:
+            gateway = FakeGateway(client, latency=args.latency)
+            await gateway.replay(
+                read_trace(args.trace), speed=args.speed, warm_up=warm_up
+            )
+            await gateway.settle(quiet=args.settle)
+            report = gateway.report()
+            report["outbox"] = client.outbox.stats()
+            report["vote_cache"] = client.vote_cache.stats()
+            report["handlers"] = tracing.tracer.summary()
+            bot.sweep_outstanding_votes.cancel()
+        return report
+
+    try:
+        report = asyncio.run(run())
+    finally:
+        tmpdir.cleanup()
+    report["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    report["gateway_profile"] = client.settings.gateway_profile
+    report["config"] = {k: v for k, v in vars(args).items() if k != "func"}
+    report["timestamp"] = datetime.datetime.utcnow().isoformat()
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    print(text)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    gen = commands.add_parser("generate", help="write a synthetic trace")
+    gen.add_argument("--channel-id", type=int, default=DEFAULT_CHANNEL_ID)
+    gen.add_argument("--members", type=int, default=10000)
+    gen.add_argument("--voter-share", type=float, default=0.3)
+    gen.add_argument("--verifies", type=int, default=20)
+    gen.add_argument("--reactions-per-minute", type=int, default=1000)
+    gen.add_argument("--minutes", type=float, default=5.0)
+    gen.add_argument("--unauthorized-share", type=float, default=0.1)
+    gen.add_argument("--remove-share", type=float, default=0.1)
+    gen.add_argument("--presences-per-minute", type=int, default=2000)
+    gen.add_argument("--typing-per-minute", type=int, default=200)
+    gen.add_argument("--voice-per-minute", type=int, default=50)
+    gen.add_argument("--seed", type=int, default=0)
+    gen.add_argument("--out", help="trace file, default stdout")
+    gen.set_defaults(func=generate)
+
+    rep = commands.add_parser("replay", help="replay a trace through bot.bot")
+    rep.add_argument("trace")
+    rep.add_argument(
+        "--speed",
+        type=float,
+        default=0.0,
+        help="1.0 keeps the trace's timing, 0 injects events as fast as possible",
+    )
+    rep.add_argument(
+        "--latency", type=float, default=0.0, help="seconds per fake REST call"
+    )
+    rep.add_argument(
+        "--settle",
+        type=float,
+        default=2.0,
+        help="stop after this many seconds without a REST call",
+    )
+    rep.add_argument("--out", help="write the report to this JSON file")
+    rep.set_defaults(func=replay)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""Time ``bot.main``'s proposal result tally against synthetic reactions.
+
+Builds a guild of members with random roles and a proposal whose two
+reactions come from ``--reactors`` users, served page by page like
+``Reaction.users()`` with ``--page-latency`` seconds per page. Then it
+tallies per-role votes the way ``sendToChannel`` used to (each reaction's
+users flattened one after the other, roles rebuilt per user) and the way it
+does now (both streams concurrently, role counts from the role index), and
+reports wall time and peak traced memory of each::
+
+    python -m benchmarks.proposal_tally --reactors 10000 --out tally.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import random
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from bot.reactions import reacting_user_ids, weighted_tally
+from bot.roles import GuildRoleIndex
+
+POSITIVE = "👍"
+NEGATIVE = "👎"
+# Reaction.users() pages of at most 100 users.
+PAGE_SIZE = 100
+
+
+class ReactionUsers:
+    """``Reaction.users()``: an async iterator over pages, with ``flatten``."""
+
+    def __init__(self, users: list, page_latency: float):
+        self.users = users
+        self.page_latency = page_latency
+
+    async def _pages(self):
+        for start in range(0, len(self.users), PAGE_SIZE):
+            await asyncio.sleep(self.page_latency)
+            for user in self.users[start : start + PAGE_SIZE]:
+                yield user
+
+    def __aiter__(self):
+        return self._pages()
+
+    async def flatten(self) -> list:
+        return [user async for user in self._pages()]
+
+
+class Reaction:
+    def __init__(self, emoji: str, users: list, page_latency: float):
+        self.emoji = emoji
+        self._users = users
+        self.page_latency = page_latency
+
+    def users(self) -> ReactionUsers:
+        return ReactionUsers(self._users, self.page_latency)
+
+
+def build(args):
+    rng = random.Random(args.seed)
+    roles = [
+        SimpleNamespace(id=1000 + i, name="role-{}".format(i), is_default=lambda: False)
+        for i in range(args.roles)
+    ]
+    members = [
+        SimpleNamespace(
+            id=10 ** 17 + i,
+            roles=[role for role in roles if rng.random() < args.role_share],
+        )
+        for i in range(args.members)
+    ]
+    guild = SimpleNamespace(id=1, roles=roles, members=members)
+    reactors = rng.sample(members, min(args.reactors, len(members)))
+    split = int(len(reactors) * (1 - args.negative_share))
+    message = SimpleNamespace(
+        reactions=[
+            Reaction(POSITIVE, reactors[:split], args.page_latency),
+            Reaction(NEGATIVE, reactors[split:], args.page_latency),
+        ]
+    )
+    role_ids = [role.id for role in roles]
+    weights: Optional[Dict[str, float]] = None
+    if args.weights:
+        weights = {str(role_id): rng.choice([0.5, 1, 2, 3]) for role_id in role_ids}
+    return guild, message, role_ids, weights
+
+
+async def flattened_tally(message, role_ids: List[int]) -> dict:
+    """The tally loop ``sendToChannel`` ran before the role index."""
+    positive = [0 for _ in role_ids]
+    negative = [0 for _ in role_ids]
+    for reaction in message.reactions:
+        if str(reaction.emoji) == POSITIVE:
+            for user in await reaction.users().flatten():
+                user_roles = [role.id for role in user.roles]
+                for i in range(len(role_ids)):
+                    if role_ids[i] in user_roles:
+                        positive[i] += 1
+        if str(reaction.emoji) == NEGATIVE:
+            for user in await reaction.users().flatten():
+                user_roles = [role.id for role in user.roles]
+                for i in range(len(role_ids)):
+                    if role_ids[i] in user_roles:
+                        negative[i] += 1
+    return {"positive": positive, "negative": negative}
+
+
+async def indexed_tally(
+    message, role_ids: List[int], index: GuildRoleIndex, weights
+) -> dict:
+    """The tally ``sendToChannel`` runs now."""
+    positive_voters, negative_voters = await asyncio.gather(
+        reacting_user_ids(message, POSITIVE), reacting_user_ids(message, NEGATIVE)
+    )
+    tally = {
+        "positive": [
+            len(positive_voters & index.members_with(role_id)) for role_id in role_ids
+        ],
+        "negative": [
+            len(negative_voters & index.members_with(role_id)) for role_id in role_ids
+        ],
+    }
+    if weights:
+        tally["weighted_positive"] = weighted_tally(
+            positive_voters, role_ids, weights, index
+        )
+        tally["weighted_negative"] = weighted_tally(
+            negative_voters, role_ids, weights, index
+        )
+    return tally
+
+
+def measure(coro) -> dict:
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        tally = asyncio.run(coro)
+        wall = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"wall_ms": 1000 * wall, "peak_kb": peak / 1024, "tally": tally}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--members", type=int, default=20000)
+    parser.add_argument("--reactors", type=int, default=10000)
+    parser.add_argument("--negative-share", type=float, default=0.4)
+    parser.add_argument("--roles", type=int, default=5)
+    parser.add_argument(
+        "--role-share", type=float, default=0.3, help="chance a member has each role"
+    )
+    parser.add_argument(
+        "--page-latency", type=float, default=0.05, help="seconds per page of users"
+    )
+    parser.add_argument(
+        "--weights", action="store_true", help="also tally random per-role weights"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    guild, message, role_ids, weights = build(args)
+    start = time.perf_counter()
+    index = GuildRoleIndex(guild)
+    index_ms = 1000 * (time.perf_counter() - start)
+
+    results = {
+        "flattened": measure(flattened_tally(message, role_ids)),
+        "indexed": measure(indexed_tally(message, role_ids, index, weights)),
+    }
+    flattened, indexed = results["flattened"]["tally"], results["indexed"]["tally"]
+    if any(flattened[key] != indexed[key] for key in ("positive", "negative")):
+        raise RuntimeError("The two tallies disagree")
+    for name, result in results.items():
+        print(
+            "{:<10}{:>10.1f} ms{:>10.0f} KiB peak".format(
+                name, result["wall_ms"], result["peak_kb"]
+            )
+        )
+    print("role index built once in {:.1f} ms".format(index_ms))
+
+    if args.out:
+        config = {k: v for k, v in vars(args).items() if k != "out"}
+        with open(args.out, "w") as f:
+            json.dump(
+                {
+                    "config": config,
+                    "timestamp": datetime.datetime.utcnow().isoformat(),
+                    "index_build_ms": index_ms,
+                    "runs": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""In-process load test for the vouch API in ``bot.server``.
+
+Seeds a temporary SQLite database, then replays a weighted mix of requests
+through the ASGI app at each concurrency level and table size, and reports
+throughput and latency percentiles per route. Results are saved as JSON so
+runs can be compared::
+
+    python -m benchmarks.server_load --votes 1000 10000 --concurrency 1 8 32 \\
+        --requests 5000 --out results.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+from bot.tracing import percentiles
+
+DEFAULT_MIX = {
+    "get_vote": 60,
+    "add_vouch": 20,
+    "delete_vouch": 10,
+    "add_member": 8,
+    "sweep": 2,
+    "vouch_batch": 0,
+}
+
+
+def summarize(
+    latencies: Dict[str, List[float]], errors: Dict[str, int], wall: float
+) -> dict:
+    routes = {}
+    for route, samples in latencies.items():
+        if not samples:
+            continue
+        routes[route] = {
+            "errors": errors.get(route, 0),
+            "rps": len(samples) / wall if wall else 0.0,
+            "mean_ms": 1000 * sum(samples) / len(samples),
+            **percentiles(samples),
+        }
+    return routes
+
+
+def parse_mix(text: str) -> Dict[str, int]:
+    mix = dict.fromkeys(DEFAULT_MIX, 0)
+    for part in text.split(","):
+        route, weight = part.split("=")
+        if route not in mix:
+            raise ValueError("Unknown route in mix: {}".format(route))
+        mix[route] = int(weight)
+    return mix
+
+
+class Workload:
+    """Generates requests against the seeded ids and tracks what it added."""
+
+    def __init__(
+        self, rng: random.Random, vote_ids: List[str], member_ids: List[str]
+    ):
+        self.rng = rng
+        self.vote_ids = vote_ids
+        self.member_ids = member_ids
+        self.vouches: List[Tuple[str, str]] = []
+        self.counter = 0
+
+    def _new_id(self) -> str:
+        self.counter += 1
+        return "bench-{}".format(self.counter)
+
+    def _vouch(self) -> dict:
+        return {
+            "vote_id": self.rng.choice(self.vote_ids),
+            "voucher_id": self._new_id(),
+        }
+
+    def request(self, route: str, batch_size: int) -> Tuple[str, str, dict]:
+        if route == "get_vote":
+            return "GET", "/votes/{}".format(self.rng.choice(self.vote_ids)), None
+        if route == "add_vouch":
+            vouch = self._vouch()
+            self.vouches.append((vouch["vote_id"], vouch["voucher_id"]))
+            return "POST", "/vouch-event", vouch
+        if route == "delete_vouch":
+            if self.vouches:
+                vote_id, voucher_id = self.vouches.pop(
+                    self.rng.randrange(len(self.vouches))
+                )
+                vouch = {"vote_id": vote_id, "voucher_id": voucher_id}
+            else:
+                vouch = self._vouch()
+            return "POST", "/vouch-event/delete", vouch
+        if route == "add_member":
+            # Mostly members that already exist, as the bot sends them.
+            if self.rng.random() < 0.9:
+                discord_id = self.rng.choice(self.member_ids)
+            else:
+                discord_id = self._new_id()
+            member = {"discord_id": discord_id, "discord_name": discord_id}
+            return "POST", "/members", member
+        if route == "sweep":
+            return "GET", "/outstanding-votes", None
+        if route == "vouch_batch":
+            events = []
+            for _ in range(batch_size):
+                vouch = self._vouch()
+                self.vouches.append((vouch["vote_id"], vouch["voucher_id"]))
+                events.append(dict(vouch, action="add"))
+            return "POST", "/vouch-events/batch", {"events": events}
+        raise ValueError("Unknown route: {}".format(route))
+
+
+async def seed(
+    rng: random.Random, n_members: int, n_votes: int, vouches_per_vote: int
+) -> Tuple[List[str], List[str]]:
+    from sqlalchemy import insert
+
+    from bot import db
+
+    async with db.engine.begin() as conn:
+        await conn.run_sync(db.Base.metadata.drop_all)
+        await conn.run_sync(db.Base.metadata.create_all)
+
+    now = datetime.datetime.utcnow()
+    member_ids = [str(10 ** 17 + i) for i in range(n_members)]
+    members = [
+        {
+            "discord_id": discord_id,
+            "discord_name": "member-{}".format(i),
+            "is_vouched_for": rng.random() < 0.5,
+            "is_voter": rng.random() < 0.3,
+        }
+        for i, discord_id in enumerate(member_ids)
+    ]
+    votes = []
+    vouches = []
+    for i in range(n_votes):
+        message_id = str(9 * 10 ** 17 + i)
+        # About a tenth of the votes have run out, so sweeps have work.
+        start_time = now - datetime.timedelta(days=rng.uniform(0, 7.7))
+        voters = rng.sample(member_ids, min(vouches_per_vote, len(member_ids)))
+        votes.append(
+            {
+                "message_id": message_id,
+                "on_behalf_of_id": rng.choice(member_ids),
+                "start_time": start_time,
+                "end_time": start_time + datetime.timedelta(days=7),
+                "vouches_required": rng.randint(3, 30),
+                "votes": len(voters),
+                "complete": False,
+            }
+        )
+        vouches.extend(
+            {"vote_id": message_id, "voucher_id": voter} for voter in voters
+        )
+    async with db.SessionLocal() as session:
+        for model, rows in (
+            (db.Member, members),
+            (db.Vote, votes),
+            (db.Vouch, vouches),
+        ):
+            if rows:
+                await session.execute(insert(model), rows)
+        await session.commit()
+    return [vote["message_id"] for vote in votes], member_ids
+
+
+async def run_level(
+    client,
+    workload: Workload,
+    mix: Dict[str, int],
+    n_requests: int,
+    concurrency: int,
+    batch_size: int,
+) -> dict:
+    routes = [route for route, weight in mix.items() if weight > 0]
+    weights = [mix[route] for route in routes]
+    plan = workload.rng.choices(routes, weights=weights, k=n_requests)
+    latencies: Dict[str, List[float]] = {route: [] for route in routes}
+    errors: Dict[str, int] = {}
+    queue = iter(plan)
+
+    async def worker():
+        for route in queue:
+            method, path, body = workload.request(route, batch_size)
+            start = time.perf_counter()
+            resp = await client.request(method, path, json=body)
+            latencies[route].append(time.perf_counter() - start)
+            # 400s are expected answers, e.g. for members that already exist.
+            if resp.status_code >= 500:
+                errors[route] = errors.get(route, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests": n_requests,
+        "wall_s": wall,
+        "rps": n_requests / wall if wall else 0.0,
+        "routes": summarize(latencies, errors, wall),
+    }
+
+
+def print_run(run: dict):
+    print("votes={votes} concurrency={concurrency}: {rps:.0f} req/s".format(**run))
+    print(
+        "  {:<14}{:>8}{:>8}{:>10}{:>10}{:>10}{:>10}".format(
+            "route", "count", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"
+        )
+    )
+    for route, stats in sorted(run["routes"].items()):
+        print(
+            "  {:<14}{count:>8}{errors:>8}{rps:>10.1f}"
+            "{p50_ms:>10.2f}{p95_ms:>10.2f}{p99_ms:>10.2f}".format(route, **stats)
+        )
+
+
+async def main_async(args):
+    import httpx
+
+    from bot import db
+    from bot.server import app
+
+    rng = random.Random(args.seed)
+    runs = []
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    client = httpx.AsyncClient(transport=transport, base_url="http://bench")
+    async with client:
+        for n_votes in args.votes:
+            for concurrency in args.concurrency:
+                # Every run starts from the same freshly seeded tables.
+                vote_ids, member_ids = await seed(
+                    rng, args.members, n_votes, args.vouches_per_vote
+                )
+                workload = Workload(rng, vote_ids, member_ids)
+                run = await run_level(
+                    client,
+                    workload,
+                    args.mix,
+                    args.requests,
+                    concurrency,
+                    args.batch_size,
+                )
+                run["votes"] = n_votes
+                runs.append(run)
+                print_run(run)
+    # aiosqlite's worker threads keep the process alive until disposed.
+    await db.engine.dispose()
+    return runs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--members", type=int, default=2000)
+    parser.add_argument("--votes", type=int, nargs="+", default=[1000])
+    parser.add_argument("--vouches-per-vote", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=DEFAULT_MIX,
+        help="route=weight pairs, e.g. get_vote=60,add_vouch=40,vouch_batch=5",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=20, help="events per vouch_batch request"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db", help="SQLite file to use instead of a temporary one")
+    parser.add_argument("--out", help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    tmpdir = None
+    path = args.db
+    if path is None:
+        tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmpdir.name, "bench.db")
+    # bot.db reads the URL at import time.
+    os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///{}".format(path)
+    try:
+        runs = asyncio.run(main_async(args))
+    finally:
+        if tmpdir is not None:
+            tmpdir.cleanup()
+
+    if args.out:
+        config = {k: v for k, v in vars(args).items() if k != "out"}
+        results = {
+            "benchmark": "server_load",
+            "timestamp": datetime.datetime.utcnow().isoformat(),
+            "python": sys.version.split()[0],
+            "config": config,
+            "runs": runs,
+        }
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
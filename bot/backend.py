@@ -0,0 +1,386 @@
+import abc
+import asyncio
+import contextlib
+from collections import OrderedDict
+from typing import List, Optional, Tuple, Type, TypeVar
+
+import aiohttp
+from pydantic import BaseModel
+
+from . import db
+from .tracing import tracer
+from .schemas import (
+    BotSettings,
+    Member,
+    MemberBase,
+    MembersBulk,
+    Status,
+    Vote,
+    VoteBase,
+    VotesResponse,
+    VouchEvent,
+    VouchEventAction,
+    VouchEventBase,
+    VouchEventBatch,
+    VouchEventBatchResult,
+    VouchEventResult,
+)
+
+Model = TypeVar("Model", bound=BaseModel)
+
+
+class Backend(abc.ABC):
+    """The vouch operations the bot needs, independent of where they run."""
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abc.abstractmethod
+    async def status(self) -> Status:
+        ...
+
+    @abc.abstractmethod
+    async def add_member(self, member: MemberBase) -> Optional[Member]:
+        ...
+
+    @abc.abstractmethod
+    async def get_member(self, discord_id: str) -> Optional[Member]:
+        ...
+
+    @abc.abstractmethod
+    async def upsert_member(self, member: MemberBase):
+        ...
+
+    @abc.abstractmethod
+    async def upsert_members(self, members: List[MemberBase]):
+        ...
+
+    @abc.abstractmethod
+    async def get_vote(self, message_id: str) -> Optional[Vote]:
+        ...
+
+    @abc.abstractmethod
+    async def get_existing_vote(self, discord_id: str) -> Optional[Vote]:
+        ...
+
+    @abc.abstractmethod
+    async def add_vote(self, vote: VoteBase) -> Vote:
+        ...
+
+    @abc.abstractmethod
+    async def add_vouch_event(self, vouch: VouchEventBase) -> VouchEvent:
+        ...
+
+    @abc.abstractmethod
+    async def remove_vouch_event(self, vouch: VouchEventBase) -> bool:
+        ...
+
+    @abc.abstractmethod
+    async def apply_vouch_events(
+        self, events: List[VouchEventAction]
+    ) -> VouchEventBatchResult:
+        ...
+
+    @abc.abstractmethod
+    async def get_outstanding_votes(self) -> List[Vote]:
+        ...
+
+
+class HTTPBackend(Backend):
+    """A long-lived client for the vouch API in ``bot.server``.
+
+    One pooled ``aiohttp.ClientSession`` is shared by every call so reactions
+    reuse keep-alive connections instead of opening a socket each. Reads that
+    return an ETag are cached and revalidated with ``If-None-Match``, so an
+    unchanged resource costs a 304 instead of a body to parse.
+    """
+
+    def __init__(self, settings: BotSettings):
+        self.base_url = settings.backend_url.rstrip("/")
+        self.connection_limit = settings.backend_connection_limit
+        self.keepalive_timeout = settings.backend_keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=settings.backend_timeout)
+        self.etag_cache_size = settings.backend_etag_cache_size
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._etags: "OrderedDict[str, Tuple[str, BaseModel]]" = OrderedDict()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers={"Content-Type": "application/json"},
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    @contextlib.asynccontextmanager
+    async def _request(
+        self, method: str, path: str, timeout: Optional[float] = None, **kwargs
+    ):
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+        with tracer.span("backend {}".format(method), path=path) as span:
+            async with self.session.request(
+                method, "{}{}".format(self.base_url, path), **kwargs
+            ) as resp:
+                span.set("status", resp.status)
+                yield resp
+
+    async def _get_cached(
+        self, path: str, model: Type[Model], timeout: Optional[float] = None
+    ) -> Optional[Model]:
+        """GET ``path`` as ``model``, or None if the API says it does not exist.
+
+        Other error statuses raise ``aiohttp.ClientResponseError``, so callers
+        never mistake a failing server for a missing resource.
+        """
+        cached = self._etags.get(path)
+        headers = {"If-None-Match": cached[0]} if cached else {}
+        async with self._request(
+            "GET", path, timeout=timeout, headers=headers
+        ) as resp:
+            if resp.status == 304 and cached is not None:
+                self._etags.move_to_end(path)
+                return cached[1]
+            if resp.status != 200:
+                self._etags.pop(path, None)
+                # The API answers 400 (or 404) for unknown ids.
+                if resp.status in (400, 404):
+                    return None
+                resp.raise_for_status()
+            result = model(**await resp.json())
+            tag = resp.headers.get("ETag")
+        if tag is None:
+            self._etags.pop(path, None)
+        else:
+            self._etags[path] = (tag, result)
+            self._etags.move_to_end(path)
+            while len(self._etags) > self.etag_cache_size:
+                self._etags.popitem(last=False)
+        return result
+
+    async def status(self, timeout: Optional[float] = None) -> Status:
+        async with self._request("GET", "/status", timeout=timeout) as resp:
+            return Status(**await resp.json())
+
+    async def add_member(
+        self, member: MemberBase, timeout: Optional[float] = None
+    ) -> Optional[Member]:
+        async with self._request(
+            "POST", "/members", data=member.json(), timeout=timeout
+        ) as resp:
+            if resp.status != 200:
+                return None
+            return Member(**await resp.json())
+
+    async def upsert_member(
+        self, member: MemberBase, timeout: Optional[float] = None
+    ):
+        async with self._request(
+            "PUT", "/members", data=member.json(), timeout=timeout
+        ) as resp:
+            resp.raise_for_status()
+
+    async def upsert_members(
+        self, members: List[MemberBase], timeout: Optional[float] = None
+    ):
+        bulk = MembersBulk(members=members)
+        async with self._request(
+            "POST", "/members/bulk", data=bulk.json(), timeout=timeout
+        ) as resp:
+            resp.raise_for_status()
+
+    async def get_member(
+        self, discord_id: str, timeout: Optional[float] = None
+    ) -> Optional[Member]:
+        return await self._get_cached(
+            "/members/{}".format(discord_id), Member, timeout=timeout
+        )
+
+    async def get_vote(
+        self, message_id: str, timeout: Optional[float] = None
+    ) -> Optional[Vote]:
+        return await self._get_cached(
+            "/votes/{}".format(message_id), Vote, timeout=timeout
+        )
+
+    async def get_existing_vote(
+        self, discord_id: str, timeout: Optional[float] = None
+    ) -> Optional[Vote]:
+        return await self._get_cached(
+            "/existing-votes/{}".format(discord_id), Vote, timeout=timeout
+        )
+
+    async def add_vote(self, vote: VoteBase, timeout: Optional[float] = None) -> Vote:
+        async with self._request(
+            "POST", "/votes", data=vote.json(), timeout=timeout
+        ) as resp:
+            resp.raise_for_status()
+            return Vote(**await resp.json())
+
+    async def add_vouch_event(
+        self, vouch: VouchEventBase, timeout: Optional[float] = None
+    ) -> VouchEvent:
+        async with self._request(
+            "POST", "/vouch-event", data=vouch.json(), timeout=timeout
+        ) as resp:
+            resp.raise_for_status()
+            return VouchEvent(**await resp.json())
+
+    async def remove_vouch_event(
+        self, vouch: VouchEventBase, timeout: Optional[float] = None
+    ) -> bool:
+        async with self._request(
+            "POST", "/vouch-event/delete", data=vouch.json(), timeout=timeout
+        ) as resp:
+            if resp.status != 200:
+                return False
+            return Status(**await resp.json()).alive
+
+    async def apply_vouch_events(
+        self, events: List[VouchEventAction], timeout: Optional[float] = None
+    ) -> VouchEventBatchResult:
+        batch = VouchEventBatch(events=events)
+        async with self._request(
+            "POST", "/vouch-events/batch", data=batch.json(), timeout=timeout
+        ) as resp:
+            resp.raise_for_status()
+            return VouchEventBatchResult(**await resp.json())
+
+    async def get_outstanding_votes(
+        self, timeout: Optional[float] = None
+    ) -> List[Vote]:
+        async with self._request(
+            "GET", "/outstanding-votes", timeout=timeout
+        ) as resp:
+            resp.raise_for_status()
+            return VotesResponse(**await resp.json()).votes
+
+
+class EmbeddedBackend(Backend):
+    """Runs the ``bot.server`` operations against ``bot.db`` in-process.
+
+    Skips the loopback HTTP hop for single-process deployments. The FastAPI
+    app can optionally be served from the same event loop.
+    """
+
+    def __init__(self, settings: BotSettings):
+        self.serve_http = settings.backend_serve_http
+        self.http_host = settings.backend_http_host
+        self.http_port = settings.backend_http_port
+        self._server = None
+        self._server_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await db.init_db()
+        if self.serve_http and self._server_task is None:
+            self._server_task = asyncio.ensure_future(self._serve())
+
+    async def close(self):
+        if self._server is not None:
+            self._server.should_exit = True
+        if self._server_task is not None:
+            await self._server_task
+            self._server_task = None
+        await db.engine.dispose()
+
+    async def _serve(self):
+        import uvicorn
+
+        from .server import app
+
+        class _Server(uvicorn.Server):
+            # The bot owns the process signals. uvicorn >= 0.29 takes them
+            # in capture_signals, older releases in install_signal_handlers.
+            def capture_signals(self):
+                return contextlib.nullcontext()
+
+            def install_signal_handlers(self):
+                pass
+
+        config = uvicorn.Config(app, host=self.http_host, port=self.http_port)
+        self._server = _Server(config)
+        await self._server.serve()
+
+    async def status(self) -> Status:
+        return Status()
+
+    async def add_member(self, member: MemberBase) -> Optional[Member]:
+        async with db.SessionLocal() as session:
+            if await db.get_member_by_id(session, member.discord_id):
+                return None
+            return Member.from_orm(await db.create_member(session, member))
+
+    async def get_member(self, discord_id: str) -> Optional[Member]:
+        async with db.SessionLocal() as session:
+            db_member = await db.get_member_by_id(session, discord_id)
+            return None if db_member is None else Member.from_orm(db_member)
+
+    async def upsert_member(self, member: MemberBase):
+        await self.upsert_members([member])
+
+    async def upsert_members(self, members: List[MemberBase]):
+        async with db.SessionLocal() as session:
+            await db.upsert_members(session, members)
+
+    async def get_vote(self, message_id: str) -> Optional[Vote]:
+        async with db.SessionLocal() as session:
+            db_vote = await db.get_vote_by_id(session, message_id)
+            return None if db_vote is None else Vote.from_orm(db_vote)
+
+    async def get_existing_vote(self, discord_id: str) -> Optional[Vote]:
+        async with db.SessionLocal() as session:
+            db_vote = await db.get_existing_vote_by_discord_id(session, discord_id)
+            return None if db_vote is None else Vote.from_orm(db_vote)
+
+    async def add_vote(self, vote: VoteBase) -> Vote:
+        async with db.SessionLocal() as session:
+            return Vote.from_orm(await db.create_vote(session, vote))
+
+    async def add_vouch_event(self, vouch: VouchEventBase) -> VouchEvent:
+        async with db.SessionLocal() as session:
+            db_vouch = await db.cast_vouch(session, vouch)
+            if db_vouch is None:
+                raise ValueError(
+                    "No vote found for message '{}'".format(vouch.vote_id)
+                )
+            return VouchEvent.from_orm(db_vouch)
+
+    async def remove_vouch_event(self, vouch: VouchEventBase) -> bool:
+        async with db.SessionLocal() as session:
+            return await db.delete_vouch_event(session, vouch)
+
+    async def apply_vouch_events(
+        self, events: List[VouchEventAction]
+    ) -> VouchEventBatchResult:
+        async with db.SessionLocal() as session:
+            results, votes = await db.apply_vouch_events(session, events)
+            return VouchEventBatchResult(
+                events=[VouchEventResult(**result) for result in results],
+                votes=[VoteBase.from_orm(vote) for vote in votes],
+            )
+
+    async def get_outstanding_votes(self) -> List[Vote]:
+        async with db.SessionLocal() as session:
+            return [Vote.from_orm(vote) for vote in await db.sweep_votes(session)]
+
+
+def create_backend(settings: BotSettings) -> Backend:
+    if settings.backend_mode == "embedded":
+        return EmbeddedBackend(settings)
+    if settings.backend_mode == "http":
+        return HTTPBackend(settings)
+    raise ValueError("Unknown backend mode: {}".format(settings.backend_mode))
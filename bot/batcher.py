@@ -0,0 +1,90 @@
+import asyncio
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+
+from .schemas import (
+    VoteBase,
+    VouchEventAction,
+    VouchEventBatchResult,
+    VouchEventResult,
+)
+
+SendBatch = Callable[[List[VouchEventAction]], Awaitable[VouchEventBatchResult]]
+
+
+class VouchBatcher:
+    """Collects vouch events for ``window`` seconds and sends them as one batch.
+
+    ``submit`` resolves once the batch holding the event has been applied,
+    with the event's result and the vote's state after the batch. A batch is
+    sent early once it reaches ``max_size`` events. ``close`` sends what is
+    queued and waits for every batch still in flight.
+    """
+
+    def __init__(self, send: SendBatch, window: float = 0.25, max_size: int = 100):
+        self.send = send
+        self.window = window
+        self.max_size = max_size
+        self._events: List[VouchEventAction] = []
+        self._futures: List[asyncio.Future] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._sending: Set[asyncio.Future] = set()
+
+    def __len__(self):
+        return len(self._events)
+
+    async def submit(
+        self, event: VouchEventAction
+    ) -> Tuple[VouchEventResult, Optional[VoteBase]]:
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._events.append(event)
+        self._futures.append(future)
+        if len(self._events) >= self.max_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self.flush)
+        return await future
+
+    def flush(self) -> Optional[asyncio.Future]:
+        """Send the queued events; returns the send, None if nothing was queued."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._events:
+            return None
+        events, self._events = self._events, []
+        futures, self._futures = self._futures, []
+        sending = asyncio.ensure_future(self._send(events, futures))
+        self._sending.add(sending)
+        sending.add_done_callback(self._sending.discard)
+        return sending
+
+    async def close(self):
+        self.flush()
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+
+    async def _send(
+        self, events: List[VouchEventAction], futures: List[asyncio.Future]
+    ):
+        try:
+            batch = await self.send(events)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        votes = {vote.message_id: vote for vote in batch.votes}
+        for future, result in zip(futures, batch.events):
+            if not future.done():
+                future.set_result((result, votes.get(result.vote_id)))
+        # A short response must not leave the rest waiting forever.
+        for future in futures[len(batch.events) :]:
+            if not future.done():
+                future.set_exception(
+                    RuntimeError(
+                        "Batch of {} events answered with {} results".format(
+                            len(events), len(batch.events)
+                        )
+                    )
+                )
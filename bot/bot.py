@@ -1,25 +1,69 @@
 import datetime
+import functools
 import os
-from typing import List
+from typing import List, Optional
 
-import aiohttp
 import discord
 from discord.ext import commands, tasks
 from discord.ext.commands import Context
 from dotenv import load_dotenv
 
+from . import profiling, tracing
+from .backend import Backend, create_backend
+from .batcher import VouchBatcher
+from .cache import MemberSyncCache, VoteCache
+from .gateway import client_options
+from .outbox import REACTION_REMOVAL, REPLY, ROLE_GRANT, Outbox
+from .reactions import partial_message, resolve_member
+from .roles import RoleIndex
 from .schemas import (
-    Status,
+    BotSettings,
     MemberBase,
     VoteBase,
     Vote,
-    VouchEventBase,
-    VouchEvent,
-    VotesResponse,
+    VouchEventAction,
 )
+from .tracing import tracer
 
-intents = discord.Intents.all()
-client = commands.Bot(command_prefix="!", intents=intents)
+
+class VouchBot(commands.Bot):
+    def __init__(self, *args, settings: BotSettings, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.settings = settings
+        self.backend: Optional[Backend] = None
+        self.vote_cache = VoteCache(
+            max_size=settings.vote_cache_size,
+            negative_ttl=settings.vote_cache_negative_ttl,
+        )
+        self.synced_members = MemberSyncCache()
+        self.role_index = RoleIndex()
+        self.role_index.attach(self)
+        self.outbox = Outbox(
+            concurrency=settings.outbox_concurrency,
+            coalesce_window=settings.outbox_coalesce_window,
+        )
+        self.vouch_batcher = VouchBatcher(
+            lambda events: self.backend.apply_vouch_events(events),
+            window=settings.vouch_batch_window,
+            max_size=settings.vouch_batch_max_size,
+        )
+
+    async def close(self):
+        # Queued vouches still need the backend.
+        await self.vouch_batcher.close()
+        await self.outbox.close(self.settings.outbox_close_timeout)
+        if self.backend is not None:
+            await self.backend.close()
+            self.backend = None
+        tracer.close()
+        await super().close()
+
+
+settings = BotSettings()
+client = VouchBot(command_prefix="!", settings=settings, **client_options(settings))
+tracing.configure(settings, "bot")
+tracing.instrument_discord(client)
+profiling.attach(client, settings, "bot")
 
 EXISTING_VOTER_ROLE_NAME = "Voter"
 VOUCHER_ROLE = "Verified"
@@ -35,54 +79,94 @@ def in_vouching_channel(message: discord.Message) -> bool:
 
 
 def is_voter(user: discord.Member) -> bool:
-    return EXISTING_VOTER_ROLE_NAME in [role.name for role in user.roles]
+    return client.role_index.member_has_role(user, EXISTING_VOTER_ROLE_NAME)
 
 
 def is_vouched_for(user: discord.Member) -> bool:
-    return VOUCHER_ROLE in [role.name for role in user.roles]
+    return client.role_index.member_has_role(user, VOUCHER_ROLE)
+
 
+def count_voters(guild: discord.Guild) -> int:
+    index = client.role_index.for_guild(guild)
+    return index.count(index.role_id(EXISTING_VOTER_ROLE_NAME))
 
-async def get_voters(ctx) -> List[discord.Member]:
-    return [
-        member
-        for member in ctx.guild.members
-        if EXISTING_VOTER_ROLE_NAME in [role.name for role in member.roles]
-    ]
+
+def reply_route(message: discord.PartialMessage):
+    return ("reply", message.channel.id)
 
 
 async def send_not_authorized_to_vote_reply(
-    reaction: discord.Reaction, user: discord.Member
+    message: discord.PartialMessage, names: List[str]
 ):
-    await reaction.message.reply(
-        "The vote cast by {} was removed as they don't have the Voter Role. Only Voters can verify community members.".format(
-            user.display_name
+    if len(names) == 1:
+        text = "The vote cast by {} was removed as they don't have the Voter Role. Only Voters can verify community members.".format(
+            names[0]
+        )
+    else:
+        text = "{} votes cast by {} were removed as they don't have the Voter Role. Only Voters can verify community members.".format(
+            len(names), ", ".join(names)
         )
+    await message.reply(text)
+
+
+def remove_unauthorized_vote(
+    message: discord.PartialMessage,
+    emoji: discord.PartialEmoji,
+    user: discord.Member,
+):
+    client.outbox.submit(
+        ("reaction", message.channel.id),
+        functools.partial(message.remove_reaction, emoji, user),
+        REACTION_REMOVAL,
+    )
+    client.outbox.coalesce(
+        ("not-authorized", message.id),
+        user.display_name,
+        reply_route(message),
+        functools.partial(send_not_authorized_to_vote_reply, message),
     )
 
 
 async def send_vouch_sucessful_reply(
-    member_id: str, message: discord.Message, votes: int
+    member_id: str, message: discord.PartialMessage, votes: int
 ):
-    member = await message.guild.fetch_member(int(member_id))
-    await message.reply(
-        "{} was successfully verified! They received {} approvals and are now one step closer to become a Voter...".format(
-            member.display_name, votes
-        )
+    member = message.guild.get_member(int(member_id))
+    if member is None:
+        member = await message.guild.fetch_member(int(member_id))
+    index = client.role_index.for_guild(message.guild)
+    role = message.guild.get_role(index.role_id(VOUCHER_ROLE))
+    client.outbox.submit(
+        ("roles", message.guild.id),
+        functools.partial(member.add_roles, role),
+        ROLE_GRANT,
+    )
+    client.outbox.submit(
+        reply_route(message),
+        functools.partial(
+            message.reply,
+            "{} was successfully verified! They received {} approvals and are now one step closer to become a Voter...".format(
+                member.display_name, votes
+            ),
+        ),
+        REPLY,
     )
-    role = discord.utils.get(message.guild.roles, name=VOUCHER_ROLE)
-    await member.add_roles(role)
 
 
-async def send_vouch_failed_reply(vote: Vote):
+def send_vouch_failed_reply(vote: Vote):
     channel = client.get_channel(VOUCHING_CHANNELS[0])
-    vote_message = await channel.fetch_message(vote.message_id)
-    await vote_message.reply(
-        "{} has failed verification. Only {} of the needed {} votes after {} days.".format(
-            vote.on_behalf_of.discord_name,
-            vote.votes,
-            vote.vouches_required,
-            vote.days,
-        )
+    vote_message = channel.get_partial_message(int(vote.message_id))
+    client.outbox.submit(
+        reply_route(vote_message),
+        functools.partial(
+            vote_message.reply,
+            "{} has failed verification. Only {} of the needed {} votes after {} days.".format(
+                vote.on_behalf_of.discord_name,
+                vote.votes,
+                vote.vouches_required,
+                vote.days,
+            ),
+        ),
+        REPLY,
     )
 
 
@@ -114,141 +198,144 @@ async def send_vote_embed(
     return vote
 
 
-async def attempt_to_add_user(user: discord.Member):
-    member = MemberBase(
+def member_record(user: discord.Member) -> MemberBase:
+    return MemberBase(
         discord_id=user.id,
         discord_name=user.display_name,
         is_vouched_for=is_vouched_for(user),
         is_voter=is_voter(user),
     )
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            "http://localhost:8000/members",
-            json=member.dict(),
-            headers={"Content-Type": "application/json"},
-        ) as resp:
-            response = await resp.json()
-            return response
+
+
+async def attempt_to_add_user(user: discord.Member):
+    member = member_record(user)
+    if not client.synced_members.changed(member):
+        return
+    await client.backend.upsert_member(member)
+    client.synced_members.mark_synced([member])
+
+
+async def sync_guild_members(guild: discord.Guild):
+    members = client.synced_members.unsynced(
+        member_record(user) for user in guild.members if not user.bot
+    )
+    size = client.settings.member_sync_batch_size
+    for i in range(0, len(members), size):
+        batch = members[i : i + size]
+        await client.backend.upsert_members(batch)
+        client.synced_members.mark_synced(batch)
 
 
 async def attempt_to_start_vote(ctx: Context):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            "http://localhost:8000/existing-votes/{}".format(ctx.author.id),
-            headers={"Content-Type": "application/json"},
-        ) as resp:
-            if resp.status == 200:
-                vote = await resp.json()
-                vote_msg = await ctx.channel.fetch_message(vote["message_id"])
-                await send_vote_exists_message(vote_msg)
-                return
-
-        voters = await get_voters(ctx)
-        n_voters = len(voters)
-        votes_needed = max(1, int(VOTE_PERCENT * n_voters))
-        vote_message = await send_vote_embed(ctx, votes_needed, n_voters)
-        vote = VoteBase(
-            message_id=str(vote_message.id),
-            on_behalf_of_id=ctx.author.id,
-            start_time=datetime.datetime.utcnow(),
-            days=VOTE_DAYS,
-            vouches_required=votes_needed,
-        )
-        async with session.post(
-            "http://localhost:8000/votes",
-            json=vote.dict(),
-            headers={"Content-Type": "application/json"},
-        ) as resp:
-            await resp.json()
-
-
-def is_vote_reaction(reaction: discord.Reaction) -> bool:
-    return reaction.emoji == VOTE_REACT
-
-
-async def is_message_active_vote(message: discord.Message) -> bool:
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            "http://localhost:8000/votes/{}".format(message.id),
-            headers={"Content-Type": "application/json"},
-        ) as resp:
-            if resp.status != 200:
-                return False
-            vote = await resp.json()
-            return not vote["complete"]
-
-
-async def send_vouch_event(reaction: discord.Reaction, user: discord.Member):
-    vouch = VouchEventBase(vote_id=reaction.message.id, voucher_id=user.id)
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            "http://localhost:8000/vouch-event",
-            json=vouch.dict(),
-            headers={"Content-Type": "application/json"},
-        ) as resp:
-            vouch_data = await resp.json()
-            vouch = VouchEvent(**vouch_data)
-            if vouch.vote.complete:
-                await send_vouch_sucessful_reply(
-                    vouch.vote.on_behalf_of_id, reaction.message, vouch.vote.votes
-                )
-
-
-async def send_vouch_revoked_event(reaction: discord.Reaction, user: discord.Member):
-    vouch = VouchEventBase(vote_id=reaction.message.id, voucher_id=user.id)
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            "http://localhost:8000/vouch-event/delete",
-            json=vouch.dict(),
-            headers={"Content-Type": "application/json"},
-        ) as resp:
-            status = await resp.json()
+    existing_vote = await client.backend.get_existing_vote(ctx.author.id)
+    if existing_vote is not None:
+        vote_msg = await ctx.channel.fetch_message(existing_vote.message_id)
+        await send_vote_exists_message(vote_msg)
+        return
+
+    n_voters = count_voters(ctx.guild)
+    votes_needed = max(1, int(VOTE_PERCENT * n_voters))
+    vote_message = await send_vote_embed(ctx, votes_needed, n_voters)
+    vote = VoteBase(
+        message_id=str(vote_message.id),
+        on_behalf_of_id=ctx.author.id,
+        start_time=datetime.datetime.utcnow(),
+        days=VOTE_DAYS,
+        vouches_required=votes_needed,
+    )
+    db_vote = await client.backend.add_vote(vote)
+    client.vote_cache.put(db_vote.message_id, db_vote)
+
+
+def is_vote_reaction(emoji: discord.PartialEmoji) -> bool:
+    return str(emoji) == VOTE_REACT
+
+
+async def is_message_active_vote(message: discord.PartialMessage) -> bool:
+    state = client.vote_cache.get(message.id)
+    if state is None:
+        # Raises on a backend error, so nothing is cached and the next
+        # reaction asks again.
+        vote = await client.backend.get_vote(message.id)
+        state = client.vote_cache.put(message.id, vote)
+    return state.active
+
+
+async def send_vouch_event(message: discord.PartialMessage, user: discord.Member):
+    vouch = VouchEventAction(vote_id=message.id, voucher_id=user.id)
+    result, vote = await client.vouch_batcher.submit(vouch)
+    if result.completed:
+        client.vote_cache.put(vote.message_id, vote)
+        await send_vouch_sucessful_reply(vote.on_behalf_of_id, message, vote.votes)
+
+
+async def send_vouch_revoked_event(
+    message: discord.PartialMessage, user: discord.Member
+):
+    vouch = VouchEventAction(vote_id=message.id, voucher_id=user.id, action="remove")
+    await client.vouch_batcher.submit(vouch)
 
 
 @client.event
+@tracer.traced()
 async def on_ready():
-    async with aiohttp.ClientSession() as session:
-        async with session.get("http://localhost:8000/status") as resp:
-            data = await resp.json()
-            status = Status(**data)
-            print("Backend online: {}".format(status.alive))
+    if client.backend is None:
+        client.backend = create_backend(client.settings)
+        await client.backend.start()
+    client.outbox.start()
+    status = await client.backend.status()
+    print("Backend online: {}".format(status.alive))
+    for channel_id in VOUCHING_CHANNELS:
+        channel = client.get_channel(channel_id)
+        if channel is not None:
+            await sync_guild_members(channel.guild)
+    if not sweep_outstanding_votes.is_running():
+        sweep_outstanding_votes.start()
 
 
 @client.event
-async def on_reaction_add(reaction: discord.Reaction, user: discord.Member):
-    if not in_vouching_channel(reaction.message):
+@tracer.traced()
+async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
+    if payload.channel_id not in VOUCHING_CHANNELS:
         return
-    if user == client.user:
+    if payload.user_id == client.user.id:
         return
-    is_vote = await is_message_active_vote(reaction.message)
+    user = payload.member
+    message = partial_message(client, payload)
+    is_vote = await is_message_active_vote(message)
     if is_vote:
-        if not is_vote_reaction(reaction):
+        if not is_vote_reaction(payload.emoji):
             return
         if not is_voter(user):
-            await reaction.message.remove_reaction(reaction, user)
-            await send_not_authorized_to_vote_reply(reaction, user)
+            remove_unauthorized_vote(message, payload.emoji, user)
             return
-        await send_vouch_event(reaction, user)
+        await send_vouch_event(message, user)
     await attempt_to_add_user(user)
 
 
 @client.event
-async def on_reaction_remove(reaction: discord.Reaction, user: discord.Member):
-    if not in_vouching_channel(reaction.message):
+@tracer.traced()
+async def on_raw_reaction_remove(payload: discord.RawReactionActionEvent):
+    if payload.channel_id not in VOUCHING_CHANNELS:
+        return
+    if payload.user_id == client.user.id:
         return
-    if user == client.user:
+    user = await resolve_member(client, payload)
+    if user is None:
         return
-    is_vote = await is_message_active_vote(reaction.message)
+    message = partial_message(client, payload)
+    is_vote = await is_message_active_vote(message)
     if is_vote:
         if not is_voter(user):
             return
-        if not is_vote_reaction(reaction):
+        if not is_vote_reaction(payload.emoji):
             return
-        await send_vouch_revoked_event(reaction, user)
+        await send_vouch_revoked_event(message, user)
     await attempt_to_add_user(user)
 
 
 @client.command(name="verify")
+@tracer.traced()
 async def verify(ctx: Context):
     if not in_vouching_channel(ctx.message):
         return
@@ -260,17 +347,13 @@ async def verify(ctx: Context):
 
 
 @tasks.loop(minutes=10)
+@tracer.traced()
 async def sweep_outstanding_votes():
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            "http://localhost:8000/outstanding-votes",
-            headers={"Content-Type": "application/json"},
-        ) as resp:
-            response = await resp.json()
-            votes = VotesResponse(**response.dict()).votes
-            for vote in votes:
-                if vote.complete:
-                    await send_vouch_failed_reply(vote)
+    votes = await client.backend.get_outstanding_votes()
+    for vote in votes:
+        if vote.complete:
+            client.vote_cache.put(vote.message_id, vote)
+            send_vouch_failed_reply(vote)
 
 
 def main():
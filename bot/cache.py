@@ -0,0 +1,110 @@
+import datetime
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .schemas import MemberBase, VoteBase
+
+
+@dataclass
+class VoteState:
+    active: bool
+    vouches_required: int = 0
+    end_time: Optional[datetime.datetime] = None
+
+
+NOT_A_VOTE = VoteState(active=False)
+
+
+class VoteCache:
+    """An LRU of vote state keyed by message id.
+
+    Active votes expire at their ``end_time``. Messages that are not votes,
+    and votes that are complete, are cached as inactive until evicted or
+    ``negative_ttl`` seconds pass.
+    """
+
+    def __init__(self, max_size: int = 10000, negative_ttl: float = 3600.0):
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[VoteState, float]]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, message_id) -> Optional[VoteState]:
+        key = str(message_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        state, expires_at = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return state
+
+    def put(self, message_id, vote: Optional[VoteBase]) -> VoteState:
+        if vote is None or vote.complete:
+            state = NOT_A_VOTE
+            expires_at = time.time() + self.negative_ttl
+        else:
+            state = VoteState(
+                active=True,
+                vouches_required=vote.vouches_required,
+                end_time=vote.end_time,
+            )
+            expires_at = (
+                vote.end_time.replace(tzinfo=datetime.timezone.utc).timestamp()
+            )
+        key = str(message_id)
+        self._entries[key] = (state, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return state
+
+    def invalidate(self, message_id):
+        self._entries.pop(str(message_id), None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+
+class MemberSyncCache:
+    """The member records the backend is known to hold, keyed by discord id.
+
+    ``changed`` tells whether a member is new or differs from what was last
+    synced, so unchanged members never cost a backend call.
+    """
+
+    def __init__(self):
+        self._members: Dict[str, MemberBase] = {}
+
+    def __len__(self):
+        return len(self._members)
+
+    def changed(self, member: MemberBase) -> bool:
+        return self._members.get(member.discord_id) != member
+
+    def unsynced(self, members: Iterable[MemberBase]) -> List[MemberBase]:
+        return [member for member in members if self.changed(member)]
+
+    def mark_synced(self, members: Iterable[MemberBase]):
+        for member in members:
+            self._members[member.discord_id] = member
+
+    def invalidate(self, discord_id):
+        self._members.pop(str(discord_id), None)
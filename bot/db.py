@@ -1,25 +1,131 @@
 import datetime
-
-from sqlalchemy import create_engine
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import (
+    and_,
+    delete,
+    event,
+    func,
+    inspect,
+    not_,
+    or_,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import selectinload, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.schema import CreateColumn
+
+from sqlalchemy import (
+    Boolean,
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    JSON,
+    String,
+)
 from sqlalchemy.orm import relationship
 
-from .schemas import MemberBase, VoteBase, VouchEventBase
+from .schemas import MemberBase, VoteBase, VouchEventAction, VouchEventBase
+
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./app.db")
+DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", "5"))
+DATABASE_MAX_OVERFLOW = int(os.getenv("DATABASE_MAX_OVERFLOW", "10"))
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./app.db"
+DATABASE_BUSY_TIMEOUT_MS = int(os.getenv("DATABASE_BUSY_TIMEOUT_MS", "5000"))
+IS_SQLITE = make_url(SQLALCHEMY_DATABASE_URL).get_backend_name() == "sqlite"
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+engine = create_async_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False} if IS_SQLITE else {},
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=DATABASE_POOL_SIZE,
+    max_overflow=DATABASE_MAX_OVERFLOW,
 )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+if IS_SQLITE:
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        # In WAL mode readers keep reading the last committed state while a
+        # commit is being written, instead of waiting on its lock. Writers
+        # still queue; busy_timeout makes them wait instead of failing.
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA busy_timeout={}".format(DATABASE_BUSY_TIMEOUT_MS))
+        cursor.close()
+
+
+SessionLocal = sessionmaker(
+    engine,
+    class_=AsyncSession,
+    autocommit=False,
+    autoflush=False,
+    expire_on_commit=False,
+)
 
 Base = declarative_base()
 
 
+async def init_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_migrate)
+
+
+def _migrate(conn):
+    """Add the columns and indexes that tables from an older release lack.
+
+    ``create_all`` only creates missing tables. Each step checks the live
+    schema first, so this does nothing on an up-to-date database.
+    """
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                conn.execute(
+                    text("ALTER TABLE {} ADD COLUMN {}".format(table.name, ddl))
+                )
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                if index.name == "uq_vouches_vote_voucher":
+                    _drop_duplicate_vouches(conn)
+                index.create(conn)
+
+
+def _drop_duplicate_vouches(conn):
+    # Before the unique index, a replayed reaction could store and count the
+    # same vouch twice. Keep the first row and recount the affected votes.
+    duplicated = select(Vouch.vote_id).group_by(Vouch.vote_id, Vouch.voucher_id)
+    vote_ids = conn.execute(duplicated.having(func.count() > 1)).scalars().all()
+    if not vote_ids:
+        return
+    first = select(func.min(Vouch.vouch_id)).group_by(Vouch.vote_id, Vouch.voucher_id)
+    conn.execute(delete(Vouch).where(Vouch.vouch_id.not_in(first)))
+    count = (
+        select(func.count(Vouch.vouch_id))
+        .where(Vouch.vote_id == Vote.message_id)
+        .scalar_subquery()
+    )
+    conn.execute(
+        update(Vote)
+        .where(Vote.message_id.in_(set(vote_ids)))
+        .values(votes=count, version=Vote.version + 1)
+    )
+
+
 class Member(Base):
 
     __tablename__ = "members"
@@ -29,6 +135,8 @@ class Member(Base):
     discord_pp_url = Column(String)
     is_vouched_for = Column(Boolean)
     is_voter = Column(Boolean)
+    # Bumped on every write; the API derives ETags from it.
+    version = Column(Integer, nullable=False, default=1, server_default="1")
 
     votes = relationship("Vote", back_populates="on_behalf_of")
 
@@ -36,6 +144,15 @@ class Member(Base):
 class Vote(Base):
 
     __tablename__ = "vouch_votes"
+    __table_args__ = (
+        Index(
+            "ix_vouch_votes_on_behalf_of_complete_end",
+            "on_behalf_of_id",
+            "complete",
+            "end_time",
+        ),
+        Index("ix_vouch_votes_start_time_message", "start_time", "message_id"),
+    )
 
     message_id = Column(String, primary_key=True, index=True)
     on_behalf_of_id = Column(String, ForeignKey("members.discord_id"))
@@ -45,27 +162,48 @@ class Vote(Base):
     vouches_required = Column(Integer, nullable=False)
     votes = Column(Integer)
     complete = Column(Boolean)
+    completed_at = Column(DateTime, index=True)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
 
     on_behalf_of = relationship("Member", back_populates="votes")
     vouches = relationship("Vouch", back_populates="vote")
 
-    @property
+    @hybrid_property
     def failed(self):
         return (
             self.votes < self.vouches_required
             and self.end_time < datetime.datetime.utcnow()
         )
 
-    @property
+    @failed.expression
+    def failed(cls):
+        return and_(
+            cls.votes < cls.vouches_required,
+            cls.end_time < datetime.datetime.utcnow(),
+        )
+
+    @hybrid_property
     def successful(self):
         return self.votes >= self.vouches_required and (
             self.end_time >= datetime.datetime.utcnow() or self.complete
         )
 
+    @successful.expression
+    def successful(cls):
+        return and_(
+            cls.votes >= cls.vouches_required,
+            or_(cls.end_time >= datetime.datetime.utcnow(), cls.complete == True),
+        )
+
 
 class Vouch(Base):
 
     __tablename__ = "vouches"
+    __table_args__ = (
+        # A named unique index rather than a constraint, so SQLite does not
+        # replace it with an anonymous autoindex.
+        Index("uq_vouches_vote_voucher", "vote_id", "voucher_id", unique=True),
+    )
 
     vouch_id = Column(Integer, primary_key=True)
     vote_id = Column(String, ForeignKey("vouch_votes.message_id"))
@@ -74,79 +212,401 @@ class Vouch(Base):
     vote = relationship("Vote", back_populates="vouches")
 
 
-def get_member_by_id(db, id_: str):
-    return db.query(Member).filter(Member.discord_id == id_).first()
+class ChannelPreference(Base):
+
+    __tablename__ = "channel_preferences"
+
+    channel_id = Column(String, primary_key=True)
+    preferences = Column(JSON, nullable=False)
 
 
-def get_vote_by_id(db, id_: str):
-    return db.query(Vote).filter(Vote.message_id == id_).first()
+class MessageTally(Base):
 
+    __tablename__ = "message_tallies"
 
-def create_member(db, member: MemberBase):
+    message_id = Column(String, primary_key=True)
+    channel_id = Column(String, nullable=False, index=True)
+    start_time = Column(DateTime)
+    is_ended = Column(Boolean, nullable=False, default=False, index=True)
+    counts = Column(JSON, nullable=False)
+
+
+def _vote_loads():
+    return (selectinload(Vote.on_behalf_of), selectinload(Vote.vouches))
+
+
+def _member_loads():
+    return (
+        selectinload(Member.votes).selectinload(Vote.on_behalf_of),
+        selectinload(Member.votes).selectinload(Vote.vouches),
+    )
+
+
+async def get_member_by_id(db, id_: str):
+    result = await db.execute(
+        select(Member)
+        .options(*_member_loads())
+        .where(Member.discord_id == id_)
+        .execution_options(populate_existing=True)
+    )
+    return result.scalars().first()
+
+
+async def upsert_members(db, members: List[MemberBase]):
+    # Only the synced fields are overwritten, so discord_pp_url survives.
+    if members:
+        rows = [member.dict() for member in members]
+        await db.execute(
+            _upsert(db, Member, columns=list(rows[0]), version=Member.version + 1),
+            rows,
+        )
+    await db.commit()
+
+
+async def get_member_version(db, id_: str) -> Optional[Tuple[int, int, int]]:
+    """``(version, vote count, sum of vote versions)`` for a member, or None.
+
+    Together these change whenever anything in the member's response does,
+    without loading the votes and vouches.
+    """
+    result = await db.execute(
+        select(
+            Member.version,
+            func.count(Vote.message_id),
+            func.coalesce(func.sum(Vote.version), 0),
+        )
+        .outerjoin(Member.votes)
+        .where(Member.discord_id == id_)
+        .group_by(Member.discord_id, Member.version)
+    )
+    return result.first()
+
+
+async def get_vote_version(db, id_: str) -> Optional[Tuple[int, int]]:
+    """``(vote version, member version)``; a vote embeds its member."""
+    result = await db.execute(
+        select(Vote.version, Member.version)
+        .outerjoin(Vote.on_behalf_of)
+        .where(Vote.message_id == id_)
+    )
+    return result.first()
+
+
+async def get_existing_vote_version(db, discord_id: str):
+    """``(message id, vote version, member version)`` of the open vote."""
+    result = await db.execute(
+        select(Vote.message_id, Vote.version, Member.version)
+        .outerjoin(Vote.on_behalf_of)
+        .where(*_existing_vote_filter(discord_id))
+    )
+    return result.first()
+
+
+async def get_vote_by_id(db, id_: str):
+    result = await db.execute(
+        select(Vote)
+        .options(*_vote_loads())
+        .where(Vote.message_id == id_)
+        .execution_options(populate_existing=True)
+    )
+    return result.scalars().first()
+
+
+async def create_member(db, member: MemberBase):
     db_member = Member(**member.dict())
     db.add(db_member)
-    db.commit()
-    db.refresh(db_member)
-    return db_member
+    await db.commit()
+    return await get_member_by_id(db, db_member.discord_id)
 
 
-def create_vote(db, vote: VoteBase):
-    vote_dict = vote.dict(as_datetime=True, exclude={"days"})
+async def create_vote(db, vote: VoteBase):
+    vote_dict = vote.dict(exclude={"days"})
     vote_dict["end_time"] = vote.end_time
     vote_dict["complete"] = False
     db_vote = Vote(**vote_dict)
     db.add(db_vote)
-    db.commit()
-    db.refresh(db_vote)
-    return db_vote
+    await db.commit()
+    return await get_vote_by_id(db, db_vote.message_id)
 
 
-def get_existing_vote_by_discord_id(db, discord_id: str):
+def _existing_vote_filter(discord_id: str):
     return (
-        db.query(Vote)
-        .filter(
-            Vote.on_behalf_of_id == discord_id
-            and Vote.end_time > datetime.datetime.utcnow()
-        )
-        .first()
+        Vote.on_behalf_of_id == discord_id,
+        Vote.complete == False,
+        Vote.end_time > datetime.datetime.utcnow(),
     )
 
 
-def get_vouch_event_by_ids(db, vouch: VouchEventBase):
+async def get_existing_vote_by_discord_id(db, discord_id: str):
+    result = await db.execute(
+        select(Vote).options(*_vote_loads()).where(*_existing_vote_filter(discord_id))
+    )
+    return result.scalars().first()
+
+
+async def get_vouch_event_by_ids(db, vouch: VouchEventBase):
+    result = await db.execute(
+        select(Vouch)
+        .options(selectinload(Vouch.vote))
+        .where(Vouch.vote_id == vouch.vote_id, Vouch.voucher_id == vouch.voucher_id)
+        .execution_options(populate_existing=True)
+    )
+    return result.scalars().first()
+
+
+def _insert(db, model):
+    dialect = postgresql if db.bind.dialect.name == "postgresql" else sqlite
+    return dialect.insert(model)
+
+
+def _insert_ignoring_duplicates(db, model):
+    return _insert(db, model).on_conflict_do_nothing()
+
+
+def _upsert(db, model, columns: Optional[List[str]] = None, **values):
+    """Insert, or update ``columns`` (default: every non-key column) on conflict.
+
+    ``values`` are extra SET expressions for the conflict case.
+    """
+    stmt = _insert(db, model)
+    table = model.__table__
+    if columns is None:
+        columns = [column.name for column in table.columns if not column.primary_key]
+    set_ = {name: stmt.excluded[name] for name in columns}
+    set_.update(values)
+    return stmt.on_conflict_do_update(
+        index_elements=[column.name for column in table.primary_key],
+        set_=set_,
+    )
+
+
+def _count_vote(vote_id: str, delta: int):
     return (
-        db.query(Vouch)
-        .filter(Vouch.vote_id == vouch.vote_id and Vouch.voucher_id == vouch.voucher_id)
-        .first()
-    )
-
-
-def delete_vouch_event(db, vouch: VouchEventBase):
-    db_vouch = get_vouch_event_by_ids(db, vouch)
-    if db_vouch:
-        db_vote = get_vote_by_id(db, db_vouch.vote.message_id)
-        db_vote.votes -= 1
-        db.delete(db_vouch)
-        db.commit()
-        return True
-    return False
-
-
-def create_vouch_event(db, vouch: VouchEventBase):
-    db_vouch = Vouch(**vouch.dict())
-    db_vote = get_vote_by_id(db, db_vouch.vote.message_id)
-    db_vote.votes += 1
-    db.add(db_vouch)
-    db.commit()
-    db.refresh(db_vouch)
-    return db_vouch
+        update(Vote)
+        .where(Vote.message_id == vote_id)
+        .values(votes=Vote.votes + delta, version=Vote.version + 1)
+    )
+
 
+async def delete_vouch_event(db, vouch: VouchEventBase):
+    result = await db.execute(
+        delete(Vouch).where(
+            Vouch.vote_id == vouch.vote_id, Vouch.voucher_id == vouch.voucher_id
+        )
+    )
+    if result.rowcount != 1:
+        await db.rollback()
+        return False
+    await db.execute(_count_vote(vouch.vote_id, -1))
+    await db.commit()
+    return True
 
-def get_current_votes(db):
-    return db.query(Vote).filter(Vote.complete != True).all()
 
+async def _existing_vote_ids(db, vote_ids) -> Set[str]:
+    result = await db.execute(
+        select(Vote.message_id).where(Vote.message_id.in_(set(vote_ids)))
+    )
+    return set(result.scalars().all())
+
+
+async def create_vouch_event(db, vouch: VouchEventBase):
+    """Insert and count ``vouch``; None, writing nothing, if its vote is unknown."""
+    if not await _existing_vote_ids(db, [vouch.vote_id]):
+        await db.rollback()
+        return None
+    # A duplicate (vote_id, voucher_id) inserts nothing and is not counted,
+    # so replayed gateway events return the existing vouch unchanged.
+    result = await db.execute(
+        _insert_ignoring_duplicates(db, Vouch).values(**vouch.dict())
+    )
+    if result.rowcount == 1:
+        await db.execute(_count_vote(vouch.vote_id, 1))
+    await db.commit()
+    return await get_vouch_event_by_ids(db, vouch)
+
+
+async def apply_vouch_events(db, events: List[VouchEventAction]):
+    """Apply add/remove events in order in a single transaction.
+
+    Returns one result dict per event and the votes they touched. Each
+    vote's counter is updated once with the net change, and a vote that is
+    now successful is completed and credited to its last applied event.
+    Events for votes that do not exist are not applied.
+    """
+    results = []
+    deltas: Dict[str, int] = {}
+    last_applied: Dict[str, int] = {}
+    known = await _existing_vote_ids(db, {event.vote_id for event in events})
+    for i, event in enumerate(events):
+        vouch = {"vote_id": event.vote_id, "voucher_id": event.voucher_id}
+        if event.vote_id not in known:
+            results.append(dict(event.dict(), applied=False, completed=False))
+            continue
+        if event.action == "add":
+            result = await db.execute(
+                _insert_ignoring_duplicates(db, Vouch).values(**vouch)
+            )
+            delta = 1
+        else:
+            result = await db.execute(
+                delete(Vouch).where(
+                    Vouch.vote_id == event.vote_id,
+                    Vouch.voucher_id == event.voucher_id,
+                )
+            )
+            delta = -1
+        applied = result.rowcount == 1
+        if applied:
+            deltas[event.vote_id] = deltas.get(event.vote_id, 0) + delta
+            last_applied[event.vote_id] = i
+        results.append(dict(event.dict(), applied=applied, completed=False))
+    # Also for a net change of zero: the vote's vouches still changed.
+    for vote_id, delta in deltas.items():
+        await db.execute(_count_vote(vote_id, delta))
+    votes = []
+    if events:
+        result = await db.execute(
+            select(Vote)
+            .options(*_vote_loads())
+            .where(Vote.message_id.in_({event.vote_id for event in events}))
+            .execution_options(populate_existing=True)
+        )
+        votes = result.scalars().all()
+    now = datetime.datetime.utcnow()
+    for vote in votes:
+        if vote.message_id in last_applied and not vote.complete and vote.successful:
+            vote.complete = True
+            vote.completed_at = now
+            vote.version += 1
+            results[last_applied[vote.message_id]]["completed"] = True
+    await db.commit()
+    return results, votes
+
+
+async def ping(db):
+    await db.execute(select(1))
+
+
+async def count_open_votes(db) -> int:
+    result = await db.execute(
+        select(func.count(Vote.message_id)).where(
+            or_(Vote.complete == False, Vote.complete == None)
+        )
+    )
+    return result.scalar()
 
-def complete_vote(db, vote: Vote):
+
+async def get_current_votes(db):
+    result = await db.execute(
+        select(Vote).options(*_vote_loads()).where(Vote.complete != True)
+    )
+    return result.scalars().all()
+
+
+async def complete_vote(db, vote: Vote):
     vote.complete = True
-    db.commit()
-    db.refresh(vote)
+    vote.completed_at = datetime.datetime.utcnow()
+    vote.version += 1
+    await db.commit()
     return vote
+
+
+async def cast_vouch(db, vouch: VouchEventBase):
+    db_vouch = await create_vouch_event(db, vouch)
+    if db_vouch is None:
+        return None
+    if not db_vouch.vote.complete and db_vouch.vote.successful:
+        await complete_vote(db, db_vouch.vote)
+    return db_vouch
+
+
+async def sweep_votes(db):
+    """Close every failed vote and return only the votes closed by this call.
+
+    One UPDATE stamps the closed rows with this sweep's ``completed_at``,
+    which is then used to load them back with their relationships.
+    """
+    now = datetime.datetime.utcnow()
+    await db.execute(
+        update(Vote)
+        .where(Vote.complete != True, Vote.failed)
+        .values(complete=True, completed_at=now, version=Vote.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    result = await db.execute(
+        select(Vote)
+        .options(*_vote_loads())
+        .where(Vote.completed_at == now)
+        .execution_options(populate_existing=True)
+    )
+    return result.scalars().all()
+
+
+async def stream_votes(
+    db,
+    limit: int,
+    after: Optional[Tuple[datetime.datetime, str]] = None,
+    complete: Optional[bool] = None,
+    failed: Optional[bool] = None,
+    successful: Optional[bool] = None,
+    on_behalf_of_id: Optional[str] = None,
+    start_after: Optional[datetime.datetime] = None,
+    start_before: Optional[datetime.datetime] = None,
+):
+    """Stream up to ``limit`` votes ordered by (start_time, message_id).
+
+    ``after`` is the keyset cursor: the (start_time, message_id) of the last
+    vote of the previous page.
+    """
+    query = select(Vote).options(*_vote_loads())
+    if after is not None:
+        start_time, message_id = after
+        query = query.where(
+            or_(
+                Vote.start_time > start_time,
+                and_(Vote.start_time == start_time, Vote.message_id > message_id),
+            )
+        )
+    for flag, condition in (
+        (complete, Vote.complete == True),
+        (failed, Vote.failed),
+        (successful, Vote.successful),
+    ):
+        if flag is not None:
+            query = query.where(condition if flag else not_(condition))
+    if on_behalf_of_id is not None:
+        query = query.where(Vote.on_behalf_of_id == on_behalf_of_id)
+    if start_after is not None:
+        query = query.where(Vote.start_time >= start_after)
+    if start_before is not None:
+        query = query.where(Vote.start_time < start_before)
+    query = (
+        query.order_by(Vote.start_time, Vote.message_id)
+        .limit(limit)
+        .execution_options(yield_per=100)
+    )
+    result = await db.stream(query)
+    return result.scalars()
+
+
+async def get_channel_preferences(db):
+    result = await db.execute(select(ChannelPreference))
+    return result.scalars().all()
+
+
+async def get_active_message_tallies(db):
+    result = await db.execute(
+        select(MessageTally).where(MessageTally.is_ended == False)
+    )
+    return result.scalars().all()
+
+
+async def save_channel_preferences(db, rows: List[dict]):
+    if rows:
+        await db.execute(_upsert(db, ChannelPreference), rows)
+
+
+async def save_message_tallies(db, rows: List[dict]):
+    if rows:
+        await db.execute(_upsert(db, MessageTally), rows)
@@ -0,0 +1,36 @@
+import discord
+
+from .reactions import message_cache_size
+from .schemas import BotSettings
+
+
+def lean_intents() -> discord.Intents:
+    """Only the gateway traffic the vouch flow reads."""
+    intents = discord.Intents.none()
+    intents.guilds = True
+    # Role index, voter counts and member lookups.
+    intents.members = True
+    # !verify and the vote cards. Prefix commands need the message text.
+    intents.guild_messages = True
+    intents.message_content = True
+    intents.guild_reactions = True
+    return intents
+
+
+def client_options(settings: BotSettings) -> dict:
+    """Keyword arguments for the bot client for ``settings.gateway_profile``.
+
+    The "full" profile receives every intent. The "lean" profile drops
+    presence, typing, DM and voice traffic and only caches members as the
+    members intent allows. Either can chunk guilds at startup or lazily.
+    """
+    if settings.gateway_profile == "lean":
+        intents = lean_intents()
+    else:
+        intents = discord.Intents.all()
+    return {
+        "intents": intents,
+        "member_cache_flags": discord.MemberCacheFlags.from_intents(intents),
+        "chunk_guilds_at_startup": settings.chunk_guilds_at_startup,
+        "max_messages": message_cache_size(settings),
+    }
@@ -8,11 +8,27 @@ from typing import Literal, Optional, Union
 
 import discord
 import os
-from discord.ext import commands, tasks
+from discord.ext import commands
 from discord.utils import get
 
 # User defined Imports
-from .utils import common_member, unique
+from . import profiling, tracing
+from .outbox import REACTION_REMOVAL, RESULT, Outbox
+from .reactions import (
+    eligible_role_ids,
+    message_cache_size,
+    partial_message,
+    quorum_reached,
+    reacting_user_ids,
+    track_vote,
+    untrack_vote,
+    weighted_tally,
+)
+from .roles import RoleIndex
+from .scheduler import DeadlineScheduler
+from .schemas import BotSettings
+from .store import StateStore
+from .tracing import tracer
 
 
 # Global Variables
@@ -20,6 +36,7 @@ global dayRegex, hourRegex, channelPreferences, messageReactions
 
 dayRegex = re.compile(r"(\d+)[Dd]")
 hourRegex = re.compile(r"(\d+)[Hh]")
+weightRegex = re.compile(r"<@&(\d+)>\s+(\d+(?:\.\d+)?)")
 
 
 @dataclass
@@ -45,21 +62,19 @@ class ChannelPreference:
     percent_to_clear: Optional[float] = None
 
 
-MESSAGE_REACTIONS: list[MessageReaction] = []
+MESSAGE_REACTIONS: list[MessageReactionVote] = []
 CHANNEL_PREFERENCES: list[ChannelPreference] = []
 
 channelPreferences = dict()
 # {"channelID":{"votingMethod":("quorum","time"),"percentToClear/timeToVote":(33%/99hours),positiveVoteEmoji:"\emoji", negativeVoteEmoji:"\emoji2"},"rolesEligible":[all roles eligible]}
 
 
+def voteDeadline(startTime, interval):
+    return startTime + datetime.timedelta(seconds=int(interval) * 60)
+
+
 def hasTimePassed(startTime, interval):
-    currTime = datetime.now()
-    timeDiff = (currTime - startTime).total_seconds()
-    interval = int(interval) * 60
-    if timeDiff > interval:
-        return True
-    else:
-        return False
+    return datetime.datetime.now() > voteDeadline(startTime, interval)
 
 
 async def embed(ctx):
@@ -94,6 +109,16 @@ async def embed(ctx):
             for role_id in channelPreferences[ctx.channel.id]["roles"]
         ],
     )
+    if "weights" in channelPreferences[ctx.channel.id]:
+        embed.add_field(
+            name="Weights",
+            value=[
+                "{}: {}".format(ctx.guild.get_role(int(role_id)), weight)
+                for role_id, weight in channelPreferences[ctx.channel.id][
+                    "weights"
+                ].items()
+            ],
+        )
     channelName = discord.utils.get(
         ctx.guild.channels, id=channelPreferences[ctx.channel.id]["resultChannel"]
     )
@@ -106,6 +131,14 @@ async def sendToChannel(preferenceObject, messageObject):
     currentChannel = client.get_channel(messageObject["channelID"])
     msg = await currentChannel.fetch_message(messageObject["messageID"])
     msgContent = msg.content
+    index = roleIndex.for_guild(currentChannel.guild)
+    roles = preferenceObject["roles"]
+    weights = preferenceObject.get("weights")
+
+    positiveVoters, negativeVoters = await asyncio.gather(
+        reacting_user_ids(msg, preferenceObject["positiveEmoji"]),
+        reacting_user_ids(msg, preferenceObject["negativeEmoji"]),
+    )
 
     embed = discord.Embed(title="Proposal results", description=msgContent)
     embed.add_field(
@@ -113,58 +146,40 @@ async def sendToChannel(preferenceObject, messageObject):
     )
     embed.add_field(name="In Favor", value=messageObject["positiveEmoji"])
     embed.add_field(name="Against", value=messageObject["negativeEmoji"])
-    if messageObject["positiveEmoji"] > messageObject["negativeEmoji"]:
+    if weights:
+        positiveWeight = weighted_tally(positiveVoters, roles, weights, index)
+        negativeWeight = weighted_tally(negativeVoters, roles, weights, index)
+        embed.add_field(name="Weighted In Favor", value=positiveWeight)
+        embed.add_field(name="Weighted Against", value=negativeWeight)
+        passed = positiveWeight > negativeWeight
+    else:
+        passed = messageObject["positiveEmoji"] > messageObject["negativeEmoji"]
+    if passed:
         result = "Passed"
     else:
         result = "Failed"
     embed.add_field(name="Result", value=result)
-    memberCounts = totalMembers(currentChannel, preferenceObject["roles"])
+    memberCounts = totalMembers(currentChannel, roles)
     embed.add_field(name="Stats", value="Total Members and Votes by Role", inline=False)
 
-    positiveReactions = [0 for a in preferenceObject["roles"]]
-
-    negativeReactions = [0 for a in preferenceObject["roles"]]
-
-    for currReaction in msg.reactions:
-        if currReaction.emoji == preferenceObject["positiveEmoji"]:
-            currReactionUser = await currReaction.users().flatten()
-            for user in currReactionUser:
-                user_roles = [role.id for role in user.roles]
-                for i in range(len(preferenceObject["roles"])):
-                    # We check what role does the user have
-                    if preferenceObject["roles"][i] in user_roles:
-                        positiveReactions[i] += 1
-                        # based on the role, we can add a multiplier as well.
-        if currReaction.emoji == preferenceObject["negativeEmoji"]:
-            currReactionUser = await currReaction.users().flatten()
-            for user in currReactionUser:
-                user_roles = [role.id for role in user.roles]
-                for i in range(len(preferenceObject["roles"])):
-                    if preferenceObject["roles"][i] in user_roles:
-                        negativeReactions[i] += 1
-
-    for i in range(len(preferenceObject["roles"])):
+    for i, role_id in enumerate(roles):
+        members_with_role = index.members_with(role_id)
         embed.add_field(
-            name=get(currentChannel.guild.roles, id=preferenceObject["roles"][i]),
+            name=currentChannel.guild.get_role(role_id),
             value=memberCounts[i],
             inline=False,
         )
-        embed.add_field(name="Voted Positive", value=positiveReactions[i], inline=True)
-        embed.add_field(name="Voted Negative", value=negativeReactions[i], inline=True)
-    await channel.send(embed=embed)
-
-
-def members(ctx, roles):
-    server = ctx.message.guild
-    mems = []
-    for role_id in roles:
-        for member in server.members:
-            member_role_ids = [role.id for role in member.roles]
-            if role_id in member_role_ids:
-                mems.append(member.id)
-    uniquemems = unique(mems)
-    count = len(uniquemems)
-    return count
+        embed.add_field(
+            name="Voted Positive",
+            value=len(positiveVoters & members_with_role),
+            inline=True,
+        )
+        embed.add_field(
+            name="Voted Negative",
+            value=len(negativeVoters & members_with_role),
+            inline=True,
+        )
+    outbox.submit(("reply", channel.id), lambda: channel.send(embed=embed), RESULT)
 
 
 def reactionByRole(reaction, role):
@@ -174,38 +189,77 @@ def reactionByRole(reaction, role):
 
 
 def totalMembers(ctx, roles):
-    server = ctx.guild
-    mems = []
-
-    for role_id in roles:
-        roleCount = 0
-        for member in server.members:
-            member_role_ids = [role.id for role in member.roles]
-            if role_id in member_role_ids:
-                roleCount += 1
-        mems.append(roleCount)
-    return mems
+    index = roleIndex.for_guild(ctx.guild)
+    return [index.count(role_id) for role_id in roles]
 
 
 intents = discord.Intents.default()
 intents.members = True
 
-client = commands.Bot(intents=intents, command_prefix="!")
+settings = BotSettings()
+stateStore = StateStore(flush_interval=settings.state_flush_interval)
+outbox = Outbox(
+    concurrency=settings.outbox_concurrency,
+    coalesce_window=settings.outbox_coalesce_window,
+)
+
+
+class VotingBot(commands.Bot):
+    async def close(self):
+        await outbox.close(settings.outbox_close_timeout)
+        await stateStore.close()
+        tracer.close()
+        await super().close()
+
+
+client = VotingBot(
+    intents=intents,
+    command_prefix="!",
+    max_messages=message_cache_size(settings),
+)
+tracing.configure(settings, "main")
+tracing.instrument_discord(client)
+profiling.attach(client, settings, "main")
+roleIndex = RoleIndex()
+roleIndex.attach(client)
+stateLoaded = False
 
 
 @client.event
+@tracer.traced()
 async def on_ready():
+    global stateLoaded
     print("we have logged in as{0.user}".format(client))
+    if not stateLoaded:
+        stateLoaded = True
+        await loadState()
+    stateStore.start()
+    voteScheduler.start()
+    outbox.start()
+
+
+async def loadState():
+    preferences, tallies = await stateStore.load()
+    for channelID, preference in preferences.items():
+        channelPreferences.setdefault(channelID, preference)
+    for messageID, tally in tallies.items():
+        messageReactions.setdefault(messageID, tally)
+        channelVotes.setdefault(tally["channelID"], set()).add(messageID)
+        scheduleTimedVote(messageID)
 
 
 @client.command()
+@tracer.traced()
 async def reset(ctx):
     global channelPreferences
     channelPreferences[ctx.channel.id] = {}
+    stateStore.save_preference(ctx.channel.id, channelPreferences[ctx.channel.id])
+    rescheduleChannel(ctx.channel.id)
     return
 
 
 @client.command()
+@tracer.traced()
 async def sv(ctx):
     global dayRegex, hourRegex
     sentMessages = []
@@ -258,6 +312,7 @@ async def sv(ctx):
         msg = await client.wait_for("message", check=baseCheck)
         sentMessages.append(msg)
         channelPreferences[ctx.channel.id]["percentage"] = msg.content
+        channelPreferences[ctx.channel.id]["threshold"] = parsePercentage(msg.content)
     elif channelPreferences[ctx.channel.id]["votingMethod"] == "Time":
         msg2 = await client.wait_for("message", check=baseCheck)
         hours = sum(int(h) for h in hourRegex.findall(msg2.content)) * 1
@@ -266,12 +321,15 @@ async def sv(ctx):
         sentMessages.append(msg2)
         channelPreferences[ctx.channel.id]["time"] = totalTime
 
-    def checkEmoji(reaction, user):
+    def checkEmoji(payload):
         if (
-            user == ctx.author
-            and reaction.message.channel == ctx.channel
+            payload.user_id == ctx.author.id
+            and payload.channel_id == ctx.channel.id
             and (
-                (reaction.emoji != channelPreferences[ctx.channel.id]["positiveEmoji"])
+                (
+                    str(payload.emoji)
+                    != channelPreferences[ctx.channel.id]["positiveEmoji"]
+                )
                 if "positiveEmoji" in channelPreferences[ctx.channel.id]
                 else True
             )
@@ -285,13 +343,13 @@ async def sv(ctx):
             return False
 
     positiveMessage = await ctx.send("React with Positive Emoji!")
-    positiveReaction, user = await client.wait_for("reaction_add", check=checkEmoji)
-    channelPreferences[ctx.channel.id]["positiveEmoji"] = positiveReaction.emoji
+    positiveReaction = await client.wait_for("raw_reaction_add", check=checkEmoji)
+    channelPreferences[ctx.channel.id]["positiveEmoji"] = str(positiveReaction.emoji)
     await asyncio.sleep(1)
     await positiveMessage.delete()
     negativeMessage = await ctx.send("React with Negative Emoji!")
-    negativeReaction, user = await client.wait_for("reaction_add", check=checkEmoji)
-    channelPreferences[ctx.channel.id]["negativeEmoji"] = negativeReaction.emoji
+    negativeReaction = await client.wait_for("raw_reaction_add", check=checkEmoji)
+    channelPreferences[ctx.channel.id]["negativeEmoji"] = str(negativeReaction.emoji)
     await asyncio.sleep(1)
     await negativeMessage.delete()
     sentMessages.append(await ctx.send("Mention all Roles who can participate!"))
@@ -307,15 +365,41 @@ async def sv(ctx):
     await ctx.channel.delete_messages(sentMessages)
     await embed(ctx)
     channelPreferences[ctx.channel.id]["votingEnabled"] = True
+    stateStore.save_preference(ctx.channel.id, channelPreferences[ctx.channel.id])
+    rescheduleChannel(ctx.channel.id)
 
 
 @client.command()
+@tracer.traced()
 async def gv(ctx):
     global channelPreferences
     await embed(ctx)
 
 
+@client.command()
+@tracer.traced()
+async def weights(ctx):
+    """Set per-role vote weights, e.g. ``!weights @Core 2 @Member 0.5``."""
+    if not ctx.author.guild_permissions.administrator:
+        await ctx.channel.send("You need to be an Admin to access this role!")
+        return
+    if ctx.channel.id not in channelPreferences:
+        await ctx.send("Setup Voting for this channel first with !sv")
+        return
+    roleWeights = {
+        role_id: float(weight)
+        for role_id, weight in weightRegex.findall(ctx.message.content)
+    }
+    if roleWeights:
+        channelPreferences[ctx.channel.id]["weights"] = roleWeights
+    else:
+        channelPreferences[ctx.channel.id].pop("weights", None)
+    stateStore.save_preference(ctx.channel.id, channelPreferences[ctx.channel.id])
+    await embed(ctx)
+
+
 @client.event
+@tracer.traced()
 async def on_message(message):
     global messageReactions, channelPreferences
     if message.author == client.user:
@@ -329,10 +413,13 @@ async def on_message(message):
         return
 
     messageReactions[message.id] = dict()
-    messageReactions[message.id]["startTime"] = datetime.now()
+    messageReactions[message.id]["startTime"] = datetime.datetime.now()
     messageReactions[message.id]["positiveEmoji"] = 0
     messageReactions[message.id]["negativeEmoji"] = 0
     messageReactions[message.id]["channelID"] = message.channel.id
+    channelVotes.setdefault(message.channel.id, set()).add(message.id)
+    stateStore.save_tally(message.id, messageReactions[message.id])
+    scheduleTimedVote(message.id)
     await message.add_reaction(channelPreferences[message.channel.id]["positiveEmoji"])
     await message.add_reaction(channelPreferences[message.channel.id]["negativeEmoji"])
 
@@ -340,130 +427,138 @@ async def on_message(message):
 
 
 @client.event
-async def on_reaction_add(reaction, user):
-    await on_reaction_change(reaction, user, "add")
+@tracer.traced()
+async def on_raw_reaction_add(payload):
+    await on_reaction_change(payload, "add")
 
 
 @client.event
-async def on_reaction_remove(reaction, user):
-    await on_reaction_change(reaction, user, "remove")
+@tracer.traced()
+async def on_raw_reaction_remove(payload):
+    await on_reaction_change(payload, "remove")
 
 
-async def on_reaction_change(reaction, user, action):
-    if user == client.user:
+async def on_reaction_change(payload, action):
+    if payload.user_id == client.user.id:
         return
     global channelPreferences, messageReactions
     preference = {}
     try:
-        preference = channelPreferences[reaction.message.channel.id]
+        preference = channelPreferences[payload.channel_id]
         newLol = preference["roles"]
-        messageChannel = messageReactions[reaction.message.id]
+        messageChannel = messageReactions[payload.message_id]
 
     except:
         return
-    if "isEnded" in messageReactions[reaction.message.id]:
-        await reaction.message.remove_reaction(reaction, user)
+    message = partial_message(client, payload)
+    user = discord.Object(id=payload.user_id)
+    if "isEnded" in messageReactions[payload.message_id]:
+        removeReaction(message, payload.emoji, user)
         return
     if preference["votingMethod"] == "Time":
-        if "startTime" not in messageReactions[reaction.message.id]:
-
-            messageReactions[reaction.message.id]["startTime"] = datetime.now()
+        if "startTime" not in messageReactions[payload.message_id]:
+            now = datetime.datetime.now()
+            messageReactions[payload.message_id]["startTime"] = now
+            stateStore.save_tally(
+                payload.message_id, messageReactions[payload.message_id]
+            )
         if hasTimePassed(
-            messageReactions[reaction.message.id]["startTime"], preference["time"]
+            messageReactions[payload.message_id]["startTime"], preference["time"]
         ):
-
-            messageReactions[reaction.message.id]["isEnded"] = True
-            messageReactions[reaction.message.id]["messageID"] = reaction.message.id
-            await sendToChannel(preference, messageReactions[reaction.message.id])
-            await reaction.message.remove_reaction(reaction, user)
+            await closeTimedVote(payload.message_id)
+            removeReaction(message, payload.emoji, user)
             return
 
-    if not common_member(preference["roles"], [role.id for role in user.roles]):
-        await reaction.message.remove_reaction(reaction, user)
-        return
-    if reaction.emoji == preference["positiveEmoji"]:
-        if action == "add":
-            await reaction.message.remove_reaction(preference["negativeEmoji"], user)
-        # messageReactions[reaction.message.id]["positiveEmoji"]=reaction.count;
-
-    elif reaction.emoji == preference["negativeEmoji"]:
-        if action == "add":
-            await reaction.message.remove_reaction(preference["positiveEmoji"], user)
-        # messageReactions[reaction.message.id]["negativeEmoji"]=reaction.count;
+    messageID = payload.message_id
+    emoji = str(payload.emoji)
+    if emoji == preference["positiveEmoji"]:
+        kind, otherEmoji = "positiveEmoji", preference["negativeEmoji"]
+    elif emoji == preference["negativeEmoji"]:
+        kind, otherEmoji = "negativeEmoji", preference["positiveEmoji"]
     else:
-        await reaction.message.remove_reaction(reaction, user)
+        kind, otherEmoji = None, None
 
-    for cuRe in reaction.message.reactions:
-        # -1 to remove bot's reaction
-        if cuRe.emoji == preference["positiveEmoji"]:
-            messageReactions[reaction.message.id]["positiveEmoji"] = cuRe.count - 1
-        if cuRe.emoji == preference["negativeEmoji"]:
-            messageReactions[reaction.message.id]["negativeEmoji"] = cuRe.count - 1
+    if action == "remove":
+        if kind is None or not untrack_vote(messageReactions[messageID], kind, user.id):
+            return
+    else:
+        eligibleRoles = eligible_role_ids(
+            roleIndex.for_guild(message.guild), user.id, preference["roles"]
+        )
+        if kind is None or not eligibleRoles:
+            removeReaction(message, payload.emoji, user)
+            return
+        removeReaction(message, otherEmoji, user)
+        if not track_vote(messageReactions[messageID], kind, user.id, eligibleRoles):
+            return
+    stateStore.save_tally(messageID, messageReactions[messageID])
 
     if preference["votingMethod"] == "Quorum":
-        # TODO Get total eligible Members
-        totalEligibleMembers = max(1, members(reaction, preference["roles"]))
-        positivePercent = (
-            100
-            * (messageReactions[reaction.message.id]["positiveEmoji"])
-            / totalEligibleMembers
-        )
-        negativePercent = (
-            100
-            * (messageReactions[reaction.message.id]["negativeEmoji"])
-            / totalEligibleMembers
+        totalEligibleMembers = roleIndex.for_guild(message.guild).count_any(
+            preference["roles"]
         )
+        threshold = preference.get("threshold")
+        if threshold is None:
+            threshold = preference["threshold"] = parsePercentage(
+                preference["percentage"]
+            )
+        if quorum_reached(
+            messageReactions[messageID], threshold, totalEligibleMembers
+        ):
+            messageReactions[messageID]["messageID"] = messageID
+            await sendToChannel(preference, messageReactions[messageID])
+            messageReactions[messageID]["isEnded"] = True
+            stateStore.save_tally(messageID, messageReactions[messageID])
 
-        preference["totalEligibleMembers"] = totalEligibleMembers
-        preference["negativePercent"] = negativePercent
 
-        if positivePercent >= int(preference["percentage"]) or negativePercent >= int(
-            preference["percentage"]
-        ):
-            messageReactions[reaction.message.id]["messageID"] = reaction.message.id
-            await sendToChannel(preference, messageReactions[reaction.message.id])
-            messageReactions[reaction.message.id]["isEnded"] = True
+def removeReaction(message, emoji, user):
+    outbox.submit(
+        ("reaction", message.channel.id),
+        lambda: message.remove_reaction(emoji, user),
+        REACTION_REMOVAL,
+    )
 
 
-@tasks.loop(seconds=1)
-async def slow_count():
-    await everyTwoHours()
+def parsePercentage(percentage):
+    return int(str(percentage).strip().rstrip("%"))
 
 
-slow_count.start()
+channelVotes = dict()
+# {"channelID": {messageIDs tracked for that channel}}
 
-# Tasks waala
-async def everyTwoHours():
-    try:
-        global messageReactions, channelPreferences
-        for messageID in messageReactions:
-            if (
-                "isEnded" in messageReactions[messageID]
-                or "channelID" not in messageReactions[messageID]
-                or "startTime" not in messageReactions[messageID]
-            ):
-                continue
-            if (
-                channelPreferences[messageReactions[messageID]["channelID"]][
-                    "votingMethod"
-                ]
-                != "Time"
-            ):
-                continue
-
-            if hasTimePassed(
-                messageReactions[messageID]["startTime"],
-                channelPreferences[messageReactions[messageID]["channelID"]]["time"],
-            ):
-                messageReactions[messageID]["isEnded"] = True
-                messageReactions[messageID]["messageID"] = messageID
-
-                await sendToChannel(
-                    channelPreferences[messageReactions[messageID]["channelID"]],
-                    messageReactions[messageID],
-                )
-    except Exception as e:
-        print(e)
+
+def scheduleTimedVote(messageID):
+    vote = messageReactions[messageID]
+    preference = channelPreferences.get(vote["channelID"], {})
+    if "isEnded" in vote or preference.get("votingMethod") != "Time":
+        voteScheduler.cancel(messageID)
+        return
+    deadline = voteDeadline(vote["startTime"], preference["time"])
+    voteScheduler.schedule(messageID, deadline)
+
+
+def rescheduleChannel(channelID):
+    for messageID in channelVotes.get(channelID, set()):
+        scheduleTimedVote(messageID)
+
+
+@tracer.traced()
+async def closeTimedVote(messageID):
+    vote = messageReactions.get(messageID)
+    if vote is None or "isEnded" in vote:
+        return
+    preference = channelPreferences.get(vote["channelID"], {})
+    if preference.get("votingMethod") != "Time":
+        return
+    voteScheduler.cancel(messageID)
+    channelVotes.get(vote["channelID"], set()).discard(messageID)
+    vote["isEnded"] = True
+    vote["messageID"] = messageID
+    stateStore.save_tally(messageID, vote)
+    await sendToChannel(preference, vote)
+
+
+voteScheduler = DeadlineScheduler(closeTimedVote)
 
 
 client.run(os.getenv("TOKEN"))
@@ -0,0 +1,232 @@
+import abc
+import bisect
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+# Seconds; tuned for requests and queries between 1ms and a few seconds.
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+Labels = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{{{}}}".format(",".join(pairs)) if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric(abc.ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, help_: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> Labels:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abc.abstractmethod
+    def samples(self) -> List[str]:
+        ...
+
+    def render(self) -> List[str]:
+        return [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ] + self.samples()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [
+            "{}{} {}".format(
+                self.name, _format_labels(self.labelnames, key), _format_value(value)
+            )
+            for key, value in sorted(self.values.items())
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [count per bucket (non-cumulative, +Inf last), sum].
+        self.values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="{}"'.format(_format_value(bound))
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        self.name, _format_labels(self.labelnames, key, le), cumulative
+                    )
+                )
+            labels = _format_labels(self.labelnames, key)
+            lines.append("{}_sum{} {}".format(self.name, labels, repr(total[0])))
+            lines.append("{}_count{} {}".format(self.name, labels, cumulative))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_: str, labelnames: Sequence[str] = ()):
+        return self.register(Counter(name, help_, labelnames))
+
+    def gauge(self, name: str, help_: str, labelnames: Sequence[str] = ()):
+        return self.register(Gauge(name, help_, labelnames))
+
+    def histogram(self, name: str, help_: str, labelnames: Sequence[str] = ()):
+        return self.register(Histogram(name, help_, labelnames))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Prometheus text exposition format.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = Registry()
+
+http_requests = registry.counter(
+    "vouch_http_requests_total",
+    "HTTP requests by route and status.",
+    ("method", "route", "status"),
+)
+http_latency = registry.histogram(
+    "vouch_http_request_duration_seconds",
+    "Time to the start of the response, by route.",
+    ("method", "route"),
+)
+db_query_latency = registry.histogram(
+    "vouch_db_query_duration_seconds",
+    "Time spent executing SQL statements, by statement type.",
+    ("statement",),
+)
+db_commit_latency = registry.histogram(
+    "vouch_db_commit_duration_seconds",
+    "Time to commit a session, including its final flush.",
+)
+loop_lag = registry.histogram(
+    "vouch_event_loop_lag_seconds",
+    "How late the event loop ran a timer it was asked to run on time.",
+)
+open_votes = registry.gauge("vouch_open_votes", "Votes that are not complete.")
+pool_size = registry.gauge("vouch_db_pool_size", "Configured connection pool size.")
+pool_checked_out = registry.gauge(
+    "vouch_db_pool_checked_out", "Connections currently in use."
+)
+pool_checked_in = registry.gauge(
+    "vouch_db_pool_checked_in", "Idle connections held by the pool."
+)
+pool_overflow = registry.gauge(
+    "vouch_db_pool_overflow", "Connections open beyond the pool size."
+)
+
+
+def _statement_type(statement: str) -> str:
+    words = statement.lstrip().split(None, 1)
+    return words[0].upper() if words else "UNKNOWN"
+
+
+def instrument_engine(engine: Engine):
+    """Time every statement on ``engine`` and every session commit."""
+
+    # The start time lives on the per-statement context: a statement that
+    # raises never reaches after_cursor_execute, and its context is dropped.
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        context._query_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        start = context._query_start
+        db_query_latency.observe(
+            time.perf_counter() - start, statement=_statement_type(statement)
+        )
+
+    @event.listens_for(Session, "before_commit")
+    def before_commit(session):
+        session.info["commit_start"] = time.perf_counter()
+
+    @event.listens_for(Session, "after_commit")
+    def after_commit(session):
+        start: Optional[float] = session.info.pop("commit_start", None)
+        if start is not None:
+            db_commit_latency.observe(time.perf_counter() - start)
+
+
+def update_pool(engine: Engine):
+    pool = engine.pool
+    pool_size.set(pool.size())
+    pool_checked_out.set(pool.checkedout())
+    pool_checked_in.set(pool.checkedin())
+    pool_overflow.set(max(0, pool.overflow()))
@@ -0,0 +1,253 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+logger = logging.getLogger(__name__)
+
+# Lower runs first when several routes have a token to spend.
+ROLE_GRANT = 0
+RESULT = 1
+REACTION_REMOVAL = 2
+REPLY = 3
+
+# (requests, per seconds) for each route kind. A route is a tuple whose
+# first element is its kind, e.g. ("reply", channel_id); every route gets
+# its own bucket. The values follow the limits Discord reports for these
+# endpoints so that discord.py rarely has to sleep on a 429 itself.
+DEFAULT_LIMITS: Dict[str, Tuple[int, float]] = {
+    "roles": (10, 10.0),
+    "reaction": (4, 1.0),
+    "reply": (5, 5.0),
+}
+FALLBACK_LIMIT = (5, 5.0)
+GLOBAL_LIMIT = (50, 1.0)
+
+Route = Tuple[Hashable, ...]
+Action = Callable[[], Awaitable[Any]]
+
+
+class TokenBucket:
+    def __init__(self, rate: int, per: float):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(
+            self.rate, self.tokens + (now - self.updated) * self.rate / self.per
+        )
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) * self.per / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class Outbox:
+    """Prioritized, rate-limited queue for outbound Discord REST calls.
+
+    Handlers ``submit`` a zero-argument coroutine function and return
+    immediately. The dispatcher runs queued actions in priority order,
+    spending one token from the action's route bucket and from the global
+    bucket, so a burst on one channel never stalls handlers or other
+    routes. ``coalesce`` folds repeated notices for the same key within
+    ``coalesce_window`` seconds into a single action. Actions run in the
+    context they were submitted from, so context variables set by the
+    calling handler still apply. ``close`` sends pending notices and runs
+    what is queued, role grants first, before stopping.
+    """
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, Tuple[int, float]]] = None,
+        concurrency: int = 4,
+        coalesce_window: float = 2.0,
+    ):
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.coalesce_window = coalesce_window
+        self._queues: Dict[
+            Route, List[Tuple[int, int, float, contextvars.Context, Action]]
+        ] = {}
+        self._buckets: Dict[Route, TokenBucket] = {}
+        self._global = TokenBucket(*GLOBAL_LIMIT)
+        self._notices: Dict[Hashable, List[Any]] = {}
+        self._flushes: Dict[Hashable, Tuple[asyncio.TimerHandle, Callable]] = {}
+        self._sending: Set[asyncio.Future] = set()
+        self._counter = itertools.count()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def submit(self, route: Route, action: Action, priority: int = REPLY):
+        entry = (
+            priority,
+            next(self._counter),
+            time.monotonic(),
+            contextvars.copy_context(),
+            action,
+        )
+        heapq.heappush(self._queues.setdefault(route, []), entry)
+        self._wakeup.set()
+
+    def coalesce(
+        self,
+        key: Hashable,
+        item: Any,
+        route: Route,
+        send: Callable[[List[Any]], Awaitable[Any]],
+        priority: int = REPLY,
+    ):
+        """Collect ``item`` under ``key`` and later call ``send(items)`` once."""
+        items = self._notices.get(key)
+        if items is not None:
+            items.append(item)
+            self.coalesced += 1
+            return
+        items = self._notices[key] = [item]
+
+        def flush():
+            del self._notices[key]
+            del self._flushes[key]
+            self.submit(route, lambda: send(items), priority)
+
+        handle = asyncio.get_event_loop().call_later(self.coalesce_window, flush)
+        self._flushes[key] = (handle, flush)
+
+    def stats(self) -> dict:
+        depth_by_priority: Dict[int, int] = {}
+        for queue in self._queues.values():
+            for priority, *_ in queue:
+                depth_by_priority[priority] = depth_by_priority.get(priority, 0) + 1
+        return {
+            "depth": sum(depth_by_priority.values()),
+            "depth_by_priority": depth_by_priority,
+            "pending_notices": len(self._notices),
+            "sent": self.sent,
+            "failed": self.failed,
+            "coalesced": self.coalesced,
+            "wait_total": self.wait_total,
+            "wait_max": self.wait_max,
+            "wait_mean": self.wait_total / max(1, self.sent + self.failed),
+        }
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def close(self, timeout: float = 10.0):
+        """Run everything queued, for at most ``timeout`` seconds, then stop."""
+        for handle, flush in list(self._flushes.values()):
+            handle.cancel()
+            flush()
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(self._drain(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(
+                    "Outbox closed with %d actions still queued: %s",
+                    len(self),
+                    self.stats()["depth_by_priority"],
+                )
+        self.stop()
+
+    async def _drain(self):
+        # Sleep first: handlers woken by the last vouch batch may still be
+        # about to submit their role grants and replies.
+        while True:
+            await asyncio.sleep(0.05)
+            if not len(self) and not self._sending:
+                return
+
+    def _bucket(self, route: Route) -> TokenBucket:
+        bucket = self._buckets.get(route)
+        if bucket is None:
+            rate, per = self.limits.get(route[0], FALLBACK_LIMIT)
+            bucket = self._buckets[route] = TokenBucket(rate, per)
+        return bucket
+
+    def _next(self, now: float) -> Tuple[Optional[Route], Optional[float]]:
+        """The ready route with the most urgent head, else the shortest wait."""
+        best: Optional[Route] = None
+        wait: Optional[float] = None
+        for route, queue in self._queues.items():
+            delay = self._bucket(route).delay(now)
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+            elif best is None or queue[0] < self._queues[best][0]:
+                best = route
+        if best is not None:
+            delay = self._global.delay(now)
+            if delay > 0:
+                return None, delay
+        return best, wait
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            route, wait = self._next(now)
+            if route is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._slots.acquire()
+            queue = self._queues[route]
+            _, _, queued_at, context, action = heapq.heappop(queue)
+            if not queue:
+                del self._queues[route]
+            now = time.monotonic()
+            self._bucket(route).take(now)
+            self._global.take(now)
+            waited = now - queued_at
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            sending = context.run(asyncio.ensure_future, self._send(action))
+            self._sending.add(sending)
+            sending.add_done_callback(self._sending.discard)
+
+    async def _send(self, action: Action):
+        try:
+            await action()
+            self.sent += 1
+        except Exception:
+            self.failed += 1
+            logger.exception("Outbox action failed")
+        finally:
+            self._slots.release()
@@ -0,0 +1,195 @@
+import asyncio
+import collections
+import datetime
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Counter, Deque, Optional
+
+from discord.ext import commands
+
+from . import metrics
+from .schemas import BotSettings
+from .tracing import percentiles
+
+logger = logging.getLogger(__name__)
+
+
+class LoopMonitor:
+    """Measures event loop lag and reports what blocks the loop.
+
+    A task sleeps ``interval`` seconds at a time and records how late it
+    wakes up. A watchdog thread checks that the task keeps waking; once it
+    has been silent for ``threshold`` seconds the loop is stuck in a
+    callback, and the thread logs the running task and the loop thread's
+    stack while it is still stuck.
+    """
+
+    def __init__(
+        self, interval: float = 0.1, threshold: float = 0.25, reservoir_size: int = 3000
+    ):
+        self.interval = interval
+        self.threshold = threshold
+        self.samples: Deque[float] = collections.deque(maxlen=reservoir_size)
+        self.stalls = 0
+        self._heartbeat = time.monotonic()
+        self._reported: Optional[float] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopped = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        self._loop = asyncio.get_event_loop()
+        self._thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.ensure_future(self._run())
+        self._stopped.clear()
+        self._watchdog = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True
+        )
+        self._watchdog.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def summary(self) -> dict:
+        summary = percentiles(self.samples)
+        summary["stalls"] = self.stalls
+        return summary
+
+    async def _run(self):
+        try:
+            while True:
+                start = time.monotonic()
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                self._heartbeat = now
+                lag = max(0.0, now - start - self.interval)
+                self.samples.append(lag)
+                metrics.loop_lag.observe(lag)
+                if lag >= self.threshold:
+                    self.stalls += 1
+        finally:
+            # discord.py cancels every task when the client shuts down.
+            self._stopped.set()
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if stalled < self.threshold or self._reported == heartbeat:
+                continue
+            # Once per stall: the heartbeat only moves when the loop does.
+            self._reported = heartbeat
+            frame = sys._current_frames().get(self._thread_id)
+            task = asyncio.current_task(self._loop)
+            logger.warning(
+                "Event loop blocked for %.3fs so far in %s\n%s",
+                stalled,
+                task.get_coro() if task is not None else "a callback",
+                "".join(traceback.format_stack(frame)) if frame is not None else "",
+            )
+
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(
+            "{} ({}:{})".format(
+                code.co_name, os.path.basename(code.co_filename), code.co_firstlineno
+            )
+        )
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """Samples one thread's stack on a timer from a background thread.
+
+    Stacks are written in the collapsed format ``root;...;leaf count`` that
+    flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.running = False
+
+    def _sample(self, thread_id: int, seconds: float, path: str) -> int:
+        stacks: Counter[str] = collections.Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                stacks[_collapse(frame)] += 1
+            time.sleep(self.interval)
+        with open(path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+        return sum(stacks.values())
+
+    async def profile(self, seconds: float, path: str) -> int:
+        """Sample the calling thread (the loop's) for ``seconds`` into ``path``."""
+        if self.running:
+            raise RuntimeError("A profile is already running")
+        self.running = True
+        try:
+            return await asyncio.get_event_loop().run_in_executor(
+                None, self._sample, threading.get_ident(), seconds, path
+            )
+        finally:
+            self.running = False
+
+
+def attach(client: commands.Bot, settings: BotSettings, service: str):
+    """Run a ``LoopMonitor`` on ``client``'s loop and add admin commands.
+
+    ``!lag`` replies with the loop lag percentiles, ``!profile [seconds]``
+    samples the loop thread into ``settings.profile_dir``.
+    """
+    monitor = LoopMonitor(
+        interval=settings.loop_lag_interval, threshold=settings.loop_lag_threshold
+    )
+    profiler = SamplingProfiler(interval=settings.profile_interval)
+
+    async def on_ready():
+        monitor.start()
+
+    async def lag(ctx: commands.Context):
+        if not ctx.author.guild_permissions.administrator:
+            return
+        await ctx.send(
+            " ".join("{}={:g}".format(k, v) for k, v in monitor.summary().items())
+        )
+
+    async def profile(ctx: commands.Context, seconds: float = 10.0):
+        if not ctx.author.guild_permissions.administrator:
+            return
+        if profiler.running:
+            await ctx.send("A profile is already running.")
+            return
+        seconds = min(max(seconds, 0.0), settings.profile_max_seconds)
+        path = os.path.join(
+            settings.profile_dir,
+            "profile-{}-{}.folded".format(
+                service, datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+            ),
+        )
+        await ctx.send("Profiling for {:g}s.".format(seconds))
+        samples = await profiler.profile(seconds, path)
+        await ctx.send("Wrote {} samples to {}".format(samples, path))
+
+    client.add_listener(on_ready, "on_ready")
+    client.add_command(commands.Command(lag, name="lag"))
+    client.add_command(commands.Command(profile, name="profile"))
+    return monitor
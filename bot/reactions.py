@@ -0,0 +1,112 @@
+from typing import Dict, Iterable, List, Optional, Set
+
+import discord
+
+from .roles import GuildRoleIndex
+from .schemas import BotSettings
+
+
+def message_cache_size(settings: BotSettings) -> Optional[int]:
+    """The ``max_messages`` to give the client; 0 disables the message cache.
+
+    discord.py treats ``None`` as "no cache" and silently replaces 0 with its
+    default of 1000.
+    """
+    return settings.max_messages or None
+
+
+def partial_message(
+    client: discord.Client, payload: discord.RawReactionActionEvent
+) -> discord.PartialMessage:
+    """A message handle for a raw reaction that needs no fetch or cache hit."""
+    channel = client.get_channel(payload.channel_id)
+    return channel.get_partial_message(payload.message_id)
+
+
+async def resolve_member(
+    client: discord.Client, payload: discord.RawReactionActionEvent
+) -> Optional[discord.Member]:
+    """The reacting member; only remove events need the cache or a fetch."""
+    if payload.member is not None:
+        return payload.member
+    guild = client.get_guild(payload.guild_id)
+    if guild is None:
+        return None
+    member = guild.get_member(payload.user_id)
+    if member is None:
+        try:
+            member = await guild.fetch_member(payload.user_id)
+        except discord.NotFound:
+            return None
+    return member
+
+
+async def reacting_user_ids(message: discord.Message, emoji: str) -> Set[int]:
+    """Ids of the users who reacted with ``emoji``, streamed page by page."""
+    for reaction in message.reactions:
+        if str(reaction.emoji) == emoji:
+            return {user.id async for user in reaction.users()}
+    return set()
+
+
+def weighted_tally(
+    voters: Set[int],
+    roles: Iterable[int],
+    weights: Dict[str, float],
+    index: GuildRoleIndex,
+) -> float:
+    """Each voter counts once, at the weight of their heaviest eligible role."""
+    remaining = set(voters)
+    total = 0
+    for role_id in sorted(roles, key=lambda r: weights.get(str(r), 1), reverse=True):
+        counted = remaining & index.members_with(role_id)
+        total += weights.get(str(role_id), 1) * len(counted)
+        remaining -= counted
+    return total
+
+
+def eligible_role_ids(
+    index: GuildRoleIndex, user_id: int, role_ids: Iterable[int]
+) -> List[int]:
+    """The configured roles ``user_id`` holds; empty if they may not vote."""
+    return [role_id for role_id in role_ids if index.has_role(user_id, role_id)]
+
+
+def track_vote(tally: dict, kind: str, user_id: int, role_ids: Iterable[int]) -> bool:
+    """Count one eligible reaction; returns False if it was already counted.
+
+    ``tally`` is a ``bot.main`` message tally. ``kind`` is "positiveEmoji"
+    or "negativeEmoji"; per-role counts are kept under "roleCounts" and the
+    roles each voter was counted for under "voters".
+    """
+    voters = tally.setdefault("voters", {}).setdefault(kind, {})
+    if str(user_id) in voters:
+        return False
+    role_ids = list(role_ids)
+    voters[str(user_id)] = role_ids
+    tally[kind] = tally.get(kind, 0) + 1
+    role_counts = tally.setdefault("roleCounts", {}).setdefault(kind, {})
+    for role_id in role_ids:
+        role_counts[str(role_id)] = role_counts.get(str(role_id), 0) + 1
+    return True
+
+
+def untrack_vote(tally: dict, kind: str, user_id: int) -> bool:
+    """Uncount a reaction; returns False if it was never counted."""
+    role_ids = tally.get("voters", {}).get(kind, {}).pop(str(user_id), None)
+    if role_ids is None:
+        return False
+    tally[kind] -= 1
+    role_counts = tally["roleCounts"][kind]
+    for role_id in role_ids:
+        role_counts[str(role_id)] -= 1
+    return True
+
+
+def quorum_reached(tally: dict, threshold: float, eligible: int) -> bool:
+    """Whether either side has ``threshold`` percent of ``eligible`` members."""
+    eligible = max(1, eligible)
+    return any(
+        100 * tally.get(kind, 0) >= threshold * eligible
+        for kind in ("positiveEmoji", "negativeEmoji")
+    )
@@ -0,0 +1,180 @@
+import asyncio
+from typing import Dict, FrozenSet, Iterable, Optional, Set
+
+import discord
+from discord.ext import commands
+
+
+def _role_ids(member: discord.Member) -> Set[int]:
+    return {role.id for role in member.roles if not role.is_default()}
+
+
+class GuildRoleIndex:
+    """Role membership for one guild, kept current from gateway events."""
+
+    def __init__(self, guild: discord.Guild):
+        self.guild_id = guild.id
+        self.members_by_role: Dict[int, Set[int]] = {}
+        self.roles_by_member: Dict[int, Set[int]] = {}
+        self.role_ids_by_name: Dict[str, int] = {}
+        self._union_counts: Dict[FrozenSet[int], int] = {}
+        for role in guild.roles:
+            self.add_role(role)
+        for member in guild.members:
+            self.update_member(member)
+
+    def add_role(self, role: discord.Role):
+        if role.is_default():
+            return
+        self.members_by_role.setdefault(role.id, set())
+        self.role_ids_by_name[role.name] = role.id
+
+    def rename_role(self, before: discord.Role, after: discord.Role):
+        if self.role_ids_by_name.get(before.name) == before.id:
+            del self.role_ids_by_name[before.name]
+        self.add_role(after)
+
+    def remove_role(self, role: discord.Role):
+        for member_id in self.members_by_role.pop(role.id, set()):
+            self.roles_by_member[member_id].discard(role.id)
+        if self.role_ids_by_name.get(role.name) == role.id:
+            del self.role_ids_by_name[role.name]
+        self._union_counts.clear()
+
+    def update_member(self, member: discord.Member):
+        new = _role_ids(member)
+        old = self.roles_by_member.get(member.id, set())
+        if new == old and member.id in self.roles_by_member:
+            return
+        for role_id in old - new:
+            self.members_by_role.get(role_id, set()).discard(member.id)
+        for role_id in new - old:
+            self.members_by_role.setdefault(role_id, set()).add(member.id)
+        self.roles_by_member[member.id] = new
+        self._union_counts.clear()
+
+    def remove_member(self, member_id: int):
+        for role_id in self.roles_by_member.pop(member_id, set()):
+            self.members_by_role.get(role_id, set()).discard(member_id)
+        self._union_counts.clear()
+
+    def role_id(self, name: str) -> Optional[int]:
+        return self.role_ids_by_name.get(name)
+
+    def has_role(self, member_id: int, role_id: Optional[int]) -> bool:
+        return role_id in self.roles_by_member.get(member_id, ())
+
+    def has_any_role(self, member_id: int, role_ids: Iterable[int]) -> bool:
+        return not self.roles_by_member.get(member_id, set()).isdisjoint(role_ids)
+
+    def members_with(self, role_id: int) -> Set[int]:
+        return self.members_by_role.get(role_id, set())
+
+    def count(self, role_id: int) -> int:
+        return len(self.members_by_role.get(role_id, ()))
+
+    def count_any(self, role_ids: Iterable[int]) -> int:
+        key = frozenset(role_ids)
+        if key not in self._union_counts:
+            members: Set[int] = set()
+            for role_id in key:
+                members |= self.members_by_role.get(role_id, set())
+            self._union_counts[key] = len(members)
+        return self._union_counts[key]
+
+
+class RoleIndex:
+    """Role indexes for every guild a client can see.
+
+    ``attach`` registers the listeners that build each guild's index on
+    ready and keep it current as members and roles change.
+    """
+
+    def __init__(self):
+        self.guilds: Dict[int, GuildRoleIndex] = {}
+
+    def __getitem__(self, guild_id: int) -> GuildRoleIndex:
+        return self.guilds[guild_id]
+
+    def get(self, guild_id: int) -> Optional[GuildRoleIndex]:
+        return self.guilds.get(guild_id)
+
+    def build(self, guild: discord.Guild) -> GuildRoleIndex:
+        self.guilds[guild.id] = GuildRoleIndex(guild)
+        return self.guilds[guild.id]
+
+    def for_guild(self, guild: discord.Guild) -> GuildRoleIndex:
+        index = self.get(guild.id)
+        if index is None:
+            index = self.build(guild)
+        return index
+
+    async def _chunk(self, guild: discord.Guild):
+        # With lazy chunking the index starts from whichever members are
+        # cached and is rebuilt once the full member list arrives.
+        await guild.chunk()
+        self.build(guild)
+
+    def member_has_role(self, member: discord.Member, role_name: str) -> bool:
+        index = self.get(member.guild.id)
+        if index is None or member.id not in index.roles_by_member:
+            return role_name in [role.name for role in member.roles]
+        return index.has_role(member.id, index.role_id(role_name))
+
+    def attach(self, client: commands.Bot):
+        async def on_ready():
+            for guild in client.guilds:
+                self.build(guild)
+                if not guild.chunked:
+                    asyncio.ensure_future(self._chunk(guild))
+
+        async def on_guild_join(guild):
+            self.build(guild)
+            if not guild.chunked:
+                asyncio.ensure_future(self._chunk(guild))
+
+        async def on_guild_remove(guild):
+            self.guilds.pop(guild.id, None)
+
+        async def on_member_join(member):
+            index = self.get(member.guild.id)
+            if index is not None:
+                index.update_member(member)
+
+        async def on_member_update(before, after):
+            index = self.get(after.guild.id)
+            if index is not None:
+                index.update_member(after)
+
+        async def on_member_remove(member):
+            index = self.get(member.guild.id)
+            if index is not None:
+                index.remove_member(member.id)
+
+        async def on_guild_role_create(role):
+            index = self.get(role.guild.id)
+            if index is not None:
+                index.add_role(role)
+
+        async def on_guild_role_update(before, after):
+            index = self.get(after.guild.id)
+            if index is not None:
+                index.rename_role(before, after)
+
+        async def on_guild_role_delete(role):
+            index = self.get(role.guild.id)
+            if index is not None:
+                index.remove_role(role)
+
+        for listener in (
+            on_ready,
+            on_guild_join,
+            on_guild_remove,
+            on_member_join,
+            on_member_update,
+            on_member_remove,
+            on_guild_role_create,
+            on_guild_role_update,
+            on_guild_role_delete,
+        ):
+            client.add_listener(listener, listener.__name__)
@@ -0,0 +1,96 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineScheduler:
+    """Calls ``callback(key)`` once each key's deadline has passed.
+
+    Deadlines sit in a min-heap and the runner sleeps until the earliest
+    one, so the cost is per due key rather than per tracked key. Cancelled
+    and rescheduled entries are dropped lazily when they reach the top.
+    """
+
+    def __init__(self, callback: Callable[[Hashable], Awaitable[None]]):
+        self.callback = callback
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._deadlines: Dict[Hashable, float] = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def schedule(self, key: Hashable, deadline: datetime.datetime):
+        timestamp = deadline.timestamp()
+        self._deadlines[key] = timestamp
+        heapq.heappush(self._heap, (timestamp, next(self._counter), key))
+        if self._heap[0][0] == timestamp:
+            self._wakeup.set()
+        self._compact()
+
+    def cancel(self, key: Hashable):
+        self._deadlines.pop(key, None)
+        self._compact()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _compact(self):
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [
+                entry
+                for entry in self._heap
+                if self._deadlines.get(entry[2]) == entry[0]
+            ]
+            heapq.heapify(self._heap)
+
+    def _pop_due(self, now: float) -> List[Hashable]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            timestamp, _, key = heapq.heappop(self._heap)
+            if self._deadlines.get(key) == timestamp:
+                del self._deadlines[key]
+                due.append(key)
+        return due
+
+    async def _sleep(self):
+        while self._heap:
+            timestamp, _, key = self._heap[0]
+            if self._deadlines.get(key) == timestamp:
+                break
+            heapq.heappop(self._heap)
+        timeout = None
+        if self._heap:
+            timeout = self._heap[0][0] - datetime.datetime.now().timestamp()
+            if timeout <= 0:
+                return
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        while True:
+            await self._sleep()
+            self._wakeup.clear()
+            for key in self._pop_due(datetime.datetime.now().timestamp()):
+                try:
+                    await self.callback(key)
+                except Exception:
+                    logger.exception("Deadline callback failed for %r", key)
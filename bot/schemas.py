@@ -1,5 +1,5 @@
 import datetime
-from typing import List, Optional
+from typing import List, Literal, Optional
 from pydantic import BaseSettings, BaseModel, validator
 
 
@@ -14,6 +14,49 @@ class VouchConfiguration(BaseSettings):
     voter_role: str
 
 
+class BotSettings(BaseSettings):
+
+    backend_mode: Literal["http", "embedded"] = "http"
+    backend_serve_http: bool = False
+    backend_http_host: str = "127.0.0.1"
+    backend_http_port: int = 8000
+    backend_url: str = "http://localhost:8000"
+    backend_connection_limit: int = 10
+    backend_keepalive_timeout: float = 30.0
+    backend_timeout: float = 10.0
+    backend_etag_cache_size: int = 1000
+    vote_cache_size: int = 10000
+    vote_cache_negative_ttl: float = 3600.0
+    state_flush_interval: float = 1.0
+    max_messages: int = 1000
+    gateway_profile: Literal["full", "lean"] = "full"
+    chunk_guilds_at_startup: bool = True
+    outbox_concurrency: int = 4
+    outbox_coalesce_window: float = 2.0
+    outbox_close_timeout: float = 10.0
+    vouch_batch_window: float = 0.25
+    vouch_batch_max_size: int = 100
+    member_sync_batch_size: int = 500
+    trace_sample_rate: float = 0.01
+    trace_file: Optional[str] = None
+    trace_file_max_bytes: int = 10_000_000
+    trace_file_backups: int = 3
+    trace_exporter: Optional[str] = None
+    loop_lag_interval: float = 0.1
+    loop_lag_threshold: float = 0.25
+    profile_interval: float = 0.005
+    profile_max_seconds: float = 120.0
+    profile_dir: str = "."
+
+    class Config:
+        env_file = ".env"
+
+
+# The ``from_orm`` classmethods below read trusted rows from ``bot.db`` and
+# use ``construct`` to skip validation. Datetimes stay datetimes until the
+# JSON encoder writes them.
+
+
 class MemberBase(BaseModel):
     discord_id: str
     discord_name: str
@@ -22,14 +65,18 @@ class MemberBase(BaseModel):
 
     @classmethod
     def from_orm(cls, db_model):
-        return cls(
+        return cls.construct(
             discord_id=db_model.discord_id,
             discord_name=db_model.discord_name,
-            is_vouched_for=db_model.is_vouched_for,
-            is_voter=db_model.is_voter,
+            is_vouched_for=bool(db_model.is_vouched_for),
+            is_voter=bool(db_model.is_voter),
         )
 
 
+class MembersBulk(BaseModel):
+    members: List[MemberBase]
+
+
 class VoteBase(BaseModel):
     message_id: str
     on_behalf_of_id: str
@@ -57,24 +104,17 @@ class VoteBase(BaseModel):
 
     @classmethod
     def from_orm(cls, db_model):
-        return cls(
+        return cls.construct(
             message_id=db_model.message_id,
             on_behalf_of_id=db_model.on_behalf_of_id,
             start_time=db_model.start_time,
             days=(db_model.end_time - db_model.start_time).days,
             vouches_required=db_model.vouches_required,
+            votes=db_model.votes or 0,
             message_text=db_model.message_text,
-            complete=db_model.complete,
+            complete=bool(db_model.complete),
         )
 
-    def dict(self, as_datetime=False, **kwargs):
-        output = super().dict(**kwargs)
-        for k, v in output.items():
-            if isinstance(v, datetime.datetime) and not as_datetime:
-                # datetime: "2022-04-16T06:43:56+00:00"
-                output[k] = v.isoformat()
-        return output
-
 
 class VouchEventBase(BaseModel):
     vote_id: str
@@ -82,12 +122,32 @@ class VouchEventBase(BaseModel):
 
     @classmethod
     def from_orm(cls, db_model):
-        return cls(
+        return cls.construct(
             vote_id=db_model.vote_id,
             voucher_id=db_model.voucher_id,
         )
 
 
+class VouchEventAction(VouchEventBase):
+    action: Literal["add", "remove"] = "add"
+
+
+class VouchEventResult(VouchEventAction):
+    # Whether the event changed anything; replays and unknown removals don't.
+    applied: bool
+    # Set on the one event whose batch completed its vote.
+    completed: bool = False
+
+
+class VouchEventBatch(BaseModel):
+    events: List[VouchEventAction]
+
+
+class VouchEventBatchResult(BaseModel):
+    events: List[VouchEventResult]
+    votes: List[VoteBase]
+
+
 class Vote(VoteBase):
     on_behalf_of: MemberBase
     vouches: List[VouchEventBase]
@@ -98,14 +158,15 @@ class Vote(VoteBase):
         vouches_db = db_model.vouches
         on_behalf_of = MemberBase.from_orm(on_behalf_of_db)
         vouches = [VouchEventBase.from_orm(vouch) for vouch in vouches_db]
-        return cls(
+        return cls.construct(
             message_id=db_model.message_id,
             on_behalf_of_id=db_model.on_behalf_of_id,
             start_time=db_model.start_time,
             days=(db_model.end_time - db_model.start_time).days,
             vouches_required=db_model.vouches_required,
+            votes=db_model.votes or 0,
             message_text=db_model.message_text,
-            complete=db_model.complete,
+            complete=bool(db_model.complete),
             on_behalf_of=on_behalf_of,
             vouches=vouches,
         )
@@ -116,7 +177,7 @@ class VouchEvent(VouchEventBase):
 
     @classmethod
     def from_orm(cls, db_model):
-        return cls(
+        return cls.construct(
             vote_id=db_model.vote_id,
             voucher_id=db_model.voucher_id,
             vote=VoteBase.from_orm(db_model.vote),
@@ -128,18 +189,24 @@ class Member(MemberBase):
 
     @classmethod
     def from_orm(cls, db_model):
-        return cls(
+        return cls.construct(
             discord_id=db_model.discord_id,
             discord_name=db_model.discord_name,
-            is_vouched_for=db_model.is_vouched_for,
-            is_voter=db_model.is_voter,
+            is_vouched_for=bool(db_model.is_vouched_for),
+            is_voter=bool(db_model.is_voter),
             votes=[Vote.from_orm(vote) for vote in db_model.votes],
         )
 
 
 class Status(BaseModel):
     alive: bool = True
+    db_latency_ms: Optional[float] = None
 
 
 class VotesResponse(BaseModel):
     votes: List[Vote]
+
+
+class VotesPage(BaseModel):
+    votes: List[Vote]
+    next_cursor: Optional[str] = None
@@ -1,114 +1,307 @@
-from fastapi import Depends, FastAPI, HTTPException
-from sqlalchemy.orm import Session
+import base64
+import datetime
+import json
+import time
+from typing import Optional, Tuple
+
+import orjson
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
 
 
 from .schemas import (
     Member,
     MemberBase,
+    MembersBulk,
     Status,
     Vote,
+    VotesPage,
     VotesResponse,
     VouchEvent,
     VoteBase,
     VouchEventBase,
+    VouchEventBatch,
+    VouchEventBatchResult,
+    VouchEventResult,
 )
+from . import metrics
 from .db import (
-    Base,
     SessionLocal,
     engine,
+    init_db,
+    ping,
+    count_open_votes,
     get_member_by_id,
+    get_member_version,
     get_vote_by_id,
-    get_current_votes,
+    get_vote_version,
+    get_existing_vote_version,
     create_member,
+    upsert_members,
     create_vote,
-    create_vouch_event,
     delete_vouch_event,
+    apply_vouch_events,
     get_vouch_event_by_ids,
-    complete_vote,
     get_existing_vote_by_discord_id,
+    cast_vouch,
+    sweep_votes,
+    stream_votes,
 )
 
-Base.metadata.create_all(bind=engine)
+async def get_db():
+    async with SessionLocal() as db:
+        yield db
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+app = FastAPI(default_response_class=ORJSONResponse)
+metrics.instrument_engine(engine.sync_engine)
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - start
+    # The route template keeps label cardinality down, e.g. /votes/{message_id}.
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    metrics.http_latency.observe(elapsed, method=request.method, route=path)
+    metrics.http_requests.inc(
+        method=request.method, route=path, status=response.status_code
+    )
+    return response
+
+
+def model_response(
+    model: BaseModel, headers: Optional[dict] = None
+) -> ORJSONResponse:
+    """Encode a model built by ``from_orm`` without revalidating it.
 
+    Returning a response directly skips FastAPI's ``response_model``
+    validation; the ``response_model`` declarations still document the API.
+    """
+    return ORJSONResponse(model.dict(), headers=headers)
 
-app = FastAPI()
+
+@app.on_event("startup")
+async def startup():
+    await init_db()
 
 
 @app.get("/status", response_model=Status)
-async def status():
-    return Status()
+async def status(db: AsyncSession = Depends(get_db)):
+    start = time.perf_counter()
+    try:
+        await ping(db)
+    except Exception:
+        return Status(alive=False)
+    return Status(db_latency_ms=1000 * (time.perf_counter() - start))
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(db: AsyncSession = Depends(get_db)):
+    metrics.open_votes.set(await count_open_votes(db))
+    metrics.update_pool(engine.sync_engine)
+    return PlainTextResponse(
+        metrics.registry.render(), media_type=metrics.CONTENT_TYPE
+    )
+
+
+def etag(*parts) -> str:
+    return '"{}"'.format("-".join(str(part) for part in parts))
+
+
+def not_modified(if_none_match: Optional[str], tag: str) -> Optional[Response]:
+    """A 304 for ``tag`` if the client already holds it, else None."""
+    if if_none_match is None:
+        return None
+    tags = [t.strip() for t in if_none_match.split(",")]
+    if "*" in tags or tag in tags or "W/" + tag in tags:
+        return Response(status_code=304, headers={"ETag": tag})
+    return None
+
+
+def member_etag(discord_id, version, n_votes, vote_versions) -> str:
+    return etag("member", discord_id, version, n_votes, vote_versions)
+
+
+def vote_etag(message_id, version, member_version) -> str:
+    return etag("vote", message_id, version, member_version)
 
 
 @app.get("/members/{discord_id}", response_model=Member)
-async def get_member(discord_id: str, db: Session = Depends(get_db)):
-    db_member = get_member_by_id(db, discord_id)
+async def get_member(
+    discord_id: str,
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+):
+    versions = await get_member_version(db, discord_id)
+    if versions is not None:
+        cached = not_modified(if_none_match, member_etag(discord_id, *versions))
+        if cached is not None:
+            return cached
+    db_member = await get_member_by_id(db, discord_id)
     if db_member is None:
         raise HTTPException(
             status_code=400, detail="Member with id {} not found".format(discord_id)
         )
-    return Member.from_orm(db_member)
+    tag = member_etag(
+        discord_id,
+        db_member.version,
+        len(db_member.votes),
+        sum(vote.version for vote in db_member.votes),
+    )
+    return model_response(Member.from_orm(db_member), headers={"ETag": tag})
 
 
 @app.post("/members", response_model=Member)
-async def add_member(member: MemberBase, db: Session = Depends(get_db)):
-    db_member = get_member_by_id(db, member.discord_id)
+async def add_member(member: MemberBase, db: AsyncSession = Depends(get_db)):
+    db_member = await get_member_by_id(db, member.discord_id)
     if db_member:
         raise HTTPException(
             status_code=400,
             detail="Member for {} already exists".format(member.discord_id),
         )
-    db_member = create_member(db, member)
-    return Member.from_orm(db_member)
+    db_member = await create_member(db, member)
+    return model_response(Member.from_orm(db_member))
+
+
+@app.put("/members", response_model=MemberBase)
+async def put_member(member: MemberBase, db: AsyncSession = Depends(get_db)):
+    await upsert_members(db, [member])
+    return member
+
+
+@app.post("/members/bulk", response_model=Status)
+async def put_members(bulk: MembersBulk, db: AsyncSession = Depends(get_db)):
+    await upsert_members(db, bulk.members)
+    return Status()
 
 
 @app.get("/votes/{message_id}", response_model=Vote)
-async def get_vote(message_id: str, db: Session = Depends(get_db)):
-    db_vote = get_vote_by_id(db, message_id)
+async def get_vote(
+    message_id: str,
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+):
+    versions = await get_vote_version(db, message_id)
+    if versions is not None:
+        cached = not_modified(if_none_match, vote_etag(message_id, *versions))
+        if cached is not None:
+            return cached
+    db_vote = await get_vote_by_id(db, message_id)
     if db_vote is None:
         raise HTTPException(
             status_code=400,
             detail="Vote for message with id {} not found".format(message_id),
         )
-    return Vote.from_orm(db_vote)
+    tag = vote_etag(message_id, db_vote.version, db_vote.on_behalf_of.version)
+    return model_response(Vote.from_orm(db_vote), headers={"ETag": tag})
+
+
+def encode_cursor(db_vote) -> str:
+    raw = json.dumps([db_vote.start_time.isoformat(), db_vote.message_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime.datetime, str]:
+    try:
+        start_time, message_id = json.loads(base64.urlsafe_b64decode(cursor))
+        return datetime.datetime.fromisoformat(start_time), str(message_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor {}".format(cursor))
+
+
+@app.get("/votes", response_model=VotesPage)
+async def list_votes(
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    complete: Optional[bool] = None,
+    failed: Optional[bool] = None,
+    successful: Optional[bool] = None,
+    on_behalf_of_id: Optional[str] = None,
+    start_after: Optional[datetime.datetime] = None,
+    start_before: Optional[datetime.datetime] = None,
+):
+    after = decode_cursor(cursor) if cursor else None
+
+    async def body():
+        # The stream outlives this handler, so it gets its own session
+        # rather than one from get_db, whose cleanup may run first.
+        async with SessionLocal() as db:
+            # One extra row tells us whether there is a next page.
+            db_votes = await stream_votes(
+                db,
+                limit + 1,
+                after=after,
+                complete=complete,
+                failed=failed,
+                successful=successful,
+                on_behalf_of_id=on_behalf_of_id,
+                start_after=start_after,
+                start_before=start_before,
+            )
+            yield '{"votes":['
+            count = 0
+            last_vote = None
+            next_cursor = None
+            async for db_vote in db_votes:
+                if count == limit:
+                    next_cursor = encode_cursor(last_vote)
+                    break
+                if count:
+                    yield ","
+                yield orjson.dumps(Vote.from_orm(db_vote).dict())
+                count += 1
+                last_vote = db_vote
+            await db_votes.close()
+            yield '],"next_cursor":{}}}'.format(json.dumps(next_cursor))
+
+    return StreamingResponse(body(), media_type="application/json")
 
 
 @app.get("/existing-votes/{discord_id}", response_model=Vote)
-async def get_existing_vote(discord_id: str, db: Session = Depends(get_db)):
-    db_vote = get_existing_vote_by_discord_id(db, discord_id)
+async def get_existing_vote(
+    discord_id: str,
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+):
+    versions = await get_existing_vote_version(db, discord_id)
+    if versions is not None:
+        cached = not_modified(if_none_match, vote_etag(*versions))
+        if cached is not None:
+            return cached
+    db_vote = await get_existing_vote_by_discord_id(db, discord_id)
     if db_vote is None:
         raise HTTPException(
             status_code=400,
             detail="No existing votes found for {}".format(discord_id),
         )
-    return Vote.from_orm(db_vote)
+    tag = vote_etag(
+        db_vote.message_id, db_vote.version, db_vote.on_behalf_of.version
+    )
+    return model_response(Vote.from_orm(db_vote), headers={"ETag": tag})
 
 
 @app.post("/votes", response_model=Vote)
-async def add_vote(vote: VoteBase, db: Session = Depends(get_db)):
-    db_vote = create_vote(db, vote)
-    return Vote.from_orm(db_vote)
+async def add_vote(vote: VoteBase, db: AsyncSession = Depends(get_db)):
+    db_vote = await create_vote(db, vote)
+    return model_response(Vote.from_orm(db_vote))
 
 
 @app.get("/outstanding-votes", response_model=VotesResponse)
-async def get_outstanding_votes(db: Session = Depends(get_db)):
-    votes = get_current_votes(db)
-    for vote in votes:
-        if vote.failed:
-            complete_vote(db, vote)
-    return {"votes": [Vote.from_orm(vote) for vote in votes]}
+async def get_outstanding_votes(db: AsyncSession = Depends(get_db)):
+    votes = await sweep_votes(db)
+    return model_response(
+        VotesResponse.construct(votes=[Vote.from_orm(vote) for vote in votes])
+    )
 
 
 @app.post("/vouches", response_model=VouchEvent)
-async def get_vouch_event(vouch: VouchEventBase, db: Session = Depends(get_db)):
-    vouch_db = get_vouch_event_by_ids(db, vouch)
+async def get_vouch_event(vouch: VouchEventBase, db: AsyncSession = Depends(get_db)):
+    vouch_db = await get_vouch_event_by_ids(db, vouch)
     if vouch_db is None:
         raise HTTPException(
             status_code=400,
@@ -116,21 +309,23 @@ async def get_vouch_event(vouch: VouchEventBase, db: Session = Depends(get_db)):
                 vouch.vote_id, vouch.voucher_id
             ),
         )
-    return VouchEvent.from_orm(vouch_db)
+    return model_response(VouchEvent.from_orm(vouch_db))
 
 
 @app.post("/vouch-event", response_model=VouchEvent)
-async def add_vouch_event(vouch: VouchEventBase, db: Session = Depends(get_db)):
-    vouch_db = create_vouch_event(db, vouch)
-    print(vouch_db.vote.votes, vouch_db.vote.successful)
-    if vouch_db.vote.successful:
-        complete_vote(db, vouch_db.vote)
-    return VouchEvent.from_orm(vouch_db)
+async def add_vouch_event(vouch: VouchEventBase, db: AsyncSession = Depends(get_db)):
+    vouch_db = await cast_vouch(db, vouch)
+    if vouch_db is None:
+        raise HTTPException(
+            status_code=400,
+            detail="No vote found for message '{}'".format(vouch.vote_id),
+        )
+    return model_response(VouchEvent.from_orm(vouch_db))
 
 
 @app.post("/vouch-event/delete", response_model=Status)
-async def remove_vouch_event(vouch: VouchEventBase, db: Session = Depends(get_db)):
-    status = delete_vouch_event(db, vouch)
+async def remove_vouch_event(vouch: VouchEventBase, db: AsyncSession = Depends(get_db)):
+    status = await delete_vouch_event(db, vouch)
     if status:
         return Status(alive=status)
     raise HTTPException(
@@ -139,3 +334,16 @@ async def remove_vouch_event(vouch: VouchEventBase, db: Session = Depends(get_db
             vouch.vote_id, vouch.voucher_id
         ),
     )
+
+
+@app.post("/vouch-events/batch", response_model=VouchEventBatchResult)
+async def apply_vouch_event_batch(
+    batch: VouchEventBatch, db: AsyncSession = Depends(get_db)
+):
+    results, votes = await apply_vouch_events(db, batch.events)
+    return model_response(
+        VouchEventBatchResult.construct(
+            events=[VouchEventResult.construct(**result) for result in results],
+            votes=[VoteBase.from_orm(vote) for vote in votes],
+        )
+    )
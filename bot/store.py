@@ -0,0 +1,120 @@
+import asyncio
+import logging
+from typing import Dict, Optional, Tuple
+
+from . import db
+
+logger = logging.getLogger(__name__)
+
+# Keys of a main.py message tally that have their own columns.
+TALLY_COLUMNS = ("channelID", "startTime", "isEnded", "messageID")
+
+
+def _tally_row(message_id, tally: dict) -> dict:
+    return {
+        "message_id": str(message_id),
+        "channel_id": str(tally["channelID"]),
+        "start_time": tally.get("startTime"),
+        "is_ended": "isEnded" in tally,
+        "counts": {k: v for k, v in tally.items() if k not in TALLY_COLUMNS},
+    }
+
+
+def _tally_from_row(row: db.MessageTally) -> dict:
+    tally = dict(row.counts)
+    tally["channelID"] = int(row.channel_id)
+    if row.start_time is not None:
+        tally["startTime"] = row.start_time
+    return tally
+
+
+class StateStore:
+    """Write-behind persistence for ``bot.main`` channel preferences and tallies.
+
+    ``save_*`` only marks a key dirty, so reaction handlers never wait on
+    disk. A background task writes every dirty key in one transaction each
+    ``flush_interval`` seconds, so a crash loses at most that window.
+    """
+
+    def __init__(self, flush_interval: float = 1.0):
+        self.flush_interval = flush_interval
+        self._preferences: Dict[int, dict] = {}
+        self._tallies: Dict[int, dict] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def save_preference(self, channel_id: int, preference: dict):
+        self._preferences[channel_id] = preference
+
+    def save_tally(self, message_id: int, tally: dict):
+        self._tallies[message_id] = tally
+
+    async def load(self) -> Tuple[Dict[int, dict], Dict[int, dict]]:
+        """Return the saved preferences and the tallies of votes still open."""
+        await db.init_db()
+        async with db.SessionLocal() as session:
+            preferences = {
+                int(row.channel_id): dict(row.preferences)
+                for row in await db.get_channel_preferences(session)
+            }
+            tallies = {
+                int(row.message_id): _tally_from_row(row)
+                for row in await db.get_active_message_tallies(session)
+            }
+        return preferences, tallies
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            # Let a flush in progress put its rows back before the last one.
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        await db.engine.dispose()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        preferences, self._preferences = self._preferences, {}
+        tallies, self._tallies = self._tallies, {}
+        if not preferences and not tallies:
+            return
+        preference_rows = [
+            {"channel_id": str(channel_id), "preferences": dict(preference)}
+            for channel_id, preference in preferences.items()
+        ]
+        tally_rows = [
+            _tally_row(message_id, tally) for message_id, tally in tallies.items()
+        ]
+        try:
+            async with db.SessionLocal() as session:
+                await db.save_channel_preferences(session, preference_rows)
+                await db.save_message_tallies(session, tally_rows)
+                await session.commit()
+        except Exception:
+            logger.exception(
+                "State flush failed; keeping %d preferences and %d tallies dirty",
+                len(preferences),
+                len(tallies),
+            )
+            self._restore(preferences, tallies)
+        except BaseException:
+            # Cancelled part way through, e.g. by close().
+            self._restore(preferences, tallies)
+            raise
+
+    def _restore(self, preferences: Dict[int, dict], tallies: Dict[int, dict]):
+        # Keep anything that was not marked dirty again in the meantime.
+        for channel_id, preference in preferences.items():
+            self._preferences.setdefault(channel_id, preference)
+        for message_id, tally in tallies.items():
+            self._tallies.setdefault(message_id, tally)
@@ -0,0 +1,252 @@
+import abc
+import collections
+import contextlib
+import contextvars
+import functools
+import importlib
+import json
+import logging
+import queue
+import random
+import time
+from logging.handlers import QueueListener, RotatingFileHandler
+from typing import Deque, Dict, Iterable, Optional
+
+from .schemas import BotSettings
+
+
+def percentiles(samples: Iterable[float]) -> dict:
+    """Count and p50/p95/p99 in milliseconds of durations in seconds."""
+    ordered = sorted(samples)
+    n = len(ordered)
+    summary: Dict[str, float] = {"count": n}
+    if not n:
+        return summary
+    for q in (0.5, 0.95, 0.99):
+        index = min(n - 1, max(0, int(round(q * n)) - 1))
+        summary["p{}_ms".format(int(q * 100))] = 1000 * ordered[index]
+    return summary
+
+
+class Span:
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "name",
+        "start",
+        "duration",
+        "attributes",
+        "error",
+    )
+
+    def __init__(self, name: str, parent: Optional["Span"], attributes: dict):
+        self.name = name
+        self.span_id = "{:016x}".format(random.getrandbits(64))
+        self.parent_id = parent.span_id if parent is not None else None
+        self.trace_id = (
+            parent.trace_id
+            if parent is not None
+            else "{:032x}".format(random.getrandbits(128))
+        )
+        self.start = time.time()
+        self.duration = 0.0
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+    def to_dict(self) -> dict:
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+class _NoopSpan:
+    def set(self, key: str, value):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+# Marks the inside of a root span that was not sampled, so its children are
+# skipped too instead of starting traces of their own.
+_UNSAMPLED = object()
+_current: contextvars.ContextVar = contextvars.ContextVar("span", default=None)
+
+
+def current_span():
+    span = _current.get()
+    return span if isinstance(span, Span) else NOOP_SPAN
+
+
+class Exporter(abc.ABC):
+    """Receives every finished span of a sampled trace."""
+
+    @abc.abstractmethod
+    def export(self, span: Span):
+        ...
+
+    def export_summary(self, summary: dict):
+        pass
+
+    def close(self):
+        pass
+
+
+class _JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(record.msg)
+
+
+class JSONLExporter(Exporter):
+    """Writes spans as JSON lines to a rotating file from a background thread."""
+
+    def __init__(self, path: str, max_bytes: int = 10_000_000, backup_count: int = 3):
+        handler = RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count
+        )
+        handler.setFormatter(_JSONFormatter())
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._listener = QueueListener(self._queue, handler)
+        self._listener.start()
+
+    def _put(self, payload: dict):
+        self._queue.put(logging.makeLogRecord({"msg": payload, "args": None}))
+
+    def export(self, span: Span):
+        self._put(span.to_dict())
+
+    def export_summary(self, summary: dict):
+        self._put({"summary": summary, "time": time.time()})
+
+    def close(self):
+        self._listener.stop()
+
+
+class Tracer:
+    """Head-sampled spans carried in a context variable.
+
+    A span opened with no span around it is a root, and is sampled with
+    probability ``sample_rate``; spans inside it follow its decision. Root
+    durations are kept for every root, sampled or not, so ``summary`` gives
+    per-handler latency percentiles at the cost of two clock reads.
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = 0.0,
+        exporter: Optional[Exporter] = None,
+        reservoir_size: int = 2048,
+    ):
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+        self.reservoir_size = reservoir_size
+        self._durations: Dict[str, Deque[float]] = {}
+
+    def _record(self, name: str, duration: float):
+        samples = self._durations.get(name)
+        if samples is None:
+            samples = self._durations[name] = collections.deque(
+                maxlen=self.reservoir_size
+            )
+        samples.append(duration)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        parent = _current.get()
+        if parent is _UNSAMPLED:
+            yield NOOP_SPAN
+            return
+        sampled = parent is not None or (
+            self.exporter is not None and random.random() < self.sample_rate
+        )
+        start = time.perf_counter()
+        span = Span(name, parent, attributes) if sampled else None
+        token = _current.set(span if sampled else _UNSAMPLED)
+        try:
+            yield span if sampled else NOOP_SPAN
+        except BaseException as e:
+            if sampled:
+                span.error = repr(e)
+            raise
+        finally:
+            _current.reset(token)
+            duration = time.perf_counter() - start
+            if parent is None:
+                self._record(name, duration)
+            if sampled:
+                span.duration = duration
+                self.exporter.export(span)
+
+    def traced(self, name: Optional[str] = None):
+        """Run a coroutine function inside a span named after it."""
+
+        def decorator(func):
+            span_name = name or func.__name__
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return await func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def summary(self) -> dict:
+        return {
+            name: percentiles(samples) for name, samples in self._durations.items()
+        }
+
+    def close(self):
+        if self.exporter is not None:
+            self.exporter.export_summary(self.summary())
+            self.exporter.close()
+            self.exporter = None
+
+
+tracer = Tracer()
+
+
+def configure(settings: BotSettings, service: str):
+    """Point the shared ``tracer`` at the exporter ``settings`` describe.
+
+    ``trace_exporter`` may name a ``module:callable`` that takes the
+    settings and the service name and returns an ``Exporter``.
+    """
+    tracer.sample_rate = settings.trace_sample_rate
+    if settings.trace_sample_rate <= 0:
+        tracer.exporter = None
+    elif settings.trace_exporter:
+        module, _, attr = settings.trace_exporter.partition(":")
+        factory = getattr(importlib.import_module(module), attr)
+        tracer.exporter = factory(settings, service)
+    else:
+        tracer.exporter = JSONLExporter(
+            settings.trace_file or "traces-{}.jsonl".format(service),
+            max_bytes=settings.trace_file_max_bytes,
+            backup_count=settings.trace_file_backups,
+        )
+
+
+class _RateLimitTagger(logging.Handler):
+    # discord.py sleeps out 429s inside HTTPClient.request and only logs
+    # them, so count them on the REST span that hit them.
+    def emit(self, record: logging.LogRecord):
+        span = _current.get()
+        if isinstance(span, Span) and "rate limited" in record.getMessage():
+            span.set("rate_limited", span.attributes.get("rate_limited", 0) + 1)
+
+
+def instrument_discord(client):
+    """Open a child span for every REST call ``client`` makes."""
+    http = client.http
+    request = http.request
+
+    async def traced_request(route, **kwargs):
+        with tracer.span(
+            "discord {} {}".format(route.method, route.path), url=route.url
+        ):
+            return await request(route, **kwargs)
+
+    http.request = traced_request
+    logging.getLogger("discord.http").addHandler(_RateLimitTagger(logging.WARNING))
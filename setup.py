@@ -6,9 +6,12 @@ setup(
     packages=find_packages(),
     install_requires=[
         "python-dotenv>=0.20.0",
-        "sqlalchemy>=1.4.37",
+        "sqlalchemy[asyncio]>=1.4.37",
+        "aiosqlite",
         "fastapi[all]>=0.78.0",
-        "discord>=1.7.3",
+        "discord.py>=2.0",
+        "aiohttp",
+        "orjson",
         "wheel",
     ],
     entry_points={"console_scripts": ["run-discord=bot.bot:main"]},
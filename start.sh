@@ -5,5 +5,7 @@ cd "$_dir"
 
 source .env
 export DISCORD_TOKEN
-uvicorn bot.server:app &
+if [ "${BACKEND_MODE:-http}" != "embedded" ]; then
+    uvicorn bot.server:app &
+fi
 run-discord
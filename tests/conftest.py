@@ -0,0 +1,83 @@
+import asyncio
+import datetime
+import os
+import tempfile
+
+import pytest
+
+_tmpdir = tempfile.TemporaryDirectory()
+DATABASE_PATH = os.path.join(_tmpdir.name, "test.db")
+# bot.db reads the URL when it is imported, and bot.bot sets up tracing.
+os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///{}".format(DATABASE_PATH)
+os.environ["TRACE_SAMPLE_RATE"] = "0"
+
+import httpx  # noqa: E402
+
+from bot import db  # noqa: E402
+
+
+async def _dispose_after(coro):
+    try:
+        return await coro
+    finally:
+        # Pooled aiosqlite connections belong to this loop.
+        await db.engine.dispose()
+
+
+def _run(coro):
+    return asyncio.run(_dispose_after(coro))
+
+
+async def _reset():
+    async with db.engine.begin() as conn:
+        await conn.run_sync(db.Base.metadata.drop_all)
+    await db.init_db()
+
+
+@pytest.fixture
+def run():
+    """Runs a coroutine on a fresh event loop against empty tables."""
+    _run(_reset())
+    return _run
+
+
+@pytest.fixture
+def api():
+    """Returns a factory for clients of ``bot.server.app`` that need no server."""
+    from bot.server import app
+
+    def client() -> httpx.AsyncClient:
+        transport = httpx.ASGITransport(app=app)
+        return httpx.AsyncClient(transport=transport, base_url="http://test")
+
+    return client
+
+
+def member_json(discord_id: str) -> dict:
+    return {"discord_id": discord_id, "discord_name": "member-{}".format(discord_id)}
+
+
+def vote_json(message_id: str, on_behalf_of_id: str, vouches_required: int) -> dict:
+    return {
+        "message_id": message_id,
+        "on_behalf_of_id": on_behalf_of_id,
+        "start_time": datetime.datetime.utcnow().isoformat(),
+        "days": 7,
+        "vouches_required": vouches_required,
+    }
+
+
+@pytest.fixture
+def seed_vote():
+    """Creates a member and an open vote for them through the API."""
+
+    async def seed_vote(client, message_id="1000", vouches_required=1000):
+        resp = await client.post("/members", json=member_json("1"))
+        assert resp.status_code == 200
+        resp = await client.post(
+            "/votes", json=vote_json(message_id, "1", vouches_required)
+        )
+        assert resp.status_code == 200
+        return resp.json()
+
+    return seed_vote
@@ -0,0 +1,60 @@
+import asyncio
+
+from bot.batcher import VouchBatcher
+from bot.schemas import VouchEventAction, VouchEventBatchResult, VouchEventResult
+
+
+def event(voucher_id: str) -> VouchEventAction:
+    return VouchEventAction(vote_id="1000", voucher_id=voucher_id)
+
+
+def answer(events, count=None) -> VouchEventBatchResult:
+    return VouchEventBatchResult(
+        events=[
+            VouchEventResult(**e.dict(), applied=True) for e in events[:count]
+        ],
+        votes=[],
+    )
+
+
+def test_close_waits_for_the_queued_batch():
+    sent = []
+
+    async def send(events):
+        await asyncio.sleep(0.1)
+        sent.extend(events)
+        return answer(events)
+
+    async def scenario():
+        batcher = VouchBatcher(send, window=60)
+        submits = [
+            asyncio.ensure_future(batcher.submit(event(str(i)))) for i in range(3)
+        ]
+        await asyncio.sleep(0)
+        await batcher.close()
+        # The backend may be closed now: the batch has been applied.
+        assert len(sent) == 3
+        return await asyncio.gather(*submits)
+
+    results = asyncio.run(scenario())
+    assert [result.voucher_id for result, _ in results] == ["0", "1", "2"]
+
+
+def test_short_response_fails_the_unanswered_events():
+    async def send(events):
+        return answer(events, count=1)
+
+    async def scenario():
+        batcher = VouchBatcher(send, window=60)
+        submits = [
+            asyncio.ensure_future(batcher.submit(event(str(i)))) for i in range(3)
+        ]
+        await asyncio.sleep(0)
+        batcher.flush()
+        return await asyncio.wait_for(
+            asyncio.gather(*submits, return_exceptions=True), timeout=1
+        )
+
+    first, *rest = asyncio.run(scenario())
+    assert first[0].voucher_id == "0"
+    assert [type(error) for error in rest] == [RuntimeError, RuntimeError]
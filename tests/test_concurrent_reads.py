@@ -0,0 +1,40 @@
+import asyncio
+import time
+
+import aiosqlite
+
+from conftest import DATABASE_PATH
+
+
+def test_reads_continue_during_a_slow_commit(run, api, seed_vote):
+    hold = 1.0
+
+    async def slow_commit(locked: asyncio.Event) -> float:
+        async with aiosqlite.connect(DATABASE_PATH, isolation_level=None) as conn:
+            await conn.execute("BEGIN EXCLUSIVE")
+            await conn.execute("UPDATE vouch_votes SET votes = votes + 1")
+            locked.set()
+            await asyncio.sleep(hold)
+            await conn.execute("COMMIT")
+            return time.perf_counter()
+
+    async def read(client) -> float:
+        resp = await client.get("/votes/1000")
+        assert resp.status_code == 200
+        return time.perf_counter()
+
+    async def scenario():
+        async with api() as client:
+            await seed_vote(client, message_id="1000")
+            locked = asyncio.Event()
+            writer = asyncio.ensure_future(slow_commit(locked))
+            await locked.wait()
+            start = time.perf_counter()
+            read_times = await asyncio.gather(*(read(client) for _ in range(50)))
+            committed_at = await writer
+            return start, read_times, committed_at
+
+    start, read_times, committed_at = run(scenario())
+    # Every read was answered while the writer still held its lock.
+    assert max(read_times) < committed_at
+    assert max(read_times) - start < hold
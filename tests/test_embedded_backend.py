@@ -0,0 +1,27 @@
+import asyncio
+import signal
+
+from bot.backend import EmbeddedBackend
+from bot.schemas import BotSettings
+from test_etags import free_port
+
+SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+
+def test_co_hosted_server_leaves_the_signals_to_the_bot(run):
+    async def scenario():
+        # asyncio.run has installed its own SIGINT handler by now.
+        before = {sig: signal.getsignal(sig) for sig in SIGNALS}
+        backend = EmbeddedBackend(
+            BotSettings(backend_serve_http=True, backend_http_port=free_port())
+        )
+        await backend.start()
+        try:
+            while backend._server is None or not backend._server.started:
+                await asyncio.sleep(0.01)
+            return before, {sig: signal.getsignal(sig) for sig in SIGNALS}
+        finally:
+            await backend.close()
+
+    before, serving = run(scenario())
+    assert serving == before
@@ -0,0 +1,162 @@
+import asyncio
+import datetime
+import socket
+
+import uvicorn
+
+from bot import db, server
+from bot.backend import HTTPBackend
+from bot.schemas import BotSettings
+from conftest import member_json
+
+
+def count_serializations(monkeypatch) -> list:
+    calls = []
+    model_response = server.model_response
+
+    def counting(model, headers=None):
+        calls.append(type(model).__name__)
+        return model_response(model, headers=headers)
+
+    monkeypatch.setattr(server, "model_response", counting)
+    return calls
+
+
+def test_matching_if_none_match_skips_serialization(run, api, seed_vote, monkeypatch):
+    async def scenario():
+        async with api() as client:
+            await seed_vote(client, message_id="1000")
+            calls = count_serializations(monkeypatch)
+            answers = []
+            for path in ("/votes/1000", "/members/1", "/existing-votes/1"):
+                first = await client.get(path)
+                second = await client.get(
+                    path, headers={"If-None-Match": first.headers["ETag"]}
+                )
+                answers.append((first, second))
+            return answers, calls
+
+    answers, calls = run(scenario())
+    for first, second in answers:
+        assert first.status_code == 200
+        assert second.status_code == 304
+        assert second.headers["ETag"] == first.headers["ETag"]
+        assert second.content == b""
+    # Only the three first reads were built and encoded.
+    assert calls == ["Vote", "Member", "Vote"]
+
+
+def vouch(voucher_id, action="add"):
+    return {"vote_id": "1000", "voucher_id": voucher_id, "action": action}
+
+
+def test_every_write_changes_the_etags(run, api, seed_vote):
+    async def expire_vote():
+        async with db.SessionLocal() as session:
+            vote = await db.get_vote_by_id(session, "1000")
+            vote.end_time = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+            await session.commit()
+
+    writes = {
+        "add vouch": lambda client: client.post(
+            "/vouch-event", json=vouch("2000")
+        ),
+        "remove vouch": lambda client: client.post(
+            "/vouch-event/delete", json=vouch("2000")
+        ),
+        "batch add": lambda client: client.post(
+            "/vouch-events/batch", json={"events": [vouch("2000"), vouch("2001")]}
+        ),
+        # Adds one vouch and removes another: the count is unchanged.
+        "mixed batch": lambda client: client.post(
+            "/vouch-events/batch",
+            json={"events": [vouch("2002"), vouch("2000", "remove")]},
+        ),
+        "member update": lambda client: client.put(
+            "/members", json=dict(member_json("1"), discord_name="renamed")
+        ),
+        "sweep": lambda client: client.get("/outstanding-votes"),
+    }
+
+    async def etags(client):
+        return (
+            (await client.get("/votes/1000")).headers["ETag"],
+            (await client.get("/members/1")).headers["ETag"],
+        )
+
+    async def scenario():
+        changed = {}
+        async with api() as client:
+            await seed_vote(client, message_id="1000")
+            for name, write in writes.items():
+                before = await etags(client)
+                if name == "sweep":
+                    await expire_vote()
+                    before = await etags(client)
+                resp = await write(client)
+                assert resp.status_code == 200, name
+                after = await etags(client)
+                changed[name] = (before[0] != after[0], before[1] != after[1])
+        return changed
+
+    changed = run(scenario())
+    assert changed == {name: (True, True) for name in writes}
+
+
+def test_mixed_batch_bumps_vote_version(run, api, seed_vote):
+    async def scenario():
+        async with api() as client:
+            await seed_vote(client, message_id="1000")
+            await client.post("/vouch-event", json=vouch("2000"))
+            first = await client.get("/votes/1000")
+            await client.post(
+                "/vouch-events/batch",
+                json={"events": [vouch("2001"), vouch("2000", "remove")]},
+            )
+            second = await client.get(
+                "/votes/1000", headers={"If-None-Match": first.headers["ETag"]}
+            )
+            return first, second
+
+    first, second = run(scenario())
+    assert second.status_code == 200
+    assert first.json()["votes"] == second.json()["votes"] == 1
+    assert [v["voucher_id"] for v in second.json()["vouches"]] == ["2001"]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_http_backend_reuses_its_cached_model_on_304(run, seed_vote, api):
+    port = free_port()
+
+    async def scenario():
+        async with api() as client:
+            await seed_vote(client, message_id="1000")
+        config = uvicorn.Config(server.app, host="127.0.0.1", port=port)
+        http_server = uvicorn.Server(config)
+        serving = asyncio.ensure_future(http_server.serve())
+        while not http_server.started:
+            await asyncio.sleep(0.01)
+        backend = HTTPBackend(
+            BotSettings(backend_url="http://127.0.0.1:{}".format(port))
+        )
+        try:
+            first = await backend.get_vote("1000")
+            second = await backend.get_vote("1000")
+            async with api() as client:
+                await client.post("/vouch-event", json=vouch("2000"))
+            third = await backend.get_vote("1000")
+        finally:
+            await backend.close()
+            http_server.should_exit = True
+            await serving
+        return first, second, third
+
+    first, second, third = run(scenario())
+    assert second is first
+    assert third is not first
+    assert third.votes == 1
@@ -0,0 +1,21 @@
+from conftest import vote_json
+
+
+def test_votes_are_streamed_in_pages(run, api, seed_vote):
+    async def scenario():
+        pages = []
+        async with api() as client:
+            await seed_vote(client, message_id="1000")
+            for message_id in ("1001", "1002"):
+                await client.post("/votes", json=vote_json(message_id, "1", 5))
+            params = {"limit": 2}
+            while True:
+                resp = await client.get("/votes", params=params)
+                assert resp.status_code == 200
+                page = resp.json()
+                pages.append([vote["message_id"] for vote in page["votes"]])
+                if page["next_cursor"] is None:
+                    return pages
+                params["cursor"] = page["next_cursor"]
+
+    assert run(scenario()) == [["1000", "1001"], ["1002"]]
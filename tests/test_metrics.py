@@ -0,0 +1,24 @@
+from sqlalchemy import create_engine, exc, text
+
+from bot import metrics
+
+
+def select_count() -> int:
+    counts, _ = metrics.db_query_latency.values.get(("SELECT",), ([0], None))
+    return sum(counts)
+
+
+def test_failed_statements_leave_no_timing_state_behind():
+    engine = create_engine("sqlite://")
+    metrics.instrument_engine(engine)
+    with engine.connect() as conn:
+        for _ in range(3):
+            try:
+                conn.execute(text("SELECT * FROM missing_table"))
+            except exc.OperationalError:
+                pass
+        before = select_count()
+        assert conn.execute(text("SELECT 1")).scalar() == 1
+        assert select_count() == before + 1
+        assert not conn.info.get("query_start")
+    engine.dispose()
@@ -0,0 +1,94 @@
+import datetime
+
+import aiosqlite
+from sqlalchemy import inspect
+
+from bot import db
+from conftest import DATABASE_PATH
+
+# The schema the first release created, before versions, completion times,
+# the composite index and the unique vouch index.
+LEGACY_SCHEMA = """
+CREATE TABLE members (
+    discord_id VARCHAR NOT NULL PRIMARY KEY,
+    discord_name VARCHAR NOT NULL,
+    discord_pp_url VARCHAR,
+    is_vouched_for BOOLEAN,
+    is_voter BOOLEAN
+);
+CREATE INDEX ix_members_discord_id ON members (discord_id);
+CREATE TABLE vouch_votes (
+    message_id VARCHAR NOT NULL PRIMARY KEY,
+    on_behalf_of_id VARCHAR REFERENCES members (discord_id),
+    message_text VARCHAR,
+    start_time DATETIME NOT NULL,
+    end_time DATETIME NOT NULL,
+    vouches_required INTEGER NOT NULL,
+    votes INTEGER,
+    complete BOOLEAN
+);
+CREATE INDEX ix_vouch_votes_message_id ON vouch_votes (message_id);
+CREATE TABLE vouches (
+    vouch_id INTEGER NOT NULL PRIMARY KEY,
+    vote_id VARCHAR REFERENCES vouch_votes (message_id),
+    voucher_id VARCHAR REFERENCES members (discord_id)
+);
+"""
+
+
+async def create_legacy_database():
+    async with db.engine.begin() as conn:
+        await conn.run_sync(db.Base.metadata.drop_all)
+    await db.engine.dispose()
+    start = datetime.datetime.utcnow()
+    async with aiosqlite.connect(DATABASE_PATH) as conn:
+        await conn.executescript(LEGACY_SCHEMA)
+        await conn.execute("INSERT INTO members VALUES ('1', 'one', NULL, 0, 0)")
+        await conn.execute(
+            "INSERT INTO vouch_votes VALUES ('1000', '1', NULL, ?, ?, 5, 3, 0)",
+            (start, start + datetime.timedelta(days=7)),
+        )
+        # A vouch that a replayed event stored, and counted, twice.
+        await conn.executemany(
+            "INSERT INTO vouches (vote_id, voucher_id) VALUES ('1000', ?)",
+            [("2000",), ("2000",), ("2001",)],
+        )
+        await conn.commit()
+
+
+def schema(conn):
+    inspector = inspect(conn)
+    return {
+        table: (
+            {column["name"] for column in inspector.get_columns(table)},
+            {index["name"] for index in inspector.get_indexes(table)},
+        )
+        for table in inspector.get_table_names()
+    }
+
+
+def test_init_db_upgrades_a_legacy_database(run, api):
+    async def scenario():
+        await create_legacy_database()
+        await db.init_db()
+        # A second start finds nothing left to do.
+        await db.init_db()
+        async with db.engine.connect() as conn:
+            upgraded = await conn.run_sync(schema)
+        async with api() as client:
+            vote = await client.get("/votes/1000")
+            member = await client.get("/members/1")
+        return upgraded, vote, member
+
+    upgraded, vote, member = run(scenario())
+    assert {"completed_at", "version"} <= upgraded["vouch_votes"][0]
+    assert "version" in upgraded["members"][0]
+    assert "ix_vouch_votes_on_behalf_of_complete_end" in upgraded["vouch_votes"][1]
+    assert "uq_vouches_vote_voucher" in upgraded["vouches"][1]
+    assert vote.status_code == 200
+    assert vote.json()["votes"] == 2
+    assert [vouch["voucher_id"] for vouch in vote.json()["vouches"]] == [
+        "2000",
+        "2001",
+    ]
+    assert member.status_code == 200
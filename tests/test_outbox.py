@@ -0,0 +1,57 @@
+import asyncio
+import logging
+
+from bot.outbox import REPLY, ROLE_GRANT, Outbox
+
+
+def test_close_runs_queued_role_grants_and_notices():
+    granted = []
+    notices = []
+
+    async def scenario():
+        outbox = Outbox(coalesce_window=60)
+        outbox.start()
+        # More than the roles bucket holds, so some wait for tokens.
+        for user_id in range(12):
+            outbox.submit(
+                ("roles", 1),
+                lambda user_id=user_id: asyncio.sleep(0, granted.append(user_id)),
+                ROLE_GRANT,
+            )
+        for name in ("a", "b"):
+            outbox.coalesce(
+                ("not-authorized", 1),
+                name,
+                ("reply", 1),
+                lambda names: asyncio.sleep(0, notices.append(names)),
+                REPLY,
+            )
+        await outbox.close(timeout=5)
+        return outbox.stats()
+
+    stats = asyncio.run(scenario())
+    assert sorted(granted) == list(range(12))
+    assert notices == [["a", "b"]]
+    assert stats["depth"] == 0 and stats["pending_notices"] == 0
+
+
+def test_close_gives_up_after_the_timeout(caplog):
+    granted = []
+
+    async def scenario():
+        outbox = Outbox(limits={"roles": (1, 60.0)})
+        outbox.start()
+        for user_id in range(3):
+            outbox.submit(
+                ("roles", 1),
+                lambda user_id=user_id: asyncio.sleep(0, granted.append(user_id)),
+                ROLE_GRANT,
+            )
+        await outbox.close(timeout=0.2)
+        return len(outbox)
+
+    with caplog.at_level(logging.WARNING, logger="bot.outbox"):
+        left = asyncio.run(scenario())
+    assert granted == [0]
+    assert left == 2
+    assert "2 actions still queued" in caplog.text
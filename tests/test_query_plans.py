@@ -0,0 +1,40 @@
+from sqlalchemy import event
+
+from bot import db
+from bot.schemas import VouchEventBase
+
+
+async def query_plan(lookup) -> str:
+    """The SQLite query plan of the first statement ``lookup(session)`` runs."""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(db.engine.sync_engine, "before_cursor_execute", capture)
+    try:
+        async with db.SessionLocal() as session:
+            await lookup(session)
+    finally:
+        event.remove(db.engine.sync_engine, "before_cursor_execute", capture)
+    statement, parameters = statements[0]
+    async with db.engine.connect() as conn:
+        result = await conn.exec_driver_sql(
+            "EXPLAIN QUERY PLAN " + statement, parameters
+        )
+        return "\n".join(row[-1] for row in result)
+
+
+def test_existing_vote_lookup_uses_composite_index(run):
+    plan = run(
+        query_plan(lambda session: db.get_existing_vote_by_discord_id(session, "1"))
+    )
+    assert "ix_vouch_votes_on_behalf_of_complete_end" in plan
+
+
+def test_vouch_event_lookup_uses_unique_index(run):
+    vouch = VouchEventBase(vote_id="1000", voucher_id="2000")
+    plan = run(
+        query_plan(lambda session: db.get_vouch_event_by_ids(session, vouch))
+    )
+    assert "uq_vouches_vote_voucher" in plan
@@ -0,0 +1,110 @@
+import asyncio
+import datetime
+
+from bot.scheduler import DeadlineScheduler
+
+
+def in_seconds(seconds: float) -> datetime.datetime:
+    return datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+
+
+def scheduler_run(scenario):
+    """Runs ``scenario(scheduler, fired)`` with the scheduler started."""
+    fired = []
+
+    async def main():
+        async def callback(key):
+            fired.append(key)
+
+        scheduler = DeadlineScheduler(callback)
+        scheduler.start()
+        try:
+            await scenario(scheduler, fired)
+        finally:
+            scheduler.stop()
+
+    asyncio.run(main())
+    return fired
+
+
+def test_due_deadlines_fire_once_in_order():
+    async def scenario(scheduler, fired):
+        scheduler.schedule("later", in_seconds(0.1))
+        scheduler.schedule("past", in_seconds(-5))
+        scheduler.schedule("soon", in_seconds(0.05))
+        scheduler.schedule("tomorrow", in_seconds(86400))
+        await asyncio.sleep(0.3)
+        assert len(scheduler) == 1 and "tomorrow" in scheduler
+
+    assert scheduler_run(scenario) == ["past", "soon", "later"]
+
+
+def test_rescheduling_earlier_wakes_the_runner():
+    async def scenario(scheduler, fired):
+        scheduler.schedule("vote", in_seconds(86400))
+        await asyncio.sleep(0.05)
+        scheduler.schedule("vote", in_seconds(0.05))
+        await asyncio.sleep(0.3)
+
+    assert scheduler_run(scenario) == ["vote"]
+
+
+def test_rescheduling_later_drops_the_old_deadline():
+    async def scenario(scheduler, fired):
+        scheduler.schedule("vote", in_seconds(0.05))
+        scheduler.schedule("vote", in_seconds(0.4))
+        await asyncio.sleep(0.2)
+        # The stale entry came due without firing.
+        assert fired == [] and "vote" in scheduler
+        await asyncio.sleep(0.4)
+
+    assert scheduler_run(scenario) == ["vote"]
+
+
+def test_cancelled_deadlines_never_fire():
+    async def scenario(scheduler, fired):
+        scheduler.schedule("vote", in_seconds(0.05))
+        scheduler.schedule("other", in_seconds(0.1))
+        scheduler.cancel("vote")
+        scheduler.cancel("unknown")
+        assert "vote" not in scheduler and len(scheduler) == 1
+        await asyncio.sleep(0.3)
+
+    assert scheduler_run(scenario) == ["other"]
+
+
+def test_stale_entries_are_compacted():
+    async def scenario(scheduler, fired):
+        for i in range(1000):
+            scheduler.schedule(i, in_seconds(3600))
+            scheduler.cancel(i)
+        for i in range(1000):
+            scheduler.schedule("vote", in_seconds(3600 + i))
+        assert len(scheduler) == 1
+        # Cancelled and superseded entries do not pile up in the heap.
+        assert len(scheduler._heap) <= 2 * len(scheduler) + 65
+        scheduler.schedule("vote", in_seconds(0.05))
+        await asyncio.sleep(0.3)
+
+    assert scheduler_run(scenario) == ["vote"]
+
+
+def test_a_failing_callback_does_not_stop_the_runner(caplog):
+    fired = []
+
+    async def callback(key):
+        fired.append(key)
+        if key == "bad":
+            raise ValueError(key)
+
+    async def main():
+        scheduler = DeadlineScheduler(callback)
+        scheduler.start()
+        scheduler.schedule("bad", in_seconds(0.02))
+        scheduler.schedule("good", in_seconds(0.1))
+        await asyncio.sleep(0.3)
+        scheduler.stop()
+
+    asyncio.run(main())
+    assert fired == ["bad", "good"]
+    assert "Deadline callback failed for 'bad'" in caplog.text
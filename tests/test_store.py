@@ -0,0 +1,81 @@
+import asyncio
+import os
+import signal
+import sys
+
+from bot import db
+from bot.store import StateStore
+
+# Saves one tally as fast as it can and reports each save on stdout.
+BURST = """
+import asyncio, itertools, sys, time
+from bot.store import StateStore
+
+async def main():
+    store = StateStore(flush_interval={flush_interval})
+    await store.load()
+    store.start()
+    for seq in itertools.count(1):
+        store.save_tally(1, {{"channelID": 1, "seq": seq}})
+        print(seq, time.monotonic(), flush=True)
+        await asyncio.sleep(0.001)
+
+asyncio.run(main())
+"""
+
+
+def test_killed_during_a_burst_loses_at_most_the_flush_window(run):
+    flush_interval = 0.05
+
+    async def scenario():
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-c",
+            BURST.format(flush_interval=flush_interval),
+            stdout=asyncio.subprocess.PIPE,
+            env=dict(os.environ, PYTHONPATH=os.getcwd()),
+        )
+        saved = {}
+        while len(saved) < 500:
+            seq, at = (await proc.stdout.readline()).split()
+            saved[int(seq)] = float(at)
+        proc.send_signal(signal.SIGKILL)
+        async for line in proc.stdout:
+            seq, at = line.split()
+            saved[int(seq)] = float(at)
+        await proc.wait()
+        _, tallies = await StateStore().load()
+        return saved, tallies[1]["seq"]
+
+    saved, persisted = run(scenario())
+    last = max(saved)
+    lost = last - persisted
+    print("{} of {} updates lost".format(lost, last))
+    assert 0 <= lost < last
+    # Only what was saved since the last completed flush is gone.
+    assert saved[last] - saved[persisted] < flush_interval + 0.5
+
+
+def test_close_keeps_rows_from_a_cancelled_flush(run, monkeypatch):
+    save_message_tallies = db.save_message_tallies
+    writing = None
+
+    async def slow_save(session, rows):
+        writing.set()
+        await asyncio.sleep(1)
+        await save_message_tallies(session, rows)
+
+    async def scenario():
+        nonlocal writing
+        writing = asyncio.Event()
+        store = StateStore(flush_interval=0.01)
+        store.start()
+        store.save_tally(1, {"channelID": 1, "seq": 1})
+        monkeypatch.setattr(db, "save_message_tallies", slow_save)
+        await writing.wait()
+        monkeypatch.setattr(db, "save_message_tallies", save_message_tallies)
+        await store.close()
+        _, tallies = await StateStore().load()
+        return tallies
+
+    assert run(scenario()) == {1: {"channelID": 1, "seq": 1}}
@@ -0,0 +1,119 @@
+import datetime
+from types import SimpleNamespace
+from typing import Optional
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from bot import bot
+from bot.backend import Backend, HTTPBackend
+from bot.cache import VoteCache
+from bot.schemas import BotSettings, Vote, VoteBase
+
+
+class CountingBackend(Backend):
+    """Answers ``get_vote`` from a dict and counts every call it gets."""
+
+    def __init__(self, votes):
+        self.votes = votes
+        self.calls = 0
+
+    async def get_vote(self, message_id: str) -> Optional[Vote]:
+        self.calls += 1
+        return self.votes.get(str(message_id))
+
+    async def _unused(self, *args):
+        raise AssertionError("unexpected backend call")
+
+    status = add_member = get_member = upsert_member = upsert_members = _unused
+    get_existing_vote = add_vote = add_vouch_event = remove_vouch_event = _unused
+    apply_vouch_events = get_outstanding_votes = _unused
+
+
+def open_vote(message_id: str, days: int = 7) -> VoteBase:
+    return VoteBase(
+        message_id=message_id,
+        on_behalf_of_id="1",
+        start_time=datetime.datetime.utcnow(),
+        days=days,
+        vouches_required=3,
+    )
+
+
+def test_repeated_reactions_make_one_backend_call(run, monkeypatch):
+    backend = CountingBackend({"1000": open_vote("1000")})
+    monkeypatch.setattr(bot.client, "backend", backend)
+    monkeypatch.setattr(bot.client, "vote_cache", VoteCache())
+    vote_message = SimpleNamespace(id=1000)
+    chat_message = SimpleNamespace(id=1001)
+
+    async def scenario():
+        return [
+            await bot.is_message_active_vote(message)
+            for _ in range(50)
+            for message in (vote_message, chat_message)
+        ]
+
+    answers = run(scenario())
+    assert answers == [True, False] * 50
+    # One miss per message; every later reaction is answered from the cache.
+    assert backend.calls == 2
+    assert bot.client.vote_cache.stats()["hits"] == 98
+    assert bot.client.vote_cache.stats()["misses"] == 2
+
+
+def test_entries_expire_and_evict():
+    cache = VoteCache(max_size=2, negative_ttl=3600)
+    cache.put("1", open_vote("1", days=-1))
+    assert cache.get("1") is None
+    cache.put("1", open_vote("1"))
+    cache.put("2", None)
+    cache.get("1")
+    cache.put("3", open_vote("3"))
+    # "2" was the least recently used.
+    assert cache.get("2") is None
+    assert cache.get("1").active
+    assert cache.get("3").active
+
+
+def test_server_errors_are_not_cached_as_missing_votes(run, monkeypatch):
+    statuses = [500, 503, 400]
+
+    async def get_vote(request):
+        return web.json_response({"detail": "error"}, status=statuses.pop(0))
+
+    monkeypatch.setattr(bot.client, "vote_cache", VoteCache())
+    vote_message = SimpleNamespace(id=1000)
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get("/votes/{message_id}", get_vote)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        backend = HTTPBackend(
+            BotSettings(backend_url="http://127.0.0.1:{}".format(port))
+        )
+        monkeypatch.setattr(bot.client, "backend", backend)
+        errors = []
+        try:
+            for _ in range(2):
+                with pytest.raises(aiohttp.ClientResponseError) as error:
+                    await bot.is_message_active_vote(vote_message)
+                errors.append(error.value.status)
+                # The next reaction must ask the backend again.
+                assert len(bot.client.vote_cache) == 0
+            # Only the API's "not found" answer is cached.
+            answer = await bot.is_message_active_vote(vote_message)
+            return errors, answer
+        finally:
+            await backend.close()
+            await runner.cleanup()
+
+    errors, answer = run(scenario())
+    assert errors == [500, 503]
+    assert answer is False
+    assert len(bot.client.vote_cache) == 1
@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+
+from bot.reactions import eligible_role_ids, quorum_reached, track_vote, untrack_vote
+from bot.roles import GuildRoleIndex
+
+VOTER, MEMBER, OTHER = 1, 2, 3
+
+
+def role(role_id: int):
+    return SimpleNamespace(id=role_id, name=str(role_id), is_default=lambda: False)
+
+
+def guild_index() -> GuildRoleIndex:
+    roles = {role_id: role(role_id) for role_id in (VOTER, MEMBER, OTHER)}
+    members = [
+        SimpleNamespace(id=10, roles=[roles[VOTER], roles[MEMBER]]),
+        SimpleNamespace(id=11, roles=[roles[MEMBER]]),
+        SimpleNamespace(id=12, roles=[roles[OTHER]]),
+        SimpleNamespace(id=13, roles=[roles[VOTER]]),
+    ]
+    return GuildRoleIndex(
+        SimpleNamespace(id=1, roles=list(roles.values()), members=members)
+    )
+
+
+def new_tally() -> dict:
+    return {"positiveEmoji": 0, "negativeEmoji": 0, "channelID": 5}
+
+
+def test_adding_and_removing_the_same_reactor():
+    tally = new_tally()
+    assert track_vote(tally, "positiveEmoji", 10, [VOTER, MEMBER])
+    # A replayed add is not counted twice.
+    assert not track_vote(tally, "positiveEmoji", 10, [VOTER, MEMBER])
+    assert tally["positiveEmoji"] == 1
+    assert tally["roleCounts"]["positiveEmoji"] == {"1": 1, "2": 1}
+
+    assert untrack_vote(tally, "positiveEmoji", 10)
+    assert not untrack_vote(tally, "positiveEmoji", 10)
+    assert tally["positiveEmoji"] == 0
+    assert tally["roleCounts"]["positiveEmoji"] == {"1": 0, "2": 0}
+    # A reaction that was never counted is not uncounted.
+    assert not untrack_vote(tally, "negativeEmoji", 11)
+    assert tally["negativeEmoji"] == 0
+
+
+def test_sides_are_counted_separately():
+    tally = new_tally()
+    track_vote(tally, "positiveEmoji", 10, [VOTER])
+    track_vote(tally, "negativeEmoji", 11, [MEMBER])
+    untrack_vote(tally, "negativeEmoji", 10)
+    assert (tally["positiveEmoji"], tally["negativeEmoji"]) == (1, 1)
+
+
+def test_ineligible_reactors_have_no_roles_to_count():
+    index = guild_index()
+    eligible = [VOTER, MEMBER]
+    assert eligible_role_ids(index, 10, eligible) == [VOTER, MEMBER]
+    assert eligible_role_ids(index, 11, eligible) == [MEMBER]
+    assert eligible_role_ids(index, 12, eligible) == []
+    # Not in the guild's index at all.
+    assert eligible_role_ids(index, 99, eligible) == []
+
+
+def test_quorum_is_reached_at_the_threshold():
+    index = guild_index()
+    eligible = index.count_any([VOTER, MEMBER])
+    assert eligible == 3
+    tally = new_tally()
+    track_vote(tally, "positiveEmoji", 10, eligible_role_ids(index, 10, [VOTER]))
+    # 1 of 3 is 33.3%: not yet 50%, but enough for 33%.
+    assert not quorum_reached(tally, 50, eligible)
+    assert quorum_reached(tally, 33, eligible)
+    track_vote(tally, "positiveEmoji", 13, eligible_role_ids(index, 13, [VOTER]))
+    assert quorum_reached(tally, 50, eligible)
+    untrack_vote(tally, "positiveEmoji", 13)
+    assert not quorum_reached(tally, 50, eligible)
+    # The negative side can reach quorum too.
+    track_vote(tally, "negativeEmoji", 11, [MEMBER])
+    track_vote(tally, "negativeEmoji", 13, [VOTER])
+    assert quorum_reached(tally, 66, eligible)
+    assert not quorum_reached(tally, 67, eligible)
+
+
+def test_quorum_with_no_eligible_members_needs_a_vote():
+    tally = new_tally()
+    assert not quorum_reached(tally, 50, 0)
+    track_vote(tally, "positiveEmoji", 10, [VOTER])
+    assert quorum_reached(tally, 100, 0)
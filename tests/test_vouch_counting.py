@@ -0,0 +1,83 @@
+import asyncio
+
+from sqlalchemy import func, select
+
+from bot import db
+
+
+def test_parallel_vouch_events_are_counted_once(run, api, seed_vote):
+    voucher_ids = [str(2000 + i) for i in range(300)]
+
+    async def scenario():
+        async with api() as client:
+            await seed_vote(client, message_id="1000")
+            # Every voucher twice, as replayed gateway events would arrive.
+            responses = await asyncio.gather(
+                *(
+                    client.post(
+                        "/vouch-event",
+                        json={"vote_id": "1000", "voucher_id": voucher_id},
+                    )
+                    for voucher_id in voucher_ids * 2
+                )
+            )
+            assert [resp.status_code for resp in responses] == [200] * 600
+            vote = (await client.get("/votes/1000")).json()
+        async with db.SessionLocal() as session:
+            rows = await session.scalar(
+                select(func.count(db.Vouch.vouch_id)).where(db.Vouch.vote_id == "1000")
+            )
+        return vote, rows
+
+    vote, rows = run(scenario())
+    assert vote["votes"] == len(voucher_ids)
+    assert rows == len(voucher_ids)
+
+
+def test_replayed_vouch_does_not_complete_a_vote_again(run, api, seed_vote):
+    vouch = {"vote_id": "1000", "voucher_id": "2000"}
+
+    async def completed_vote():
+        async with db.SessionLocal() as session:
+            vote = await db.get_vote_by_id(session, "1000")
+            return vote.complete, vote.completed_at, vote.version
+
+    async def scenario():
+        async with api() as client:
+            await seed_vote(client, message_id="1000", vouches_required=1)
+            await client.post("/vouch-event", json=vouch)
+            first = await completed_vote()
+            resp = await client.post("/vouch-event", json=vouch)
+            assert resp.status_code == 200
+            return first, await completed_vote()
+
+    first, second = run(scenario())
+    assert first[0] is True
+    assert second == first
+
+
+def test_vouch_for_an_unknown_vote_writes_nothing(run, api, seed_vote):
+    async def scenario():
+        async with api() as client:
+            await seed_vote(client, message_id="1000")
+            single = await client.post(
+                "/vouch-event", json={"vote_id": "404", "voucher_id": "2000"}
+            )
+            batch = await client.post(
+                "/vouch-events/batch",
+                json={
+                    "events": [
+                        {"vote_id": "404", "voucher_id": "2001"},
+                        {"vote_id": "1000", "voucher_id": "2002"},
+                    ]
+                },
+            )
+        async with db.SessionLocal() as session:
+            rows = (await session.execute(select(db.Vouch.vote_id))).scalars().all()
+        return single, batch, rows
+
+    single, batch, rows = run(scenario())
+    assert single.status_code == 400
+    assert batch.status_code == 200
+    assert [event["applied"] for event in batch.json()["events"]] == [False, True]
+    assert rows == ["1000"]